@@ -15,7 +15,8 @@ The daemon should run on any machine which is attached to kegboard hardware.
 
 The daemon must connect to a Kegbot Core in order to publish data (such as flow
 and temperature events).  This is accomplished through Redis, which must be
-running locally.
+running locally.  If the core or Redis is unreachable, messages are spooled
+to disk with --spool_path and replayed once it is back.
 """
 
 from future import standard_library
@@ -23,15 +24,18 @@ standard_library.install_aliases()
 import queue
 
 import gflags
-import serial
+import selectors
 import os
 import time
 
 from kegbot.util import app
 from kegbot.util import util
 
+from kegbot.pycore import boards
 from kegbot.pycore import common_defs
+from kegbot.pycore import hotplug
 from kegbot.pycore import kegnet
+from kegbot.pycore import spool
 from kegbot.kegboard import kegboard
 
 FLAGS = gflags.FLAGS
@@ -40,6 +44,18 @@ gflags.DEFINE_string('kegboard_device_path', None,
     'Name of the single kegboard device to use.  If unset, the program '
     'will attempt to use all usb serial devices.')
 
+gflags.DEFINE_boolean('kegboard_hotplug', True,
+    'If true, watch for devices being plugged in or removed with inotify, '
+    'where available, rather than rescanning for devices periodically.')
+
+gflags.DEFINE_float('kegboard_rescan_interval', 30.0,
+    'Maximum seconds between rescans for devices when watching for hotplug '
+    'events.')
+
+gflags.DEFINE_integer('kegboard_stats_interval', 300,
+    'Seconds between logging the message and error counts of each board.',
+    lower_bound=1)
+
 STATUS_CONNECTING = 'connecting'
 STATUS_CONNECTED = 'connected'
 STATUS_NEED_UPDATE = 'need-update'
@@ -73,28 +89,63 @@ class KegboardKegnetClient(kegnet.KegnetClient):
 class KegboardManagerApp(app.App):
   def __init__(self, name='core'):
     app.App.__init__(self, name)
-    self.devices_by_path = {}
+    self.readers_by_path = {}
     self.status_by_path = {}
     self.name_by_path = {}
-    self.client = kegnet.KegnetClient()
+    if FLAGS.spool_path:
+      self.client = spool.SpoolingClient(spool.Spool(FLAGS.spool_path))
+    else:
+      self.client = kegnet.KegnetClient()
+    self.selector = selectors.DefaultSelector()
+    self.device_list = None
+    self.messages = queue.Queue()
+    self.wakeup = boards.Wakeup()
+    self.quarantine = boards.Quarantine()
+    self.last_stats_time = time.time()
 
   def _Setup(self):
     app.App._Setup(self)
+    if FLAGS.kegboard_device_path:
+      glob_paths = [FLAGS.kegboard_device_path]
+    else:
+      glob_paths = kegboard.DEFAULT_GLOB_PATHS
+    self.device_list = hotplug.DeviceList(glob_paths,
+        use_inotify=FLAGS.kegboard_hotplug,
+        rescan_interval=FLAGS.kegboard_rescan_interval)
+    watcher = self.device_list.GetWatcher()
+    if watcher:
+      self.selector.register(watcher, selectors.EVENT_READ)
+    self.selector.register(self.wakeup, selectors.EVENT_READ)
 
   def _MainLoop(self):
     self._logger.info('Main loop starting.')
     while not self._do_quit:
       self.update_devices()
-      if not self.service_devices():
-        time.sleep(0.1)
+      # Wake up at least once a second to notice quit requests, and more often
+      # while replaying spooled messages.
+      timeout = min(1.0, self.device_list.GetTimeout())
+      quarantine_timeout = self.quarantine.GetTimeout()
+      if quarantine_timeout is not None:
+        timeout = min(timeout, quarantine_timeout)
+      if FLAGS.spool_path:
+        self.client.Replay()
+        if self.client.GetSpooledCount():
+          timeout = min(0.1, timeout)
+      for key, mask in self.selector.select(timeout):
+        if key.fileobj is self.wakeup:
+          self.wakeup.Clear()
+        else:
+          self.device_list.HandleWatcherEvent()
+      self.publish_messages()
+      self.log_stats()
+    for path in list(self.readers_by_path):
+      self.remove_device(path)
 
   def update_devices(self):
-    if FLAGS.kegboard_device_path:
-      devices = kegboard.find_devices([FLAGS.kegboard_device_path])
-    else:
-      devices = kegboard.find_devices()
+    devices = self.device_list.GetDevices()
 
-    new_devices = [d for d in devices if d not in list(self.status_by_path.keys())]
+    new_devices = [d for d in devices if d not in self.status_by_path and
+        not self.quarantine.IsQuarantined(d)]
     for d in new_devices:
       self._logger.info('Device added: %s' % d)
       self.add_device(d)
@@ -105,30 +156,33 @@ class KegboardManagerApp(app.App):
       self.remove_device(d)
 
   def add_device(self, path):
+    """Starts a reader, which opens and services the device at `path`."""
     kb = kegboard.Kegboard(path)
-    try:
-      kb.open()
-    except OSError as e:
-      # TODO(mikey): Back off and eventually blacklist device.
-      self._logger.warning('Error opening device at path {}: {}'.format(path, e))
-      return
-
-    self.devices_by_path[path] = kb
+    reader = boards.BoardReader(kb, self.messages, wakeup=self.wakeup.Set)
+    self.readers_by_path[path] = reader
     self.status_by_path[path] = STATUS_CONNECTING
     self.name_by_path[path] = ''
-
-    try:
-      kb.ping()
-    except IOError:
-      self._logger.warning('Error pinging device')
-      remove_device(path)
+    reader.start()
 
   def remove_device(self, path):
-    device = self.devices_by_path.pop(path)
-    device.close_quietly()
+    reader = self.readers_by_path.pop(path)
+    reader.Quit()
+    reader.join(2 * boards.READER_POLL_SECONDS)
+    self._logger.info('Device %s stats: %s' % (path, reader.stats))
     del self.status_by_path[path]
     del self.name_by_path[path]
 
+  def fail_device(self, reader):
+    """Removes a device whose reader failed, and quarantines it."""
+    path = reader.board.device_path
+    self.remove_device(path)
+    delay = self.quarantine.RecordFailure(path, reader.stats.GetUptime())
+    failures = self.quarantine.GetFailures(path)
+    self._logger.warning('Device %s failed (%i consecutive failures); retrying '
+        'in %is.' % (path, failures, delay))
+    # The device may have gone away.
+    self.device_list.Invalidate()
+
   def get_status(self, path):
     return self.status_by_path.get(path, None)
 
@@ -136,17 +190,34 @@ class KegboardManagerApp(app.App):
     return self.name_by_path.get(path, 'unknown')
 
   def active_devices(self):
-    for k, v in self.devices_by_path.items():
+    for k, v in self.readers_by_path.items():
       if self.get_status(k) in (STATUS_CONNECTING, STATUS_CONNECTED):
-        yield v
-
-  def service_devices(self):
-    message_posted = False
-    for kb in self.active_devices():
-      for message in kb.drain_messages():
-        self.handle_message(kb, message)
-        message_posted = True
-    return message_posted
+        yield v.board
+
+  def publish_messages(self):
+    """Handles messages queued by readers, in the order they arrived."""
+    while True:
+      try:
+        reader, message = self.messages.get_nowait()
+      except queue.Empty:
+        return
+      path = reader.board.device_path
+      if self.readers_by_path.get(path) is not reader:
+        # Left over from a removed device.
+        continue
+      if message is None:
+        self.fail_device(reader)
+      elif self.get_status(path) in (STATUS_CONNECTING, STATUS_CONNECTED):
+        self.handle_message(reader.board, message)
+
+  def log_stats(self):
+    now = time.time()
+    if now - self.last_stats_time < FLAGS.kegboard_stats_interval:
+      return
+    self.last_stats_time = now
+    for path, reader in sorted(self.readers_by_path.items()):
+      self._logger.info('Device %s (%s) stats: %s' % (path,
+          self.get_name(path) or 'unnamed', reader.stats))
 
   def post_message(self, kb, message):
     self._logger.info('Posting message from %s: %s' % (kb, message))
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+from kegbot.pycore import startup
+startup.MaybeInstallImportTimer()
+
 from kegbot.pycore import kegbot_app
 
 __doc__ = kegbot_app.__doc__
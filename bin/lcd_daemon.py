@@ -15,6 +15,7 @@ import time
 
 from kegbot.api import kbapi
 from kegbot.pycore import kegnet
+from kegbot.pycore import state_table
 from kegbot.util import app
 from kegbot.util import units
 from kegbot.util import util
@@ -62,6 +63,10 @@ gflags.DEFINE_integer('rotation_time', 10,
     'Seconds to pause between rotated tap/drink info screens.',
     lower_bound=1)
 
+gflags.DEFINE_float('state_table_poll_interval', 0.1,
+    'Seconds between polls of the core\'s state table, if '
+    '--state_table_path is set.')
+
 gflags.DEFINE_integer('krest_update_interval', 60,
     'Time between periodic refreshes of tap and drink information '
     'by the Kegweb REST client.', lower_bound=10)
@@ -234,7 +239,11 @@ class LcdDaemonApp(app.App):
     app.App._Setup(self)
     kb_lcdui = KegUi()
     self._AddAppThread(LcdUiThread('kb-lcdui', kb_lcdui))
-    self._AddAppThread(KegnetMonitorThread('kegnet-monitor', kb_lcdui))
+    if FLAGS.state_table_path:
+      self._AddAppThread(StateTableMonitorThread('state-table-monitor',
+          kb_lcdui))
+    else:
+      self._AddAppThread(KegnetMonitorThread('kegnet-monitor', kb_lcdui))
     self._AddAppThread(KrestUpdaterThread('krest-updater', kb_lcdui))
 
 
@@ -299,5 +308,28 @@ class KegnetMonitorThread(util.KegbotThread):
     self._client.stop()
 
 
+class StateTableMonitorThread(util.KegbotThread):
+  """Follows flows in the core's state table (see --state_table_path)."""
+  def __init__(self, name, kb_lcdui):
+    util.KegbotThread.__init__(self, name)
+    self._kb_lcdui = kb_lcdui
+
+  def ThreadMain(self):
+    self._logger.info('Starting main loop.')
+    reader = None
+    while not self._quit:
+      if not reader:
+        try:
+          reader = state_table.StateTableReader(FLAGS.state_table_path)
+        except (IOError, state_table.StateTableError) as e:
+          self._logger.warning('Could not open state table: %s' % e)
+          time.sleep(5)
+          continue
+      for event in reader.GetFlowUpdates():
+        self._kb_lcdui.HandleFlowStatus(event)
+      time.sleep(FLAGS.state_table_poll_interval)
+    self._logger.info('Exited main loop.')
+
+
 if __name__ == '__main__':
   LcdDaemonApp.BuildAndRun()
@@ -1,11 +1,22 @@
 """Kegbot API implementation of Backend."""
 
 from builtins import object
+from concurrent import futures
 import logging
 import socket
+import threading
+
+import gflags
 
 from kegbot.api import kbapi
 from . import common_defs
+from . import transport
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('api_batch_parallelism', 4,
+    'Maximum number of web API requests made in parallel for a batch call.',
+    lower_bound=1)
 
 class BackendException(Exception):
   """Base exception type."""
@@ -15,7 +26,35 @@ class DoesNotExistException(BackendException):
   """Thrown when operating against a non-existing resource."""
 
 
+class BackendUnavailableException(BackendException):
+  """Thrown without contacting the backend, while it is known to be down."""
+
+
+class DrinkQueued(object):
+  """Result of a drink queued to be recorded later (see the offline module)."""
+
+
 class Backend(object):
+  """Interface to the Kegbot server.
+
+  The batch calls (RecordDrinks, LogSensorReadings, GetAuthTokens) return one
+  result per item, in order.  An item which failed with a BackendException or
+  kbapi.Error has that exception as its result, so that callers may handle or
+  retry items individually.
+  """
+
+  def _Map(self, fn, items):
+    """Returns [fn(item) for item in items].  Subclasses may parallelize."""
+    return [fn(item) for item in items]
+
+  def _MapCalls(self, fn, items):
+    """Like _Map, returning exceptions raised by `fn` as results."""
+    def Call(item):
+      try:
+        return fn(*item)
+      except (BackendException, kbapi.Error) as e:
+        return e
+    return self._Map(Call, items)
 
   def GetStatus(self):
     raise NotImplementedError
@@ -27,22 +66,100 @@ class Backend(object):
       pour_time=None, duration=0, auth_token=None, spilled=False, shout=''):
     raise NotImplementedError
 
+  def RecordDrinks(self, drinks):
+    """Records several drinks in one call.
+
+    `drinks` is a sequence of dicts of RecordDrink arguments, with the meter
+    name under 'meter_name', and optionally the core's flow id under
+    'flow_id'.
+    """
+    def Record(drink):
+      drink = dict(drink)
+      meter_name = drink.pop('meter_name')
+      drink.pop('flow_id', None)
+      return self.RecordDrink(meter_name, **drink)
+    return self._MapCalls(Record, [(drink,) for drink in drinks])
+
+  def SetDrinkRecordedCallback(self, callback):
+    """Sets the function called once a queued drink has been recorded.
+
+    Backends which queue drinks (returning DrinkQueued from RecordDrinks) call
+    `callback(drink, result)` with the RecordDrinks item and its result.
+    """
+
   def CancelDrink(self, drink_id, spilled=False):
     raise NotImplementedError
 
   def LogSensorReading(self, sensor_name, temperature, when=None):
     raise NotImplementedError
 
+  def LogSensorReadings(self, readings):
+    """Records several sensor readings in one call.
+
+    `readings` is a sequence of (sensor_name, temperature, when) tuples.
+    Readings rejected with ValueError have a result of None.  There is no bulk
+    endpoint, so each reading is still a separate LogSensorReading.
+    """
+    def Log(sensor_name, temperature, when):
+      try:
+        return self.LogSensorReading(sensor_name, temperature, when)
+      except ValueError:
+        return None
+    return self._MapCalls(Log, readings)
+
   def GetAuthToken(self, auth_device, token_value):
     raise NotImplementedError
 
+  def GetAuthTokens(self, tokens):
+    """Looks up several auth tokens in one call.
+
+    `tokens` is a sequence of (auth_device, token_value) tuples.
+    """
+    return self._MapCalls(self.GetAuthToken, tokens)
+
   def CreateController(self, controller_name):
     raise NotImplementedError
 
+  def GetLatencyStats(self):
+    """Returns a dict of call type to latency stats, if tracked."""
+    return {}
+
 class WebBackend(Backend):
+  """Backend using the Kegbot web API.
+
+  The API has no bulk endpoints, so batch calls are made as parallel single
+  calls, at most --api_batch_parallelism at a time.
+  """
   def __init__(self, api_url=None, api_key=None):
     self._logger = logging.getLogger('api-backend')
-    self._client = kbapi.Client(api_url=api_url, api_key=api_key)
+    self._api_url = api_url
+    self._api_key = api_key
+    self._client_obj = None
+    self._executor = None
+    self._lock = threading.Lock()
+
+  @property
+  def _client(self):
+    # Connections are set up on first use, keeping them off the startup path.
+    if self._client_obj is None:
+      with self._lock:
+        if self._client_obj is None:
+          self._client_obj = transport.PooledClient(api_url=self._api_url,
+              api_key=self._api_key)
+    return self._client_obj
+
+  def _Map(self, fn, items):
+    items = list(items)
+    if len(items) <= 1:
+      return [fn(item) for item in items]
+    with self._lock:
+      if not self._executor:
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=FLAGS.api_batch_parallelism)
+    return list(self._executor.map(fn, items))
+
+  def GetLatencyStats(self):
+    return self._client.GetLatencyStats()
 
   def GetStatus(self):
     return self._client.status()
@@ -80,11 +197,10 @@ class WebBackend(Backend):
     except kbapi.NotFoundError:
       self._logger.warning('No sensor on backend named "%s"' % (sensor_name,))
       return None
-    except kbapi.ServerError:
-      self._logger.warning('Server error recording temperature; dropping reading.')
-      return None
-    except socket.error:
-      self._logger.warning('Socket error recording temperature; dropping reading.')
+    except (kbapi.ServerError, kbapi.RequestError, socket.error) as e:
+      raise BackendException('Error recording temperature: %s' % e)
+    except kbapi.Error as e:
+      self._logger.warning('Error recording temperature; dropping reading: %s' % e)
       return None
 
   def GetAuthToken(self, auth_device, token_value):
@@ -92,9 +208,8 @@ class WebBackend(Backend):
       return self._client.get_token(auth_device, token_value)
     except kbapi.NotFoundError:
       raise
-    except socket.error:
-      self._logger.warning('Socket error fetching token; ignoring.')
-      raise kbapi.NotFoundError()
+    except (kbapi.RequestError, socket.error) as e:
+      raise BackendException('Error fetching token: %s' % e)
 
   def CreateController(self, controller_name):
     try:
@@ -0,0 +1,61 @@
+"""Unittest for backend module"""
+
+import threading
+import unittest
+
+from kegbot.api import kbapi
+from . import backend
+from .util import AttrDict
+
+class FakeBackend(backend.Backend):
+  def RecordDrink(self, meter_name, ticks, **kwargs):
+    if meter_name == 'unknown':
+      raise backend.DoesNotExistException(meter_name)
+    return AttrDict({'meter_name': meter_name, 'ticks': ticks,
+        'username': kwargs.get('username')})
+
+  def GetAuthToken(self, auth_device, token_value):
+    if token_value != 'aa':
+      raise kbapi.NotFoundError()
+    return AttrDict({'username': 'guest'})
+
+  def LogSensorReading(self, sensor_name, temperature, when=None):
+    if temperature > 100:
+      raise ValueError('Temperature out of bounds')
+    return sensor_name
+
+
+class BatchTestCase(unittest.TestCase):
+  def setUp(self):
+    self.backend = FakeBackend()
+
+  def testRecordDrinks(self):
+    results = self.backend.RecordDrinks([
+      {'meter_name': 'flow0', 'ticks': 100, 'username': 'guest'},
+      {'meter_name': 'unknown', 'ticks': 200},
+    ])
+    self.assertEqual(2, len(results))
+    self.assertEqual('guest', results[0].username)
+    self.assertIsInstance(results[1], backend.DoesNotExistException)
+
+  def testGetAuthTokens(self):
+    results = self.backend.GetAuthTokens([('core.rfid', 'aa'),
+        ('core.rfid', 'bb')])
+    self.assertEqual('guest', results[0].username)
+    self.assertIsInstance(results[1], kbapi.NotFoundError)
+
+  def testLogSensorReadings(self):
+    results = self.backend.LogSensorReadings([('thermo-1', 4.0, None),
+        ('thermo-2', 400.0, None)])
+    self.assertEqual(['thermo-1', None], results)
+
+
+class WebBackendTestCase(unittest.TestCase):
+  def testParallelMap(self):
+    web_backend = backend.WebBackend(api_url='http://localhost/api/')
+    barrier = threading.Barrier(2, timeout=5)
+    results = web_backend._Map(lambda item: (barrier.wait(), item)[1], [1, 2])
+    self.assertEqual([1, 2], results)
+
+if __name__ == '__main__':
+  unittest.main()
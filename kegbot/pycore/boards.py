@@ -0,0 +1,196 @@
+"""Per-board I/O for controller daemons.
+
+Each board is serviced by its own BoardReader thread, so that a slow or
+misbehaving board (a failed ping, a partial frame) cannot delay readings from
+the others.  Readers put (reader, message) pairs on a shared queue, which a
+single publisher consumes in order; a reader which fails puts (reader, None)
+and exits.  Readers do no more than I/O: all other state belongs to the
+publisher.
+
+Quarantine tracks boards which fail repeatedly, and keeps them from being
+reopened for an exponentially increasing time.
+"""
+
+from builtins import object
+import os
+import select
+import time
+
+from kegbot.util import util
+
+# Seconds for which a board is quarantined after its first failure; doubled
+# for each further failure, up to QUARANTINE_MAX_SECONDS.
+QUARANTINE_BASE_SECONDS = 1
+QUARANTINE_MAX_SECONDS = 300
+
+# A board which fails after being open for at least this long is not
+# considered to be flapping, and starts over at QUARANTINE_BASE_SECONDS.
+QUARANTINE_STABLE_SECONDS = 60
+
+# Maximum seconds a reader blocks before checking whether it should quit.
+READER_POLL_SECONDS = 0.5
+
+
+class Wakeup(object):
+  """A file descriptor which can be made readable from any thread.
+
+  Used to wake up a selector when a reader has queued messages.
+  """
+  def __init__(self):
+    self._read_fd, self._write_fd = os.pipe()
+    os.set_blocking(self._read_fd, False)
+    os.set_blocking(self._write_fd, False)
+
+  def fileno(self):
+    return self._read_fd
+
+  def Set(self):
+    try:
+      os.write(self._write_fd, b'\0')
+    except BlockingIOError:
+      # Already readable.
+      pass
+
+  def Clear(self):
+    try:
+      while os.read(self._read_fd, 4096):
+        pass
+    except BlockingIOError:
+      pass
+
+  def close(self):
+    os.close(self._read_fd)
+    os.close(self._write_fd)
+
+
+class BoardStats(object):
+  """Throughput and error counts of a board."""
+  def __init__(self, clock=time.time):
+    self._clock = clock
+    self.open_time = None
+    self.messages = 0
+    self.errors = 0
+    self.last_message_time = None
+
+  def RecordOpen(self):
+    self.open_time = self._clock()
+
+  def RecordMessage(self):
+    self.messages += 1
+    self.last_message_time = self._clock()
+
+  def RecordError(self):
+    self.errors += 1
+
+  def GetUptime(self):
+    if self.open_time is None:
+      return 0
+    return self._clock() - self.open_time
+
+  def GetMessageRate(self):
+    """Returns messages per second since the board was opened."""
+    uptime = self.GetUptime()
+    if not uptime:
+      return 0.0
+    return self.messages / uptime
+
+  def __str__(self):
+    return 'uptime=%is messages=%i (%.2f/s) errors=%i' % (self.GetUptime(),
+        self.messages, self.GetMessageRate(), self.errors)
+
+
+class BoardReader(util.KegbotThread):
+  """Opens a board, then reads messages from it until stopped or it fails.
+
+  `board` must provide device_path, fd, open(), ping(), drain_messages() and
+  close_quietly(), as kegboard.Kegboard does.  Messages are put on `out_queue`
+  as (reader, message), followed by (reader, None) if the board fails, and
+  `wakeup` (if given) is called after each put.
+  """
+  def __init__(self, board, out_queue, wakeup=None, clock=time.time):
+    super(BoardReader, self).__init__('reader-%s' % board.device_path)
+    self.board = board
+    self.stats = BoardStats(clock)
+    self._queue = out_queue
+    self._wakeup = wakeup
+    self.error = None
+
+  def _Put(self, message):
+    self._queue.put((self, message))
+    if self._wakeup:
+      self._wakeup()
+
+  def ThreadMain(self):
+    try:
+      self.board.open()
+      self.stats.RecordOpen()
+      self.board.ping()
+      while not self._quit:
+        readable, _, _ = select.select([self.board.fd], [], [],
+            READER_POLL_SECONDS)
+        if not readable:
+          continue
+        messages = self.board.drain_messages()
+        for message in messages:
+          self.stats.RecordMessage()
+          self._Put(message)
+        if not messages:
+          # Partial frame, or a plain file at EOF; don't spin.
+          time.sleep(0.01)
+    except Exception as e:
+      if not self._quit:
+        self.error = e
+        self.stats.RecordError()
+        self._logger.warning('Error on %s: %s' % (self.board.device_path, e))
+        self._Put(None)
+    finally:
+      self.board.close_quietly()
+
+
+class Quarantine(object):
+  """Backs off reopening boards which keep failing."""
+  def __init__(self, base_seconds=QUARANTINE_BASE_SECONDS,
+      max_seconds=QUARANTINE_MAX_SECONDS,
+      stable_seconds=QUARANTINE_STABLE_SECONDS, clock=time.time):
+    self._base_seconds = base_seconds
+    self._max_seconds = max_seconds
+    self._stable_seconds = stable_seconds
+    self._clock = clock
+    self._failures = {}  # path to consecutive failure count
+    self._until = {}  # path to end of quarantine
+
+  def RecordFailure(self, path, uptime=0):
+    """Records that the board at `path` failed after `uptime` seconds open.
+
+    Returns the number of seconds it is quarantined for.
+    """
+    if uptime >= self._stable_seconds:
+      failures = 1
+    else:
+      failures = self._failures.get(path, 0) + 1
+    self._failures[path] = failures
+    delay = min(self._max_seconds, self._base_seconds * 2 ** (failures - 1))
+    self._until[path] = self._clock() + delay
+    return delay
+
+  def GetFailures(self, path):
+    return self._failures.get(path, 0)
+
+  def IsQuarantined(self, path):
+    until = self._until.get(path)
+    if until is None:
+      return False
+    if self._clock() >= until:
+      del self._until[path]
+      return False
+    return True
+
+  def GetTimeout(self):
+    """Returns seconds until the next quarantine ends, or None."""
+    now = self._clock()
+    for path, until in list(self._until.items()):
+      if until <= now:
+        del self._until[path]
+    if not self._until:
+      return None
+    return min(self._until.values()) - now
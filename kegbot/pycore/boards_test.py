@@ -0,0 +1,121 @@
+"""Unittest for boards module"""
+
+import os
+import queue
+import select
+import unittest
+
+from . import boards
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class FakeBoard(object):
+  """Board whose messages are lines written to a pipe."""
+  def __init__(self, fail_open=False):
+    self.device_path = '/dev/fake0'
+    self.fail_open = fail_open
+    read_fd, self.write_fd = os.pipe()
+    self.fd = os.fdopen(read_fd, 'rb', buffering=0)
+    self.pinged = False
+    self.closed = False
+
+  def open(self):
+    if self.fail_open:
+      raise OSError('no such device')
+
+  def ping(self):
+    self.pinged = True
+
+  def drain_messages(self):
+    data = self.fd.read(4096)
+    if not data:
+      raise IOError('device went away')
+    return data.decode('utf-8').split()
+
+  def close_quietly(self):
+    self.closed = True
+
+class BoardReaderTestCase(unittest.TestCase):
+  def _Get(self, out_queue):
+    return out_queue.get(timeout=5)
+
+  def testReadsUntilFailure(self):
+    board = FakeBoard()
+    out_queue = queue.Queue()
+    wakeup = boards.Wakeup()
+    reader = boards.BoardReader(board, out_queue, wakeup=wakeup.Set)
+    reader.start()
+
+    os.write(board.write_fd, b'hello meter\n')
+    self.assertEqual((reader, 'hello'), self._Get(out_queue))
+    self.assertEqual((reader, 'meter'), self._Get(out_queue))
+    self.assertTrue(select.select([wakeup], [], [], 0)[0])
+    wakeup.Clear()
+    self.assertFalse(select.select([wakeup], [], [], 0)[0])
+
+    os.close(board.write_fd)
+    self.assertEqual((reader, None), self._Get(out_queue))
+    reader.join(5)
+    self.assertTrue(board.pinged)
+    self.assertTrue(board.closed)
+    self.assertIsInstance(reader.error, IOError)
+    self.assertEqual(2, reader.stats.messages)
+    self.assertEqual(1, reader.stats.errors)
+    wakeup.close()
+
+  def testOpenFailure(self):
+    board = FakeBoard(fail_open=True)
+    out_queue = queue.Queue()
+    reader = boards.BoardReader(board, out_queue)
+    reader.start()
+    self.assertEqual((reader, None), self._Get(out_queue))
+    self.assertEqual(0, reader.stats.GetUptime())
+    os.close(board.write_fd)
+
+  def testQuit(self):
+    board = FakeBoard()
+    out_queue = queue.Queue()
+    reader = boards.BoardReader(board, out_queue)
+    reader.start()
+    reader.Quit()
+    reader.join(5)
+    self.assertFalse(reader.is_alive())
+    self.assertTrue(board.closed)
+    self.assertTrue(out_queue.empty())
+    os.close(board.write_fd)
+
+class QuarantineTestCase(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.quarantine = boards.Quarantine(base_seconds=1, max_seconds=8,
+        stable_seconds=60, clock=self.clock)
+
+  def testBackoff(self):
+    path = '/dev/ttyACM0'
+    self.assertFalse(self.quarantine.IsQuarantined(path))
+    self.assertIsNone(self.quarantine.GetTimeout())
+
+    delays = [self.quarantine.RecordFailure(path) for i in range(5)]
+    self.assertEqual([1, 2, 4, 8, 8], delays)
+    self.assertTrue(self.quarantine.IsQuarantined(path))
+    self.assertEqual(8, self.quarantine.GetTimeout())
+
+    self.clock.now += 8
+    self.assertFalse(self.quarantine.IsQuarantined(path))
+    self.assertIsNone(self.quarantine.GetTimeout())
+
+  def testStableDeviceStartsOver(self):
+    path = '/dev/ttyACM0'
+    self.quarantine.RecordFailure(path)
+    self.quarantine.RecordFailure(path, uptime=5)
+    self.assertEqual(2, self.quarantine.GetFailures(path))
+    self.assertEqual(1, self.quarantine.RecordFailure(path, uptime=120))
+    self.assertEqual(1, self.quarantine.GetFailures(path))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,233 @@
+"""Circuit breaker for Backend calls.
+
+When the web backend is down, each call would otherwise wait out a full
+timeout, stalling whichever thread made it.  CircuitBreakerBackend counts
+consecutive failed calls; after --backend_failure_threshold of them the circuit
+opens and calls fail immediately with BackendUnavailableException.  After
+--backend_open_seconds, up to --backend_half_open_probes calls are let through
+as probes: a successful probe closes the circuit, a failed one opens it again.
+A call which fails before reaching the backend, such as on a local ValueError,
+counts as neither.
+"""
+
+from builtins import object
+import logging
+import socket
+import threading
+import time
+
+import gflags
+
+from kegbot.api import kbapi
+from . import backend
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('backend_failure_threshold', 5,
+    'Number of consecutive failed backend calls after which calls fail '
+    'immediately. Set to 0 to disable the circuit breaker.',
+    lower_bound=0)
+
+gflags.DEFINE_integer('backend_open_seconds', 30,
+    'Seconds to fail backend calls immediately before probing the backend '
+    'again.',
+    lower_bound=1)
+
+gflags.DEFINE_integer('backend_half_open_probes', 1,
+    'Maximum number of concurrent probe calls while the backend is '
+    'recovering.',
+    lower_bound=1)
+
+# Errors which indicate the backend itself is unwell.  Other errors, such as
+# NotFoundError or DoesNotExistException, are valid answers.
+FAILURE_EXCEPTIONS = (kbapi.RequestError, kbapi.ServerError, socket.error,
+    IOError)
+
+# Batch calls, which return per-item exceptions (see backend.Backend).
+BATCH_METHODS = ('RecordDrinks', 'LogSensorReadings', 'GetAuthTokens')
+
+
+def IsFailure(e):
+  """Returns True if exception `e` counts against the backend.
+
+  A BackendException raised while handling another exception (as WebBackend
+  does with API errors) is judged by that original exception.
+  """
+  if isinstance(e, backend.DoesNotExistException):
+    return False
+  if isinstance(e, backend.BackendException) and e.__context__ is not None:
+    return isinstance(e.__context__, FAILURE_EXCEPTIONS)
+  return isinstance(e, FAILURE_EXCEPTIONS + (backend.BackendException,))
+
+
+def IsAnswer(e):
+  """Returns True if exception `e` is an answer from the backend.
+
+  NotFoundError and the other API errors, and BackendExceptions raised while
+  handling them, show that the backend was reached.  Other exceptions, such
+  as a ValueError raised before any request is made, do not.
+  """
+  while e is not None:
+    if isinstance(e, (kbapi.Error, backend.DoesNotExistException)):
+      return True
+    e = e.__context__
+  return False
+
+
+class CircuitBreaker(object):
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half-open'
+
+  def __init__(self, failure_threshold, open_seconds, half_open_probes=1,
+      clock=time.time):
+    self._failure_threshold = failure_threshold
+    self._open_seconds = open_seconds
+    self._half_open_probes = half_open_probes
+    self._clock = clock
+    self._logger = logging.getLogger('circuit-breaker')
+    self._lock = threading.Lock()
+    self._state = self.CLOSED
+    self._failures = 0
+    self._opened_time = None
+    self._probes = 0
+
+  def GetState(self):
+    with self._lock:
+      if self._state == self.OPEN and self._CanProbe():
+        return self.HALF_OPEN
+      return self._state
+
+  def _CanProbe(self):
+    return self._clock() - self._opened_time >= self._open_seconds
+
+  def _Open(self):
+    self._state = self.OPEN
+    self._opened_time = self._clock()
+    self._probes = 0
+
+  def Acquire(self):
+    """Returns True if a call may be made now.
+
+    Every successful Acquire must be followed by Succeeded, Failed or
+    Released.
+    """
+    with self._lock:
+      if self._state == self.CLOSED:
+        return True
+      if self._state == self.OPEN:
+        if not self._CanProbe():
+          return False
+        self._logger.info('Probing backend.')
+        self._state = self.HALF_OPEN
+      if self._probes >= self._half_open_probes:
+        return False
+      self._probes += 1
+      return True
+
+  def Succeeded(self):
+    with self._lock:
+      if self._state != self.CLOSED:
+        self._logger.info('Backend recovered; closing circuit.')
+      self._state = self.CLOSED
+      self._failures = 0
+      self._probes = 0
+
+  def Released(self):
+    """Ends a call which did not reach the backend, keeping the state."""
+    with self._lock:
+      if self._state == self.HALF_OPEN and self._probes:
+        self._probes -= 1
+
+  def Failed(self):
+    with self._lock:
+      if self._state == self.HALF_OPEN:
+        self._logger.warning('Backend probe failed; reopening circuit.')
+        self._Open()
+        return
+      self._failures += 1
+      if self._state == self.CLOSED and \
+          self._failures >= self._failure_threshold:
+        self._logger.warning('%d consecutive backend failures; opening '
+            'circuit for %d seconds.' % (self._failures, self._open_seconds))
+        self._Open()
+
+
+class CircuitBreakerBackend(backend.Backend):
+  """Backend which fails fast while `delegate` is failing."""
+  def __init__(self, delegate, breaker=None):
+    self._delegate = delegate
+    if breaker is None:
+      breaker = CircuitBreaker(FLAGS.backend_failure_threshold,
+          FLAGS.backend_open_seconds, FLAGS.backend_half_open_probes)
+    self._breaker = breaker
+
+  def GetCircuitState(self):
+    return self._breaker.GetState()
+
+  def _Call(self, method, *args, **kwargs):
+    if not self._breaker.Acquire():
+      raise backend.BackendUnavailableException(
+          'Backend unavailable; not calling %s' % method)
+    try:
+      result = getattr(self._delegate, method)(*args, **kwargs)
+    except Exception as e:
+      if IsFailure(e):
+        self._breaker.Failed()
+      elif IsAnswer(e):
+        self._breaker.Succeeded()
+      else:
+        self._breaker.Released()
+      raise
+    if method not in BATCH_METHODS:
+      self._breaker.Succeeded()
+      return result
+    errors = [r for r in result if isinstance(r, Exception)]
+    if any(IsFailure(r) for r in errors):
+      self._breaker.Failed()
+    elif result and len(errors) == len(result) and \
+        not any(IsAnswer(r) for r in errors):
+      self._breaker.Released()
+    else:
+      self._breaker.Succeeded()
+    return result
+
+  def GetStatus(self):
+    return self._Call('GetStatus')
+
+  def GetAllTaps(self):
+    return self._Call('GetAllTaps')
+
+  def RecordDrink(self, *args, **kwargs):
+    return self._Call('RecordDrink', *args, **kwargs)
+
+  def RecordDrinks(self, drinks):
+    return self._Call('RecordDrinks', drinks)
+
+  def CancelDrink(self, *args, **kwargs):
+    return self._Call('CancelDrink', *args, **kwargs)
+
+  def LogSensorReading(self, *args, **kwargs):
+    return self._Call('LogSensorReading', *args, **kwargs)
+
+  def LogSensorReadings(self, readings):
+    return self._Call('LogSensorReadings', readings)
+
+  def GetAuthToken(self, *args, **kwargs):
+    return self._Call('GetAuthToken', *args, **kwargs)
+
+  def GetAuthTokens(self, tokens):
+    return self._Call('GetAuthTokens', tokens)
+
+  def CreateController(self, *args, **kwargs):
+    return self._Call('CreateController', *args, **kwargs)
+
+  def GetLatencyStats(self):
+    return self._delegate.GetLatencyStats()
+
+
+def WithCircuitBreaker(backend_obj):
+  """Wraps `backend_obj` in a CircuitBreakerBackend, if enabled by flags."""
+  if not FLAGS.backend_failure_threshold:
+    return backend_obj
+  return CircuitBreakerBackend(backend_obj)
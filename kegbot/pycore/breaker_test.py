@@ -0,0 +1,139 @@
+"""Unittest for breaker module"""
+
+import unittest
+
+from kegbot.api import kbapi
+from . import backend
+from . import breaker
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+class FlakyBackend(backend.Backend):
+  def __init__(self):
+    self.calls = 0
+    self.error = None
+
+  def GetStatus(self):
+    self.calls += 1
+    if self.error:
+      raise self.error
+    return {'ok': True}
+
+  def GetAuthTokens(self, tokens):
+    self.calls += 1
+    return [self.error or {'username': 'guest'} for token in tokens]
+
+  def CreateController(self, controller_name):
+    self.calls += 1
+    try:
+      raise kbapi.BadRequestError('Controller exists')
+    except kbapi.Error as e:
+      raise backend.BackendException(e)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.breaker = breaker.CircuitBreaker(3, 30, half_open_probes=1,
+        clock=self.clock)
+    self.delegate = FlakyBackend()
+    self.backend = breaker.CircuitBreakerBackend(self.delegate, self.breaker)
+
+  def _FailCalls(self, count):
+    for i in range(count):
+      self.assertRaises(kbapi.RequestError, self.backend.GetStatus)
+
+  def testOpensAfterConsecutiveFailures(self):
+    self.delegate.error = kbapi.RequestError('timed out')
+    self._FailCalls(2)
+    self.assertEqual(breaker.CircuitBreaker.CLOSED, self.breaker.GetState())
+    self._FailCalls(1)
+    self.assertEqual(breaker.CircuitBreaker.OPEN, self.breaker.GetState())
+
+    # Calls now fail without reaching the delegate.
+    self.assertRaises(backend.BackendUnavailableException,
+        self.backend.GetStatus)
+    self.assertEqual(3, self.delegate.calls)
+
+  def testSuccessResetsFailures(self):
+    self.delegate.error = kbapi.RequestError('timed out')
+    self._FailCalls(2)
+    self.delegate.error = None
+    self.backend.GetStatus()
+    self.delegate.error = kbapi.RequestError('timed out')
+    self._FailCalls(2)
+    self.assertEqual(breaker.CircuitBreaker.CLOSED, self.breaker.GetState())
+
+  def testHalfOpenProbe(self):
+    self.delegate.error = kbapi.RequestError('timed out')
+    self._FailCalls(3)
+    self.clock.now = 30
+    self.assertEqual(breaker.CircuitBreaker.HALF_OPEN, self.breaker.GetState())
+
+    # A failed probe reopens the circuit.
+    self._FailCalls(1)
+    self.assertEqual(breaker.CircuitBreaker.OPEN, self.breaker.GetState())
+    self.assertRaises(backend.BackendUnavailableException,
+        self.backend.GetStatus)
+
+    # A successful probe closes it.
+    self.clock.now = 60
+    self.delegate.error = None
+    self.assertEqual({'ok': True}, self.backend.GetStatus())
+    self.assertEqual(breaker.CircuitBreaker.CLOSED, self.breaker.GetState())
+
+  def testProbeLimit(self):
+    self.breaker.Failed()
+    self.breaker.Failed()
+    self.breaker.Failed()
+    self.clock.now = 30
+    self.assertTrue(self.breaker.Acquire())
+    self.assertFalse(self.breaker.Acquire())
+
+  def testAnswersAreNotFailures(self):
+    for i in range(5):
+      self.assertRaises(backend.BackendException,
+          self.backend.CreateController, 'kegboard')
+    self.delegate.error = kbapi.NotFoundError()
+    for i in range(5):
+      self.assertRaises(kbapi.NotFoundError, self.backend.GetStatus)
+    self.assertEqual(breaker.CircuitBreaker.CLOSED, self.breaker.GetState())
+
+  def testLocalErrorsDoNotCloseCircuit(self):
+    self.delegate.error = kbapi.RequestError('timed out')
+    self._FailCalls(3)
+    self.clock.now = 30
+
+    # A probe failing before reaching the backend leaves the circuit
+    # half-open, and frees its permit for another probe.
+    self.delegate.error = ValueError('Temperature out of bounds')
+    self.assertRaises(ValueError, self.backend.GetStatus)
+    self.assertEqual(breaker.CircuitBreaker.HALF_OPEN, self.breaker.GetState())
+    results = self.backend.GetAuthTokens([('core.rfid', 'aa')])
+    self.assertIsInstance(results[0], ValueError)
+    self.assertEqual(breaker.CircuitBreaker.HALF_OPEN, self.breaker.GetState())
+
+    self.delegate.error = None
+    self.backend.GetStatus()
+    self.assertEqual(breaker.CircuitBreaker.CLOSED, self.breaker.GetState())
+
+  def testBatchFailures(self):
+    self.delegate.error = kbapi.RequestError('timed out')
+    for i in range(3):
+      results = self.backend.GetAuthTokens([('core.rfid', 'aa')])
+      self.assertIsInstance(results[0], kbapi.RequestError)
+    self.assertEqual(breaker.CircuitBreaker.OPEN, self.breaker.GetState())
+
+    self.clock.now = 30
+    self.delegate.error = kbapi.NotFoundError()
+    self.backend.GetAuthTokens([('core.rfid', 'aa')])
+    self.assertEqual(breaker.CircuitBreaker.CLOSED, self.breaker.GetState())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,67 @@
+"""Sources of the current time for the core.
+
+Code which needs the time takes a clock, defaulting to SYSTEM_CLOCK, rather
+than calling time.time(), datetime.datetime.now() or time.sleep() directly.
+Calling a clock returns the current time in seconds since the epoch, so a
+clock can also be passed wherever a `clock=time.time` callable is expected.
+
+A SimulatedClock only moves when advanced, so a test or simulation (see the
+simulation module) controls the passing of time, and can run hours of it in
+moments.
+"""
+
+from builtins import object
+import datetime
+import threading
+import time
+
+
+class SystemClock(object):
+  """The real time."""
+
+  def __call__(self):
+    return time.time()
+
+  def Now(self):
+    """Returns the current local time as a naive datetime."""
+    return datetime.datetime.now()
+
+  def Sleep(self, seconds):
+    time.sleep(seconds)
+
+
+class SimulatedClock(SystemClock):
+  """A clock which moves only when advanced.
+
+  Sleep() blocks until another thread advances the clock past the end of the
+  sleep.
+  """
+  def __init__(self, start=None):
+    if start is None:
+      start = time.time()
+    self._now = float(start)
+    self._changed = threading.Condition()
+
+  def __call__(self):
+    with self._changed:
+      return self._now
+
+  def Now(self):
+    return datetime.datetime.fromtimestamp(self())
+
+  def Sleep(self, seconds):
+    with self._changed:
+      until = self._now + seconds
+      while self._now < until:
+        self._changed.wait()
+
+  def Advance(self, seconds):
+    """Moves the clock forward by `seconds`, waking any sleepers due."""
+    if seconds < 0:
+      raise ValueError('Cannot move a clock backwards')
+    with self._changed:
+      self._now += seconds
+      self._changed.notify_all()
+
+
+SYSTEM_CLOCK = SystemClock()
@@ -0,0 +1,226 @@
+"""Cluster mode: several cores sharing the kegnet bus.
+
+When enabled with --cluster_node_id, each core holds a lease on its membership
+of the cluster, renewed every second and expiring after
+--cluster_lease_seconds.  Controllers are assigned to the live members by
+consistent hashing, so every core computes the same assignment, and when a
+member joins or its lease expires, only the controllers it gains or loses
+move.  Each core handles only events for the controllers it owns (see the
+partition module).
+
+A core which cannot renew its lease for --cluster_lease_seconds stops owning
+any controller, since the other members will have taken them over.
+
+Leases are kept in Redis (RedisLeaseStore), and expired by the Redis server.
+LocalLeaseStore keeps them in memory, for tests and single-host setups.
+
+Every member must see every event, so with --kegnet_transport=streams, each
+reads the kegnet stream in its own consumer group (see
+kegbot_app.CoreConsumerGroup).  Cluster mode cannot be combined with
+--replication_role.
+"""
+
+from builtins import object
+import bisect
+import logging
+import threading
+import time
+import zlib
+
+import gflags
+
+from . import kegnet
+from . import partition
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string('cluster_node_id', '',
+    'If set, this core joins a cluster of cores under this unique name, and '
+    'handles only the controllers assigned to it.')
+
+gflags.DEFINE_integer('cluster_lease_seconds', 5,
+    'Seconds after which a cluster member which stops renewing its lease is '
+    'considered failed, and its controllers are handed to other members.',
+    lower_bound=2)
+
+gflags.DEFINE_string('cluster_redis_key', 'kegbot:cluster',
+    'Prefix of the Redis keys of the cluster membership leases.')
+
+# Number of points on the hash ring per member.
+RING_REPLICAS = 64
+
+
+def _Hash(value):
+  return zlib.crc32(value.encode('utf-8'))
+
+
+class HashRing(object):
+  """Consistent hash ring of node names."""
+  def __init__(self, nodes, replicas=RING_REPLICAS):
+    self._nodes = frozenset(nodes)
+    points = []
+    for node in self._nodes:
+      for i in range(replicas):
+        points.append((_Hash('%s#%d' % (node, i)), node))
+    points.sort()
+    self._hashes = [h for h, node in points]
+    self._points = [node for h, node in points]
+
+  def GetNodes(self):
+    return self._nodes
+
+  def GetNode(self, key):
+    """Returns the node owning `key`, or None if the ring is empty."""
+    if not self._points:
+      return None
+    index = bisect.bisect(self._hashes, _Hash(key)) % len(self._points)
+    return self._points[index]
+
+
+class LeaseStore(object):
+  """Stores membership leases."""
+
+  def Renew(self, node_id, lease_seconds):
+    """Extends the lease of `node_id` for `lease_seconds`."""
+    raise NotImplementedError
+
+  def Release(self, node_id):
+    """Ends the lease of `node_id`."""
+    raise NotImplementedError
+
+  def GetLiveNodes(self):
+    """Returns the ids of nodes holding an unexpired lease."""
+    raise NotImplementedError
+
+
+class LocalLeaseStore(LeaseStore):
+  """Leases kept in memory, shared by the members of one process."""
+  def __init__(self, clock=time.time):
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._expiry = {}
+
+  def Renew(self, node_id, lease_seconds):
+    with self._lock:
+      self._expiry[node_id] = self._clock() + lease_seconds
+
+  def Release(self, node_id):
+    with self._lock:
+      self._expiry.pop(node_id, None)
+
+  def GetLiveNodes(self):
+    now = self._clock()
+    with self._lock:
+      return set(n for n, expiry in self._expiry.items() if expiry > now)
+
+
+class RedisLeaseStore(LeaseStore):
+  """Leases kept in Redis, one key per node, expiring after the lease.
+
+  Leases are expired by the Redis server, so the clocks of the nodes need not
+  agree.  The ids of the nodes are kept in a set, from which a node is removed
+  only when it releases its lease: pruning the nodes whose lease expired
+  would race with their renewal.
+  """
+  def __init__(self, redis_client, key=None):
+    self._redis = redis_client
+    key = key or FLAGS.cluster_redis_key
+    self._nodes_key = '%s:nodes' % key
+    self._lease_key_prefix = '%s:lease:' % key
+
+  def _LeaseKey(self, node_id):
+    return self._lease_key_prefix + node_id
+
+  def Renew(self, node_id, lease_seconds):
+    pipe = self._redis.pipeline()
+    pipe.set(self._LeaseKey(node_id), 1, px=int(lease_seconds * 1000))
+    pipe.sadd(self._nodes_key, node_id)
+    pipe.execute()
+
+  def Release(self, node_id):
+    pipe = self._redis.pipeline()
+    pipe.srem(self._nodes_key, node_id)
+    pipe.delete(self._LeaseKey(node_id))
+    pipe.execute()
+
+  def GetLiveNodes(self):
+    nodes = [n.decode('utf-8') if isinstance(n, bytes) else n
+        for n in self._redis.smembers(self._nodes_key)]
+    pipe = self._redis.pipeline()
+    for node in nodes:
+      pipe.exists(self._LeaseKey(node))
+    return set(node for node, live in zip(nodes, pipe.execute()) if live)
+
+
+class ClusterOwnership(partition.Ownership):
+  """Ownership of the controllers assigned to `node_id` by the hash ring.
+
+  Refresh() must be called regularly, more often than `lease_seconds`, to
+  renew the lease and follow changes in membership.
+  """
+  def __init__(self, node_id, lease_store, lease_seconds=None,
+      clock=time.time):
+    if lease_seconds is None:
+      lease_seconds = FLAGS.cluster_lease_seconds
+    self._node_id = node_id
+    self._lease_store = lease_store
+    self._lease_seconds = lease_seconds
+    self._clock = clock
+    self._logger = logging.getLogger('cluster')
+    self._last_renewal = None
+    # Until the first refresh, own nothing.
+    self._ring = HashRing([])
+
+  def __str__(self):
+    return '<ClusterOwnership %s of %s>' % (self._node_id,
+        sorted(self._ring.GetNodes()))
+
+  def GetNodeId(self):
+    return self._node_id
+
+  def GetOwner(self, controller_name):
+    return self._ring.GetNode(controller_name)
+
+  def OwnsController(self, controller_name):
+    return self._ring.GetNode(controller_name) == self._node_id
+
+  def Refresh(self):
+    """Renews this node's lease, and updates the membership.
+
+    Returns True if the membership changed.  If the lease store cannot be
+    reached, the last known membership is kept until this node's lease would
+    have expired.
+    """
+    now = self._clock()
+    try:
+      self._lease_store.Renew(self._node_id, self._lease_seconds)
+      nodes = self._lease_store.GetLiveNodes()
+      self._last_renewal = now
+      nodes.add(self._node_id)
+    except kegnet._redis().exceptions.RedisError as e:
+      self._logger.warning('Error refreshing cluster membership: %s' % e)
+      if self._last_renewal is not None and \
+          now - self._last_renewal < self._lease_seconds:
+        return False
+      nodes = set()
+    if nodes == self._ring.GetNodes():
+      return False
+    self._logger.info('Cluster membership changed: %s -> %s' % (
+        sorted(self._ring.GetNodes()), sorted(nodes)))
+    self._ring = HashRing(nodes)
+    return True
+
+  def Leave(self):
+    """Gives up this node's lease, handing its controllers to other nodes."""
+    try:
+      self._lease_store.Release(self._node_id)
+    except kegnet._redis().exceptions.RedisError as e:
+      self._logger.warning('Error leaving cluster: %s' % e)
+
+
+def BuildOwnership():
+  """Returns a ClusterOwnership using Redis, or None if not configured."""
+  if not FLAGS.cluster_node_id:
+    return None
+  redis_client = kegnet._redis().from_url(FLAGS.redis_url)
+  return ClusterOwnership(FLAGS.cluster_node_id, RedisLeaseStore(redis_client))
@@ -0,0 +1,199 @@
+"""Unittest for cluster module"""
+
+import unittest
+
+import redis
+
+from . import cluster
+from . import kbevent
+from . import manager
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class FailingLeaseStore(cluster.LeaseStore):
+  def Renew(self, node_id, lease_seconds):
+    raise redis.exceptions.ConnectionError('unreachable')
+
+class FakeLeaseRedis(object):
+  """In-process stand-in for the Redis commands used by RedisLeaseStore.
+
+  Keys expire according to the server's clock, `clock`.
+  """
+  def __init__(self, clock):
+    self.clock = clock
+    self.sets = {}
+    self.expiry = {}
+
+  def pipeline(self, transaction=True):
+    return FakePipeline(self)
+
+  def set(self, name, value, px=None):
+    self.expiry[name] = self.clock() + px / 1000.0
+
+  def delete(self, name):
+    return int(self.expiry.pop(name, None) is not None)
+
+  def exists(self, name):
+    return int(self.expiry.get(name, 0) > self.clock())
+
+  def sadd(self, name, value):
+    self.sets.setdefault(name, set()).add(value.encode('utf-8'))
+
+  def srem(self, name, value):
+    self.sets.get(name, set()).discard(value.encode('utf-8'))
+
+  def smembers(self, name):
+    return set(self.sets.get(name, set()))
+
+class FakePipeline(object):
+  def __init__(self, redis):
+    self._redis = redis
+    self._calls = []
+
+  def __getattr__(self, name):
+    def call(*args, **kwargs):
+      self._calls.append((getattr(self._redis, name), args, kwargs))
+    return call
+
+  def execute(self):
+    return [f(*args, **kwargs) for f, args, kwargs in self._calls]
+
+CONTROLLERS = ['kegboard-%08x' % i for i in range(100)]
+
+class HashRingTestCase(unittest.TestCase):
+  def testBalancedAndStable(self):
+    ring = cluster.HashRing(['a', 'b', 'c'])
+    owners = dict((c, ring.GetNode(c)) for c in CONTROLLERS)
+    for node in ('a', 'b', 'c'):
+      self.assertTrue(10 < list(owners.values()).count(node) < 60)
+
+    # Only controllers of the removed node move.
+    smaller = cluster.HashRing(['a', 'c'])
+    for controller, owner in owners.items():
+      if owner != 'b':
+        self.assertEqual(owner, smaller.GetNode(controller))
+
+    self.assertIsNone(cluster.HashRing([]).GetNode('kegboard'))
+
+class ClusterOwnershipTestCase(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.store = cluster.LocalLeaseStore(clock=self.clock)
+
+  def _Node(self, node_id, store=None):
+    return cluster.ClusterOwnership(node_id, store or self.store,
+        lease_seconds=5, clock=self.clock)
+
+  def _Owned(self, node):
+    return set(c for c in CONTROLLERS if node.OwnsController(c))
+
+  def testHandoffOnFailure(self):
+    a = self._Node('a')
+    b = self._Node('b')
+    self.assertEqual(set(), self._Owned(a))
+
+    self.assertTrue(a.Refresh())
+    self.assertTrue(b.Refresh())
+    self.assertTrue(a.Refresh())
+    self.assertFalse(a.Refresh())
+    owned_a = self._Owned(a)
+    owned_b = self._Owned(b)
+    self.assertTrue(owned_a and owned_b)
+    self.assertEqual(set(), owned_a & owned_b)
+    self.assertEqual(set(CONTROLLERS), owned_a | owned_b)
+
+    # b stops renewing its lease.
+    self.clock.now += 3
+    self.assertFalse(a.Refresh())
+    self.clock.now += 3
+    self.assertTrue(a.Refresh())
+    self.assertEqual(set(CONTROLLERS), self._Owned(a))
+
+    # b comes back, and takes back the same controllers.
+    b.Refresh()
+    a.Refresh()
+    self.assertEqual(owned_a, self._Owned(a))
+
+    b.Leave()
+    a.Refresh()
+    self.assertEqual(set(CONTROLLERS), self._Owned(a))
+
+  def testUnreachableStore(self):
+    a = self._Node('a')
+    a.Refresh()
+    a._lease_store = FailingLeaseStore()
+    self.clock.now += 3
+    self.assertFalse(a.Refresh())
+    self.assertEqual(set(CONTROLLERS), self._Owned(a))
+
+    # Once its lease would have expired, the node owns nothing.
+    self.clock.now += 3
+    self.assertTrue(a.Refresh())
+    self.assertEqual(set(), self._Owned(a))
+
+class RedisLeaseStoreTestCase(unittest.TestCase):
+  def testSkewedClocks(self):
+    server_clock = FakeClock()
+    redis_client = FakeLeaseRedis(server_clock)
+    # The clock of b runs a minute ahead of the clock of a.
+    clock_a = FakeClock()
+    clock_b = FakeClock()
+    clock_b.now += 60
+    a = cluster.ClusterOwnership('a', cluster.RedisLeaseStore(redis_client,
+        key='cluster'), lease_seconds=5, clock=clock_a)
+    b = cluster.ClusterOwnership('b', cluster.RedisLeaseStore(redis_client,
+        key='cluster'), lease_seconds=5, clock=clock_b)
+
+    for node in (a, b, a, b):
+      node.Refresh()
+    self.assertEqual(set(['a', 'b']), a._ring.GetNodes())
+    self.assertEqual(set(['a', 'b']), b._ring.GetNodes())
+    owned_a = set(c for c in CONTROLLERS if a.OwnsController(c))
+    owned_b = set(c for c in CONTROLLERS if b.OwnsController(c))
+    self.assertEqual(set(), owned_a & owned_b)
+    self.assertEqual(set(CONTROLLERS), owned_a | owned_b)
+
+    # b stops renewing its lease, which the server expires.
+    server_clock.now += 6
+    clock_a.now += 6
+    self.assertTrue(a.Refresh())
+    self.assertEqual(set(['a']), a._ring.GetNodes())
+
+    # b comes back, then leaves.
+    b.Refresh()
+    self.assertTrue(a.Refresh())
+    b.Leave()
+    self.assertTrue(a.Refresh())
+    self.assertEqual(set(['a']), a._ring.GetNodes())
+
+class ClusterManagerTestCase(unittest.TestCase):
+  def testFlowsStoppedOnHandoff(self):
+    clock = FakeClock()
+    store = cluster.LocalLeaseStore(clock=clock)
+    ownership = cluster.ClusterOwnership('a', store, lease_seconds=5,
+        clock=clock)
+    event_hub = kbevent.EventHub()
+    tap_manager = manager.TapManager(event_hub, None, ownership=ownership)
+    flow_manager = manager.FlowManager(event_hub, tap_manager)
+    cluster_manager = manager.ClusterManager(event_hub, flow_manager,
+        ownership)
+    cluster_manager.Refresh()
+
+    other = cluster.ClusterOwnership('b', store, lease_seconds=5, clock=clock)
+    other.Refresh()
+    moved = [c for c in CONTROLLERS if other.OwnsController(c)]
+    kept = [c for c in CONTROLLERS if not other.OwnsController(c)]
+    flow_manager.StartFlow(moved[0] + '.flow0')
+    flow_manager.StartFlow(kept[0] + '.flow0')
+
+    cluster_manager.Refresh()
+    self.assertIsNone(flow_manager.GetFlow(moved[0] + '.flow0'))
+    self.assertIsNotNone(flow_manager.GetFlow(kept[0] + '.flow0'))
+
+if __name__ == '__main__':
+  unittest.main()
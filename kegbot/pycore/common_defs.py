@@ -9,6 +9,10 @@ MIN_VOLUME_TO_RECORD = 10
 # valid.
 MAX_METER_READING_DELTA = 2200*2
 
+# The largest single step between consecutive readings which a FlowMeter in the
+# core accepts.
+FLOW_METER_MAX_DELTA = 1000
+
 # Minimum and maximum thermo sensor readings (degrees C).
 THERMO_SENSOR_RANGE = (-20.0, 80.0)
 
@@ -49,5 +53,64 @@ AUTH_DEVICE_MAX_IDLE_SECS = {
   'default': 10
 }
 
+# Seconds a removed token is still considered present, based on auth device.
+# A token presented again within this window is treated as never removed, so a
+# reader which briefly loses a token (a bouncing onewire contact, or an RFID tag
+# at the edge of the field) does not end its flow and look it up again.
+# Removals are completed on the next heartbeat after the window ends.
+AUTH_DEVICE_DEBOUNCE_SECS = {
+  AUTH_MODULE_CORE_ONEWIRE: 1,
+  AUTH_MODULE_CORE_RFID: 2,
+  'default': 0
+}
+
+# Minimum seconds between attempts to start a flow for a token which is still
+# attached but owns no flow, because its lookup failed or its flow ended.
+AUTH_TOKEN_RETRY_SECS = 5
+
 # How often to record a thermo reading?
 THERMO_RECORD_DELTA_SECONDS = 60
+
+# Thermo anomaly detection (see thermo.AnomalyDetector).
+#
+# Weight of each new reading in the running mean and variance.
+THERMO_ANOMALY_ALPHA = 0.05
+# Weight of each new reading in the slow-moving baseline used to detect drift.
+THERMO_BASELINE_ALPHA = 0.001
+# Number of readings before any alert is raised.
+THERMO_WARMUP_READINGS = 30
+# A reading is a spike if it is this many standard deviations, and at least
+# THERMO_SPIKE_MIN_DEGREES, away from the running mean.
+THERMO_SPIKE_SIGMAS = 6.0
+THERMO_SPIKE_MIN_DEGREES = 1.0
+# A sensor is stuck after reporting the exact same value this many times.
+THERMO_STUCK_READINGS = 900
+# A sensor is drifting when its running mean moves this many degrees (C) away
+# from its baseline.
+THERMO_DRIFT_DEGREES = 3.0
+
+# Web API calls are grouped into call types (see transport.CallType), each with
+# its own timeout and limit on concurrent requests, so that a slow call of one
+# type cannot hold up calls of another.
+#
+# Timeout for the connection and for each read, as a multiple of
+# --api_timeout (10 seconds by default).
+API_CALL_TIMEOUT_SCALE = {
+  'auth': 0.3,
+  'drink': 1.5,
+  'sensor': 0.5,
+  'status': 1.0,
+  'default': 1.0,
+}
+
+# Maximum number of requests of each type in flight at once.
+API_CALL_MAX_CONCURRENCY = {
+  'auth': 2,
+  'drink': 2,
+  'sensor': 1,
+  'status': 1,
+  'default': 2,
+}
+
+# Upper bounds (ms) of the buckets of API latency histograms.
+API_LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
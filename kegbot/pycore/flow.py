@@ -3,17 +3,20 @@
 from builtins import object
 import datetime
 from . import kbevent
+from .clock import SYSTEM_CLOCK
 
 class Flow(object):
   """An object that holds data about a pour while it is active."""
-  def __init__(self, meter_name, flow_id, username=None, max_idle_secs=10, when=None):
+  def __init__(self, meter_name, flow_id, username=None, max_idle_secs=10, when=None,
+      clock=SYSTEM_CLOCK):
+    self._clock = clock
     self._meter_name = meter_name
     self._flow_id = flow_id
     self._bound_username = username
     self._max_idle = datetime.timedelta(seconds=max_idle_secs)
     self._state = kbevent.FlowUpdate.FlowState.ACTIVE
     if when is None:
-      when = datetime.datetime.now()
+      when = clock.Now()
     self._start_time = when
     self._end_time = when
     self._last_log_time = None
@@ -41,10 +44,38 @@ class Flow(object):
 
     return event
 
+  def GetSnapshot(self):
+    """Returns the state of this flow as a JSON-serializable dict."""
+    return {
+      'meter_name': self._meter_name,
+      'flow_id': self._flow_id,
+      'username': self._bound_username,
+      'max_idle_secs': self._max_idle.total_seconds(),
+      'state': self._state,
+      'start_time': self._start_time.timestamp(),
+      'end_time': self._end_time.timestamp(),
+      'ticks': self._total_ticks,
+      'volume_ml': self._volume_ml,
+    }
+
+  @classmethod
+  def FromSnapshot(cls, snapshot, clock=SYSTEM_CLOCK):
+    """Builds a Flow from the output of GetSnapshot."""
+    flow = cls(snapshot['meter_name'], snapshot['flow_id'],
+        username=snapshot['username'],
+        max_idle_secs=snapshot['max_idle_secs'],
+        when=datetime.datetime.fromtimestamp(snapshot['start_time']),
+        clock=clock)
+    flow._state = snapshot['state']
+    flow._end_time = datetime.datetime.fromtimestamp(snapshot['end_time'])
+    flow._total_ticks = snapshot['ticks']
+    flow._volume_ml = snapshot['volume_ml']
+    return flow
+
   def AddTicks(self, amount, when=None, tap=None):
     self._total_ticks += amount
     if when is None:
-      when = datetime.datetime.now()
+      when = self._clock.Now()
     self._end_time = when
     if tap is not None:
         self._volume_ml = tap.TicksToMilliliters(self._total_ticks)
@@ -75,7 +106,7 @@ class Flow(object):
 
   def IsIdle(self, when=None):
     if when is None:
-      when = datetime.datetime.now()
+      when = self._clock.Now()
     idle_time = when - self._end_time
     return idle_time > self._max_idle
 
@@ -15,7 +15,11 @@ class FlowMeter(object):
   def __str__(self):
     return "<FlowMeter name=%s ticks=%i>" % (self._name, self.GetTicks())
 
-  def SetTicks(self, ticks):
+  def IsValidDelta(self, delta):
+    """Returns True if `delta` may be applied as a single step."""
+    return delta >= 0 and (not self._max_delta or delta <= self._max_delta)
+
+  def SetTicks(self, ticks, base_ticks=None):
     """Reports the instantaneous reading of the meter.
 
     If this is the first report, `_total_ticks` is set to 0.
@@ -27,7 +31,19 @@ class FlowMeter(object):
 
     The value `ticks` is always saved as `_last_ticks` for use in the next
     report.
+
+    If `base_ticks` is given, the report stands for a run of readings from
+    `base_ticks` to `ticks` whose steps have already been checked with
+    `IsValidDelta`.  Only the step from `_last_ticks` to `base_ticks` is
+    validated; the remainder of the run is always added.
     """
+    if base_ticks is not None:
+      delta = self.SetTicks(base_ticks)
+      run = int(ticks) - self._last_ticks
+      self._total_ticks += run
+      self._last_ticks = int(ticks)
+      return delta + run
+
     ticks = int(ticks)
     self._logger.info('SetTicks: ticks=%s last=%s total=%s' % (
         ticks, self._last_ticks, self._total_ticks))
@@ -48,6 +64,11 @@ class FlowMeter(object):
   def GetTicks(self):
     return self._total_ticks
 
+  def Restore(self, last_ticks, total_ticks):
+    """Restores the readings saved from an earlier instance of this meter."""
+    self._last_ticks = last_ticks
+    self._total_ticks = total_ticks
+
   def GetLastReading(self):
     return self._last_ticks
 
@@ -89,6 +89,25 @@ class FlowMeterTestCase(unittest.TestCase):
     curr_reading = self.meter.GetTicks()
     self.assertEqual(curr_reading, 110)
 
+  def testCoalescedRun(self):
+    # A run that starts with the first reading establishes the baseline.
+    self.meter.SetTicks(200, base_ticks=100)
+    self.assertEqual(100, self.meter.GetTicks())
+    self.assertEqual(200, self.meter.GetLastReading())
+
+    # The step to the start of the run is validated as usual.
+    delta = self.meter.SetTicks(300 + MAX_DELTA, base_ticks=250)
+    self.assertEqual(100 + MAX_DELTA, delta)
+    delta = self.meter.SetTicks(9, base_ticks=5)
+    self.assertEqual(4, delta)
+    self.assertEqual(204 + MAX_DELTA, self.meter.GetTicks())
+
+  def testIsValidDelta(self):
+    self.assertTrue(self.meter.IsValidDelta(0))
+    self.assertTrue(self.meter.IsValidDelta(MAX_DELTA))
+    self.assertFalse(self.meter.IsValidDelta(MAX_DELTA + 1))
+    self.assertFalse(self.meter.IsValidDelta(-1))
+
 
 if __name__ == '__main__':
   unittest.main()
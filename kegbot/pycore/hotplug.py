@@ -0,0 +1,177 @@
+"""Device discovery driven by filesystem change notifications.
+
+DeviceList caches the device paths matching a set of glob patterns, and only
+rescans when something changes.  On Linux, changes are detected with inotify
+on the directories holding the patterns; InotifyWatcher exposes a file
+descriptor which becomes readable on change, suitable for use with selectors.
+Elsewhere, DeviceList falls back to rescanning periodically.
+"""
+
+from builtins import object
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import glob
+import logging
+import os
+import struct
+import time
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _GetLibc():
+  global _libc
+  if _libc is None:
+    name = ctypes.util.find_library('c')
+    if not name:
+      raise OSError(errno.ENOSYS, 'libc not found')
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+      raise OSError(errno.ENOSYS, 'inotify is not available')
+    _libc = libc
+  return _libc
+
+
+class InotifyWatcher(object):
+  """Watches directories for entries being added, removed or changed.
+
+  Raises OSError if inotify is not available.
+  """
+  def __init__(self, directories):
+    libc = _GetLibc()
+    self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self._fd < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+    self._directories = {}
+    try:
+      for directory in directories:
+        wd = libc.inotify_add_watch(self._fd, directory.encode('utf-8'),
+            WATCH_MASK)
+        if wd < 0:
+          e = ctypes.get_errno()
+          raise OSError(e, '%s: %s' % (directory, os.strerror(e)))
+        self._directories[wd] = directory
+    except OSError:
+      os.close(self._fd)
+      raise
+
+  def fileno(self):
+    return self._fd
+
+  def close(self):
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+
+  def ReadChanges(self):
+    """Returns the paths changed since the last call, without blocking.
+
+    A path of None means events were lost, and everything should be rescanned.
+    """
+    ret = []
+    while True:
+      try:
+        data = os.read(self._fd, 4096)
+      except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        raise
+      if not data:
+        break
+      offset = 0
+      while offset + _EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+        offset += _EVENT_HEADER.size
+        name = data[offset:offset + length].rstrip(b'\0').decode('utf-8',
+            'replace')
+        offset += length
+        if mask & IN_Q_OVERFLOW:
+          ret.append(None)
+        elif wd in self._directories:
+          ret.append(os.path.join(self._directories[wd], name))
+    return ret
+
+
+class DeviceList(object):
+  """Cached list of the device paths matching `glob_paths`.
+
+  If `use_inotify` is true and inotify is available, the list is rescanned only
+  when a matching path changes, and at least every `rescan_interval` seconds as
+  a safety net.  Otherwise it is rescanned every `poll_interval` seconds.
+  """
+  def __init__(self, glob_paths, use_inotify=True, rescan_interval=30.0,
+      poll_interval=1.0):
+    self._logger = logging.getLogger('device-list')
+    self._glob_paths = tuple(glob_paths)
+    self._watcher = None
+    if use_inotify:
+      directories = set(os.path.dirname(p) for p in self._glob_paths)
+      directories = [d for d in directories if os.path.isdir(d)]
+      try:
+        self._watcher = InotifyWatcher(directories)
+      except OSError as e:
+        self._logger.info('Not watching for devices (%s); will poll.' % e)
+    if self._watcher:
+      self._rescan_interval = rescan_interval
+    else:
+      self._rescan_interval = poll_interval
+    self._devices = []
+    self._last_scan_time = None
+
+  def GetWatcher(self):
+    """Returns the InotifyWatcher in use, or None if polling."""
+    return self._watcher
+
+  def GetTimeout(self, now=None):
+    """Returns seconds until the list must next be rescanned."""
+    if self._last_scan_time is None:
+      return 0
+    if now is None:
+      now = time.time()
+    return max(0, self._last_scan_time + self._rescan_interval - now)
+
+  def _Matches(self, path):
+    return any(fnmatch.fnmatch(path, p) for p in self._glob_paths)
+
+  def HandleWatcherEvent(self):
+    """Reads pending changes; returns True if the list should be rescanned."""
+    changes = self._watcher.ReadChanges()
+    for path in changes:
+      if path is None or self._Matches(path):
+        self._last_scan_time = None
+        return True
+    return False
+
+  def Invalidate(self):
+    self._last_scan_time = None
+
+  def GetDevices(self):
+    """Returns the cached device paths, rescanning them if needed."""
+    if self.GetTimeout() == 0:
+      devices = []
+      for p in self._glob_paths:
+        devices += glob.glob(p)
+      self._devices = devices
+      self._last_scan_time = time.time()
+    return self._devices
+
+  def close(self):
+    if self._watcher:
+      self._watcher.close()
@@ -0,0 +1,67 @@
+"""Unittest for hotplug module"""
+
+import os
+import select
+import shutil
+import tempfile
+import unittest
+
+from . import hotplug
+
+class DeviceListTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.pattern = os.path.join(self.tempdir, 'ttyUSB*')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _Touch(self, name):
+    path = os.path.join(self.tempdir, name)
+    open(path, 'w').close()
+    return path
+
+  def testPolling(self):
+    devices = hotplug.DeviceList([self.pattern], use_inotify=False,
+        poll_interval=60)
+    self.assertIsNone(devices.GetWatcher())
+    self.assertEqual([], devices.GetDevices())
+
+    # Cached until the poll interval passes, or the list is invalidated.
+    path = self._Touch('ttyUSB0')
+    self.assertEqual([], devices.GetDevices())
+    self.assertTrue(devices.GetTimeout() > 0)
+    devices.Invalidate()
+    self.assertEqual(0, devices.GetTimeout())
+    self.assertEqual([path], devices.GetDevices())
+
+  def testInotify(self):
+    devices = hotplug.DeviceList([self.pattern], rescan_interval=60)
+    watcher = devices.GetWatcher()
+    if not watcher:
+      self.skipTest('inotify not available')
+    try:
+      self.assertEqual([], devices.GetDevices())
+      self.assertTrue(devices.GetTimeout() > 0)
+
+      # Changes to non-matching paths do not cause a rescan.
+      self._Touch('other')
+      self.assertTrue(select.select([watcher], [], [], 1)[0])
+      self.assertFalse(devices.HandleWatcherEvent())
+      self.assertTrue(devices.GetTimeout() > 0)
+
+      path = self._Touch('ttyUSB0')
+      self.assertTrue(select.select([watcher], [], [], 1)[0])
+      self.assertTrue(devices.HandleWatcherEvent())
+      self.assertEqual([path], devices.GetDevices())
+
+      os.unlink(path)
+      self.assertTrue(select.select([watcher], [], [], 1)[0])
+      self.assertTrue(devices.HandleWatcherEvent())
+      self.assertEqual([], devices.GetDevices())
+      self.assertFalse(select.select([watcher], [], [], 0)[0])
+    finally:
+      devices.close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,20 +1,22 @@
 from __future__ import absolute_import
 
 import asyncore
-import time
 from json.decoder import JSONDecodeError
 
 from kegbot.api import exceptions as api_exceptions
 from kegbot.util import util
 from .util import AttrDict
+from . import backend
 from . import kbevent
 from . import kegnet
+from . import tracing
 
 class CoreThread(util.KegbotThread):
   """ Convenience wrapper around a threading.Thread """
   def __init__(self, kb_env, name):
     super(CoreThread, self).__init__(name)
     self._kb_env = kb_env
+    self._clock = kb_env.GetClock()
     self._kb_env.GetEventHub().Subscribe(kbevent.QuitEvent, self._HandleQuit)
 
   def _HandleQuit(self, event):
@@ -32,7 +34,7 @@ class WatchdogThread(CoreThread):
         if not thr.isAlive():
           self._logger.error('Thread %s died unexpectedly' % thr.getName())
           self.Quit()
-      time.sleep(0.5)
+      self._clock.Sleep(0.5)
 
 
 class EventHubServiceThread(CoreThread):
@@ -56,7 +58,9 @@ class SyncThread(CoreThread):
       status = self._backend.GetStatus()
       self._logger.debug('Sync complete.')
       self._logger.debug(status)
-    except (api_exceptions.Error, IOError, JSONDecodeError) as e:
+      self._logger.debug('API latency: %s' % self._backend.GetLatencyStats())
+    except (backend.BackendException, api_exceptions.Error, IOError,
+        JSONDecodeError) as e:
       self._logger.warning('API exception during sync: %s' % e)
       status = {}
 
@@ -77,7 +81,7 @@ class SyncThread(CoreThread):
       else:
         interval = 60
 
-      time.sleep(interval)
+      self._clock.Sleep(interval)
 
 
 class HeartbeatThread(CoreThread):
@@ -86,7 +90,7 @@ class HeartbeatThread(CoreThread):
     hub = self._kb_env.GetEventHub()
     seconds = 0
     while not self._quit:
-      time.sleep(1.0)
+      self._clock.Sleep(1.0)
       seconds += 1
       event = kbevent.HeartbeatSecondEvent()
       hub.PublishEvent(event)
@@ -100,13 +104,21 @@ class NetProtocolThread(CoreThread):
   def ThreadMain(self):
     self._logger.info('Starting network thread.')
     hub = self._kb_env.GetEventHub()
+    ownership = self._kb_env.GetOwnership()
+    consumer_group = self._kb_env.GetConsumerGroup()
 
     class Client(kegnet.KegnetClient):
       def __init__(self, hub):
-        super(Client, self).__init__()
+        super(Client, self).__init__(consumer_group=consumer_group, core=True)
         self.hub = hub
 
+      def wantsEvent(self, event_cls):
+        return self.hub.HasSubscribers(event_cls)
+
       def onNewEvent(self, event):
+        if not ownership.OwnsEvent(event):
+          return
+        event.AddTraceHop(tracing.HOP_NET)
         self._logger.debug('Publishing event: %s' % event)
         self.hub.PublishEvent(event)
 
@@ -6,42 +6,115 @@ This module implements a very simple inter-process event passing system
 
 from __future__ import absolute_import
 
-from future import standard_library
-standard_library.install_aliases()
-from past.builtins import basestring
 from builtins import object
-from future.utils import raise_
+import collections
+import datetime
 import json
 import logging
-import queue
+import re
+import threading
 import types
 
 import gflags
 
 from kegbot.util import util
 
+from . import tracing
+
 FLAGS = gflags.FLAGS
 
 gflags.DEFINE_boolean('debug_events', False,
     'If true, logs debugging information about internal events.')
 
+gflags.DEFINE_integer('event_starvation_limit', 20,
+    'Maximum number of times a waiting lower-priority event may be passed '
+    'over in favor of higher-priority events before it is dispatched anyway.',
+    lower_bound=1)
+
+gflags.DEFINE_integer('event_queue_size', 10000,
+    'Maximum number of events waiting for dispatch.  When the queue is full, '
+    'new events are handled according to their overflow policy.  If 0, the '
+    'queue is unbounded.',
+    lower_bound=0)
+
 class Event(metaclass=util.DeclarativeMetaclass):
+  # Encoded payload not yet decoded into `_values`; see LazyDecodeEvent.
+  _raw = None
+  _decode_failed = False
+  # Latency trace context, if any; see the tracing module.
+  _trace = None
+
   def __init__(self, initial=None, encoded=None, **kwargs):
     self._values = {}
     if encoded is not None:
       self.DecodeFromString(encoded)
+    for name, value in kwargs.items():
+      setattr(self, name, value)
 
   def __setattr__(self, name, value):
     if name != '_values' and name in self.fields:
+      if self._raw is not None:
+        self.Decode()
       self._values[name] = value
     else:
       super(Event, self).__setattr__(name, value)
 
   def __getattr__(self, name):
+    if self._raw is not None and not name.startswith('_'):
+      self.Decode()
+      return getattr(self, name)
     if name in self.__class__.fields:
       return self._values.get(name, None)
     raise AttributeError('No such field {}'.format(name))
 
+  def Decode(self):
+    """Decodes any pending encoded payload.
+
+    Returns False if the payload could not be decoded, True otherwise.  Called
+    implicitly the first time a field is accessed.
+    """
+    raw = self._raw
+    if raw is None:
+      return not self._decode_failed
+    self._raw = None
+    try:
+      msg = json.loads(raw)
+      data = msg['data']
+    except (ValueError, KeyError, TypeError):
+      self._decode_failed = True
+      return False
+    for k, v in data.items():
+      setattr(self, k, v)
+    self._DecodeTrace(msg)
+    return True
+
+  def _DecodeTrace(self, msg):
+    trace = msg.get('trace')
+    if trace:
+      try:
+        self._trace = tracing.Trace.FromDict(trace)
+      except (KeyError, TypeError, ValueError):
+        pass
+
+  def GetTrace(self):
+    """Returns the tracing.Trace of this event, or None.
+
+    A pending payload is decoded only if it carries a trace, so untraced
+    events stay undecoded.
+    """
+    if self._raw is not None and _HasTrace(self._raw):
+      self.Decode()
+    return self._trace
+
+  def SetTrace(self, trace):
+    self._trace = trace
+
+  def AddTraceHop(self, name):
+    """Records hop `name` on this event's trace, if it has one."""
+    trace = self.GetTrace()
+    if trace is not None:
+      trace.AddHop(name)
+
   def ToDict(self):
     data = {}
     for field_name in self.fields.keys():
@@ -51,6 +124,8 @@ class Event(metaclass=util.DeclarativeMetaclass):
       'event': self.__class__.__name__,
       'data': data,
     }
+    if self._trace is not None:
+      ret['trace'] = self._trace.ToDict()
     return ret
 
   def ToJson(self, indent=2):
@@ -59,6 +134,13 @@ class Event(metaclass=util.DeclarativeMetaclass):
 class EventField(util.Field):
   pass
 
+def GetEventTime(event):
+  """Returns the `when` of `event` as a naive local datetime, or None."""
+  when = getattr(event, 'when', None)
+  if when is None:
+    return None
+  return datetime.datetime.fromtimestamp(when)
+
 class Ping(Event):
   pass
 
@@ -71,6 +153,9 @@ class QuitEvent(Event):
 class MeterUpdate(Event):
   meter_name = EventField()
   reading = EventField()
+  # Unix time the reading was taken, if it is being delivered late (as by the
+  # spool module); otherwise None, meaning now.
+  when = EventField()
 
 class FlowUpdate(Event):
   class FlowState(object):
@@ -106,6 +191,25 @@ class TokenAuthEvent(Event):
 class ThermoEvent(Event):
   sensor_name = EventField()
   sensor_value = EventField()
+  # As for MeterUpdate.
+  when = EventField()
+  # Set when the event summarizes several readings (as compacted by the spool
+  # module), in which case `sensor_value` is the last of them.
+  reading_count = EventField()
+  min_value = EventField()
+  max_value = EventField()
+  mean_value = EventField()
+
+class ThermoAlertEvent(Event):
+  class Alert(object):
+    SPIKE = "spike"
+    STUCK = "stuck"
+    DRIFT = "drift"
+  sensor_name = EventField()
+  sensor_value = EventField()
+  alert = EventField()
+  mean = EventField()
+  stddev = EventField()
 
 class FlowRequest(Event):
   class Action(object):
@@ -134,29 +238,204 @@ class SetRelayOutputEvent(Event):
 class SyncEvent(Event):
   data = EventField()
 
+class ReplicationEvent(Event):
+  """State and liveness of an active core, for its standby.
+
+  `state` holds the sections of the core's state (see SnapshotManager.GetState)
+  which changed since the previous event, and may be empty.
+  """
+  node_id = EventField()
+  epoch = EventField()
+  sequence = EventField()
+  state = EventField()
+
 EVENT_NAME_TO_CLASS = {}
 for cls in Event.__subclasses__():
   name = cls.__name__
   EVENT_NAME_TO_CLASS[name] = cls
 
+_EVENT_NAME_RE = re.compile(br'"event"\s*:\s*"(\w+)"')
+
+_TRACE_KEY_RE = re.compile(br'"trace"\s*:')
+
+def _HasTrace(data):
+  """Returns whether encoded `data` may carry a trace, without decoding it."""
+  if isinstance(data, str):
+    data = data.encode('utf-8')
+  return _TRACE_KEY_RE.search(data) is not None
+
+def PeekEventClass(data):
+  """Returns the event class named by encoded `data`, without decoding it.
+
+  Returns None if no event name is found or the event is unknown.  Relies on
+  the "event" key preceding "data", as written by Event.ToJson.
+  """
+  if isinstance(data, str):
+    data = data.encode('utf-8')
+  match = _EVENT_NAME_RE.search(data)
+  if not match:
+    return None
+  return EVENT_NAME_TO_CLASS.get(match.group(1).decode('ascii'))
+
+_STRING_FIELD_RES = {}
+
+def PeekStringField(data, field_name):
+  """Returns the string value of `field_name` in encoded `data`, without
+  decoding it.
+
+  Returns None if the field is not found, or is not a string.
+  """
+  if isinstance(data, str):
+    data = data.encode('utf-8')
+  regex = _STRING_FIELD_RES.get(field_name)
+  if regex is None:
+    regex = _STRING_FIELD_RES[field_name] = re.compile(
+        br'"%s"\s*:\s*("(?:[^"\\]|\\.)*")' % field_name.encode('ascii'))
+  match = regex.search(data)
+  if not match:
+    return None
+  try:
+    return json.loads(match.group(1).decode('utf-8'))
+  except ValueError:
+    return None
+
+def LazyDecodeEvent(data, event_cls=None):
+  """Returns an event of `event_cls` whose fields are decoded on first use.
+
+  `data` is kept as-is until then.  If `event_cls` is not given, it is peeked
+  from `data` (see PeekEventClass).
+  """
+  if event_cls is None:
+    event_cls = PeekEventClass(data)
+    if event_cls is None:
+      raise ValueError('Unknown event')
+  inst = event_cls()
+  inst._raw = data
+  return inst
+
 def DecodeEvent(msg):
-  if isinstance(msg, basestring):
+  if isinstance(msg, (str, bytes)):
     msg = json.loads(msg)
   event_name = msg.get('event')
   if event_name not in EVENT_NAME_TO_CLASS:
-    raise_(ValueError, "Unknown event: %s" % event_name)
+    raise ValueError("Unknown event: %s" % event_name)
   inst = EVENT_NAME_TO_CLASS[event_name]()
   for k, v in msg['data'].items():
     setattr(inst, k, v)
+  inst._DecodeTrace(msg)
   return inst
 
 
+# Dispatch priorities used by EventHub.  Lower values are dispatched first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+# Default mapping of event class to dispatch priority.  Valve control, auth and
+# shutdown must not wait behind a backlog of sensor readings.  Classes not
+# listed here are dispatched at PRIORITY_NORMAL.
+DEFAULT_EVENT_PRIORITIES = {
+  QuitEvent: PRIORITY_HIGH,
+  SetRelayOutputEvent: PRIORITY_HIGH,
+  TokenAuthEvent: PRIORITY_HIGH,
+  FlowRequest: PRIORITY_HIGH,
+  ReplicationEvent: PRIORITY_HIGH,
+  ThermoEvent: PRIORITY_LOW,
+  HeartbeatMinuteEvent: PRIORITY_LOW,
+}
+
+# Overflow policies used by EventHub when its queue is at capacity.
+#   OVERFLOW_DROP: the new event is discarded.
+#   OVERFLOW_COALESCE: the new event replaces the queued event of the same
+#     class and key (see `COALESCE_KEYS`); if there is none, it is discarded.
+#   OVERFLOW_BLOCK: the publisher waits until there is room.  Events published
+#     from the dispatching thread itself are admitted, since waiting there
+#     would deadlock.
+#   OVERFLOW_NEVER_DROP: the event is always admitted, even beyond capacity.
+OVERFLOW_DROP = 'drop'
+OVERFLOW_COALESCE = 'coalesce'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_NEVER_DROP = 'never-drop'
+
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_COALESCE, OVERFLOW_BLOCK,
+    OVERFLOW_NEVER_DROP)
+
+# Default mapping of event class to overflow policy.  Classes not listed here
+# use OVERFLOW_DROP.
+DEFAULT_OVERFLOW_POLICIES = {
+  MeterUpdate: OVERFLOW_COALESCE,
+  ThermoEvent: OVERFLOW_COALESCE,
+  FlowUpdate: OVERFLOW_BLOCK,
+  DrinkCreatedEvent: OVERFLOW_BLOCK,
+  TokenAuthEvent: OVERFLOW_NEVER_DROP,
+  ThermoAlertEvent: OVERFLOW_NEVER_DROP,
+  SetRelayOutputEvent: OVERFLOW_NEVER_DROP,
+  FlowRequest: OVERFLOW_NEVER_DROP,
+  QuitEvent: OVERFLOW_NEVER_DROP,
+  ReplicationEvent: OVERFLOW_NEVER_DROP,
+}
+
+# Field identifying the latest-value key of coalescable events.
+COALESCE_KEYS = {
+  MeterUpdate: 'meter_name',
+  ThermoEvent: 'sensor_name',
+}
+
+
 class EventHub(object):
-  """Central sink and publish of events."""
-  def __init__(self, debug=False):
+  """Central sink and publish of events.
+
+  Events are queued in one lane per priority (see `PRIORITIES`).  The highest
+  priority non-empty lane is always served first, except that a waiting event
+  in a lower lane is never passed over more than `starvation_limit` times in a
+  row.  Within a lane, events are dispatched in the order they were published.
+
+  At most `capacity` events are queued; beyond that, each event class is
+  handled according to its overflow policy (see `OVERFLOW_POLICIES`).  The
+  number of dropped and coalesced events is reported by `GetStats`.
+
+  Classes with a coalescer (see `SetCoalescer`) are merged into the queued
+  event with the same key whenever possible, whether or not the queue is full.
+
+  Events with a trace (see the tracing module) have their dispatch recorded,
+  and pass a copy of their trace to events published by their handlers.  When
+  handled, their spans are written to `trace_exporter`, if given.
+  """
+  def __init__(self, debug=False, priorities=None, starvation_limit=None,
+      capacity=None, overflow_policies=None, trace_exporter=None):
     self._debug = debug or FLAGS.debug_events
     self._subscriptions = {}
-    self._event_queue = queue.Queue()
+    self._priorities = dict(DEFAULT_EVENT_PRIORITIES)
+    if priorities:
+      self._priorities.update(priorities)
+    if starvation_limit is None:
+      starvation_limit = FLAGS.event_starvation_limit
+    self._starvation_limit = starvation_limit
+    self._overflow_policies = dict(DEFAULT_OVERFLOW_POLICIES)
+    if overflow_policies:
+      self._overflow_policies.update(overflow_policies)
+    if capacity is None:
+      capacity = FLAGS.event_queue_size
+    self._capacity = capacity
+    self._trace_exporter = trace_exporter
+
+    # Each lane holds slots of [event, coalesce_key].  Slots of coalescable
+    # events are also indexed by key, so the latest queued event for a key can
+    # be replaced in place.
+    self._lanes = [collections.deque() for p in PRIORITIES]
+    self._passed_over = [0] * len(PRIORITIES)
+    self._coalesce_index = {}
+    self._coalescers = {}
+    self._size = 0
+    self._dropped = collections.Counter()
+    self._coalesced = collections.Counter()
+
+    self._lock = threading.Lock()
+    self._not_empty = threading.Condition(self._lock)
+    self._not_full = threading.Condition(self._lock)
+    self._local = threading.local()
     self._logger = logging.getLogger('eventhub')
 
   def Subscribe(self, event_cls, cb):
@@ -174,19 +453,174 @@ class EventHub(object):
   def Unsubscribe(self, event_cls, cb):
     self._subscriptions.get(event_cls, set()).remove(cb)
 
+  def HasSubscribers(self, event_cls):
+    return bool(self._subscriptions.get(event_cls))
+
+  def SetPriority(self, event_cls, priority):
+    """Changes the dispatch priority of `event_cls`."""
+    if priority not in PRIORITIES:
+      raise ValueError('Unknown priority: %s' % priority)
+    self._priorities[event_cls] = priority
+
+  def GetPriority(self, event_cls):
+    return self._priorities.get(event_cls, PRIORITY_NORMAL)
+
+  def SetOverflowPolicy(self, event_cls, policy):
+    """Changes the overflow policy of `event_cls`."""
+    if policy not in OVERFLOW_POLICIES:
+      raise ValueError('Unknown overflow policy: %s' % policy)
+    self._overflow_policies[event_cls] = policy
+
+  def GetOverflowPolicy(self, event_cls):
+    return self._overflow_policies.get(event_cls, OVERFLOW_DROP)
+
+  def SetCoalescer(self, event_cls, merge_fn):
+    """Merges newly published `event_cls` events into queued ones.
+
+    When an event is published while another event with the same coalesce key
+    (see `COALESCE_KEYS`) is still queued, `merge_fn(queued, new)` is called
+    with the hub lock held.  It must return the event to dispatch in place of
+    the queued one, or None if the two cannot be merged, in which case the new
+    event is queued normally.  Passing None removes the coalescer.
+    """
+    if merge_fn is None:
+      self._coalescers.pop(event_cls, None)
+    else:
+      self._coalescers[event_cls] = merge_fn
+
+  def GetStats(self):
+    """Returns a dict of queue statistics.
+
+    `dropped` and `coalesced` map event class names to the number of events
+    discarded or merged since the hub was created.
+    """
+    with self._lock:
+      return {
+        'queued': self._size,
+        'capacity': self._capacity,
+        'dropped': dict(self._dropped),
+        'coalesced': dict(self._coalesced),
+      }
+
+  def _CoalesceKey(self, event):
+    cls = event.__class__
+    field_name = COALESCE_KEYS.get(cls)
+    if field_name is None:
+      return None
+    # Peeked from a pending payload, so publishing does not decode it.
+    raw = event._raw
+    if raw is not None:
+      value = PeekStringField(raw, field_name)
+      if value is not None:
+        return (cls, value)
+    return (cls, getattr(event, field_name))
+
+  def _IsFull(self):
+    return self._capacity and self._size >= self._capacity
+
+  def _IsDispatching(self):
+    return getattr(self._local, 'dispatching', False)
+
+  def _CountDrop(self, event):
+    name = event.__class__.__name__
+    self._dropped[name] += 1
+    count = self._dropped[name]
+    if count == 1 or (count % 1000) == 0:
+      self._logger.warning('Event queue full; dropped %d %s event(s) so far' %
+          (count, name))
+
   def PublishEvent(self, event):
     """Add a new event to the queue of events to publish.
 
     Events are dispatched to listeners in the DispatchNextEvent method.
     """
-    self._event_queue.put(event)
+    cls = event.__class__
+    priority = self.GetPriority(cls)
+    policy = self.GetOverflowPolicy(cls)
+    key = self._CoalesceKey(event)
+
+    parent = getattr(self._local, 'current', None)
+    if parent is not None and parent._trace is not None and \
+        event._trace is None:
+      event.SetTrace(parent._trace.Child())
+      event.AddTraceHop(tracing.HOP_PUBLISH)
+
+    with self._lock:
+      slot = None
+      if key is not None:
+        slot = self._coalesce_index.get(key)
+      merge_fn = self._coalescers.get(cls)
+      if slot is not None and merge_fn is not None:
+        merged = merge_fn(slot[0], event)
+        if merged is not None:
+          slot[0] = merged
+          self._coalesced[cls.__name__] += 1
+          return
+        # Not mergeable; never replace the queued event outright.
+        slot = None
+
+      if self._IsFull():
+        if policy == OVERFLOW_BLOCK and not self._IsDispatching():
+          while self._IsFull():
+            self._not_full.wait()
+        elif policy == OVERFLOW_COALESCE:
+          if slot is not None:
+            slot[0] = event
+            self._coalesced[cls.__name__] += 1
+          else:
+            self._CountDrop(event)
+          return
+        elif policy == OVERFLOW_DROP:
+          self._CountDrop(event)
+          return
+
+      slot = [event, key]
+      self._lanes[priority].append(slot)
+      if key is not None:
+        self._coalesce_index[key] = slot
+      self._size += 1
+      self._not_empty.notify()
+
+  def _PopEvent(self):
+    """Removes and returns the next event to dispatch, or None.
+
+    Must be called with `_lock` held.
+    """
+    chosen = None
+    for priority in reversed(PRIORITIES):
+      if self._lanes[priority] and \
+          self._passed_over[priority] >= self._starvation_limit:
+        chosen = priority
+        break
+    if chosen is None:
+      for priority in PRIORITIES:
+        if self._lanes[priority]:
+          chosen = priority
+          break
+    if chosen is None:
+      return None
+
+    for priority in PRIORITIES:
+      if priority == chosen:
+        self._passed_over[priority] = 0
+      elif priority > chosen and self._lanes[priority]:
+        self._passed_over[priority] += 1
+
+    slot = self._lanes[chosen].popleft()
+    event, key = slot
+    if key is not None and self._coalesce_index.get(key) is slot:
+      del self._coalesce_index[key]
+    self._size -= 1
+    self._not_full.notify()
+    return event
 
   def _WaitForEvent(self, timeout=None):
     """Wait for a new event to be enqueued."""
-    try:
-      ev = self._event_queue.get(block=True, timeout=timeout)
-    except queue.Empty:
-      ev = None
+    with self._not_empty:
+      ev = self._PopEvent()
+      if ev is None:
+        self._not_empty.wait(timeout)
+        ev = self._PopEvent()
     return ev
 
   def DispatchNextEvent(self, timeout=None):
@@ -196,21 +630,38 @@ class EventHub(object):
       self._Dispatch(ev)
 
   def _Dispatch(self, ev):
+    if not ev.Decode():
+      self._logger.warning('Dropping undecodable %s' % ev.__class__.__name__)
+      return
     if self._debug:
       self._logger.debug('Publishing event: %s ' % ev)
     cls = ev.__class__
-    for cb in self._subscriptions.get(cls, []):
-      cb(ev)
+    trace = ev._trace
+    if trace is not None:
+      trace.AddHop(tracing.HOP_DISPATCH)
+    parent = getattr(self._local, 'current', None)
+    self._local.dispatching = True
+    self._local.current = ev
+    try:
+      for cb in self._subscriptions.get(cls, []):
+        cb(ev)
+    finally:
+      self._local.dispatching = False
+      self._local.current = parent
+    if trace is not None:
+      trace.AddHop(tracing.HOP_HANDLED)
+      if self._trace_exporter:
+        self._trace_exporter.Export(cls.__name__, trace)
 
   def Flush(self):
     """Dispatches all events immediately, returning a count of total
     dispatched."""
     count = 0
     while True:
-      try:
-        self._Dispatch(self._event_queue.get_nowait())
-        count += 1
-      except queue.Empty:
+      with self._lock:
+        ev = self._PopEvent()
+      if ev is None:
         break
+      self._Dispatch(ev)
+      count += 1
     return count
-
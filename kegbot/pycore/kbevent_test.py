@@ -0,0 +1,185 @@
+"""Unittest for kbevent module"""
+
+import unittest
+
+from . import kbevent
+
+class LazyEventTestCase(unittest.TestCase):
+  def _Encode(self, reading):
+    ev = kbevent.MeterUpdate()
+    ev.meter_name = 'flow0'
+    ev.reading = reading
+    return ev.ToJson().encode('utf-8')
+
+  def testPeekEventClass(self):
+    self.assertIs(kbevent.MeterUpdate, kbevent.PeekEventClass(self._Encode(1)))
+    self.assertIs(kbevent.MeterUpdate,
+        kbevent.PeekEventClass(self._Encode(1).decode('utf-8')))
+    self.assertIsNone(kbevent.PeekEventClass(b'{"event": "NoSuchEvent"}'))
+    self.assertIsNone(kbevent.PeekEventClass(b'garbage'))
+
+  def testLazyDecode(self):
+    raw = self._Encode(123)
+    ev = kbevent.LazyDecodeEvent(raw)
+    self.assertIsInstance(ev, kbevent.MeterUpdate)
+    self.assertIs(raw, ev._raw)
+
+    self.assertEqual(123, ev.reading)
+    self.assertIsNone(ev._raw)
+    self.assertEqual('flow0', ev.meter_name)
+
+  def testSetBeforeDecode(self):
+    ev = kbevent.LazyDecodeEvent(self._Encode(123))
+    ev.reading = 456
+    self.assertEqual(456, ev.reading)
+    self.assertEqual('flow0', ev.meter_name)
+
+  def testPeekStringField(self):
+    self.assertEqual('flow0',
+        kbevent.PeekStringField(self._Encode(1), 'meter_name'))
+    self.assertEqual('a"b', kbevent.PeekStringField(
+        b'{"data": {"sensor_name": "a\\"b"}}', 'sensor_name'))
+    self.assertIsNone(kbevent.PeekStringField(self._Encode(1), 'reading'))
+    self.assertIsNone(kbevent.PeekStringField(self._Encode(1), 'sensor_name'))
+
+  def testPublishKeepsEventUndecoded(self):
+    hub = kbevent.EventHub()
+    hub.SetCoalescer(kbevent.MeterUpdate, lambda queued, newer: newer)
+    first = kbevent.LazyDecodeEvent(self._Encode(1))
+    hub.PublishEvent(first)
+    self.assertIsNotNone(first._raw)
+
+    # Still coalesced with a later reading of the same meter.
+    hub.PublishEvent(kbevent.LazyDecodeEvent(self._Encode(2)))
+    self.assertEqual(1, hub.GetStats()['queued'])
+    self.assertEqual({'MeterUpdate': 1}, hub.GetStats()['coalesced'])
+
+  def testUndecodableEventNotDispatched(self):
+    hub = kbevent.EventHub()
+    dispatched = []
+    hub.Subscribe(kbevent.MeterUpdate, dispatched.append)
+    hub.PublishEvent(kbevent.LazyDecodeEvent(b'{"event": "MeterUpdate", ',
+        kbevent.MeterUpdate))
+    hub.Flush()
+    self.assertEqual([], dispatched)
+
+
+class EventHubTestCase(unittest.TestCase):
+  def setUp(self):
+    self.hub = kbevent.EventHub(starvation_limit=3)
+    self.dispatched = []
+    for cls in kbevent.EVENT_NAME_TO_CLASS.values():
+      self.hub.Subscribe(cls, self.dispatched.append)
+
+  def _Meter(self, reading, meter_name='flow0'):
+    ev = kbevent.MeterUpdate()
+    ev.meter_name = meter_name
+    ev.reading = reading
+    return ev
+
+  def testFifoWithinPriority(self):
+    events = [self._Meter(i) for i in range(5)]
+    for ev in events:
+      self.hub.PublishEvent(ev)
+    self.assertEqual(5, self.hub.Flush())
+    self.assertEqual(events, self.dispatched)
+
+  def testHighPriorityJumpsQueue(self):
+    self.hub.PublishEvent(self._Meter(1))
+    self.hub.PublishEvent(self._Meter(2))
+    relay = kbevent.SetRelayOutputEvent(output_name='relay0',
+        output_mode=kbevent.SetRelayOutputEvent.Mode.DISABLED)
+    self.hub.PublishEvent(relay)
+    quit_event = kbevent.QuitEvent()
+    self.hub.PublishEvent(quit_event)
+
+    self.hub.Flush()
+    self.assertIs(relay, self.dispatched[0])
+    self.assertIs(quit_event, self.dispatched[1])
+
+  def testStarvationProtection(self):
+    thermo = kbevent.ThermoEvent()
+    self.hub.PublishEvent(thermo)
+    for i in range(10):
+      self.hub.PublishEvent(self._Meter(i))
+
+    self.hub.Flush()
+    # The low-priority event is passed over at most `starvation_limit` times.
+    self.assertIs(thermo, self.dispatched[3])
+
+  def testConfigurablePriority(self):
+    hub = kbevent.EventHub(priorities={
+      kbevent.ThermoEvent: kbevent.PRIORITY_HIGH,
+    })
+    self.assertEqual(kbevent.PRIORITY_HIGH, hub.GetPriority(kbevent.ThermoEvent))
+    self.assertEqual(kbevent.PRIORITY_NORMAL, hub.GetPriority(kbevent.MeterUpdate))
+
+    hub.SetPriority(kbevent.MeterUpdate, kbevent.PRIORITY_LOW)
+    self.assertEqual(kbevent.PRIORITY_LOW, hub.GetPriority(kbevent.MeterUpdate))
+    self.assertRaises(ValueError, hub.SetPriority, kbevent.MeterUpdate, 99)
+
+  def testWaitTimesOut(self):
+    self.hub.DispatchNextEvent(timeout=0.01)
+    self.assertEqual([], self.dispatched)
+
+
+class BoundedEventHubTestCase(unittest.TestCase):
+  def setUp(self):
+    self.hub = kbevent.EventHub(capacity=2)
+    self.dispatched = []
+    for cls in kbevent.EVENT_NAME_TO_CLASS.values():
+      self.hub.Subscribe(cls, self.dispatched.append)
+
+  def _Thermo(self, sensor_name, value):
+    ev = kbevent.ThermoEvent()
+    ev.sensor_name = sensor_name
+    ev.sensor_value = value
+    return ev
+
+  def testDropWhenFull(self):
+    for i in range(3):
+      self.hub.PublishEvent(kbevent.HeartbeatSecondEvent())
+    stats = self.hub.GetStats()
+    self.assertEqual(2, stats['queued'])
+    self.assertEqual({'HeartbeatSecondEvent': 1}, stats['dropped'])
+    self.assertEqual(2, self.hub.Flush())
+
+  def testCoalesceWhenFull(self):
+    self.hub.PublishEvent(self._Thermo('t0', 1.0))
+    self.hub.PublishEvent(self._Thermo('t1', 2.0))
+    latest = self._Thermo('t0', 3.0)
+    self.hub.PublishEvent(latest)
+    self.hub.PublishEvent(self._Thermo('t2', 4.0))
+
+    stats = self.hub.GetStats()
+    self.assertEqual({'ThermoEvent': 1}, stats['coalesced'])
+    self.assertEqual({'ThermoEvent': 1}, stats['dropped'])
+
+    self.hub.Flush()
+    self.assertEqual([3.0, 2.0], [e.sensor_value for e in self.dispatched])
+
+  def testNeverDrop(self):
+    for i in range(2):
+      self.hub.PublishEvent(kbevent.HeartbeatSecondEvent())
+    auth = kbevent.TokenAuthEvent()
+    self.hub.PublishEvent(auth)
+    self.assertEqual(3, self.hub.GetStats()['queued'])
+    self.hub.Flush()
+    self.assertIs(auth, self.dispatched[0])
+
+  def testBlockingPolicyAdmittedFromDispatcher(self):
+    published = []
+    def Republish(event):
+      for i in range(3):
+        update = kbevent.FlowUpdate()
+        published.append(update)
+        self.hub.PublishEvent(update)
+    self.hub.Subscribe(kbevent.FlowRequest, Republish)
+
+    self.hub.PublishEvent(kbevent.FlowRequest())
+    self.hub.Flush()
+    self.assertEqual(published, self.dispatched[1:])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -18,37 +18,127 @@ import gflags
 
 from kegbot.util import app
 
+from . import cluster
 from . import kb_threads
 from . import kbevent
+from . import kegnet
 from . import manager
-from . import backend
+from . import offline
+from . import partition
+from . import replication
+from . import snapshot
+from . import startup
+from . import state_table
+from . import store
+from . import supervisor
+from . import tracing
+from .clock import SYSTEM_CLOCK
 
 FLAGS = gflags.FLAGS
 
 FLAGS.SetDefault('api_url', os.environ.get('KEGBOT_API_URL', 'http://localhost:8000/api/'))
 FLAGS.SetDefault('api_key', os.environ.get('KEGBOT_API_KEY', ''))
 
+gflags.register_multi_flags_validator(
+    ['cluster_node_id', 'replication_role'],
+    lambda flags: not (flags['cluster_node_id'] and
+        flags['replication_role'] != replication.ROLE_NONE),
+    message='--cluster_node_id and --replication_role cannot be combined.')
+
+def CoreConsumerGroup():
+  """Returns the consumer group in which the core reads the kegnet stream.
+
+  The core reads apart from the daemons listening for events.  Every member
+  of a cluster or active/standby pair must see every event, so each reads in
+  its own group.
+  """
+  group = FLAGS.redis_consumer_group or kegnet.CORE_CONSUMER_GROUP
+  if FLAGS.cluster_node_id:
+    return '%s.%s' % (group, FLAGS.cluster_node_id)
+  if FLAGS.replication_role != replication.ROLE_NONE:
+    return '%s.%s' % (group, FLAGS.replication_node_id)
+  return group
+
 class KegbotEnv(object):
   """ A class that wraps the context of the kegbot core.
 
   An instance of this class owns all the threads and services used in the kegbot
   core. It is commonly passed around to objects that the core creates.
+
+  If `ownership` is given, only events concerning controllers it owns are
+  handled (see the partition module).  Otherwise, with --cluster_node_id, the
+  controllers assigned to this core by the cluster are handled (see the cluster
+  module), and with --replication_role, this core is one of an active/standby
+  pair (see the replication module).
+
+  Events are read from the kegnet stream in `consumer_group`, which defaults
+  to CoreConsumerGroup().  It also names the queue of drinks an offline
+  backend keeps in the local store, `local_store`, which is opened from
+  --local_store_path if not given.
+
+  The managers and threads take the time from `clock`, which defaults to the
+  system clock (see the clock module).
   """
-  def __init__(self, backend_obj=None):
-    self._event_hub = kbevent.EventHub()
+  def __init__(self, backend_obj=None, ownership=None, clock=None,
+      consumer_group=None, local_store=None):
+    self._clock = clock or SYSTEM_CLOCK
+    self._event_hub = kbevent.EventHub(
+        trace_exporter=tracing.BuildExporter())
     self._logger = logging.getLogger('env')
 
+    if not ownership:
+      ownership = (cluster.BuildOwnership() or replication.BuildOwnership() or
+          partition.OwnEverything())
+    self._ownership = ownership
+
+    self._consumer_group = consumer_group or CoreConsumerGroup()
+
+    if not local_store and FLAGS.local_store_path:
+      local_store = store.LocalStore(FLAGS.local_store_path)
+    self._local_store = local_store
+
     if not backend_obj:
-      backend_obj = backend.WebBackend()
+      backend_obj = offline.BuildWebBackend(local_store=self._local_store,
+          queue_name=self._consumer_group)
     self._backend = backend_obj
 
+    self._state_table = None
+    if FLAGS.state_table_path:
+      self._state_table = state_table.StateTable(FLAGS.state_table_path,
+          slots=FLAGS.state_table_slots)
+
     # Build managers
-    self._tap_manager = manager.TapManager(self._event_hub, self._backend)
-    self._flow_manager = manager.FlowManager(self._event_hub, self._tap_manager)
+    self._tap_manager = manager.TapManager(self._event_hub, self._backend,
+        ownership=self._ownership)
+    self._flow_manager = manager.FlowManager(self._event_hub, self._tap_manager,
+        state_table=self._state_table, clock=self._clock)
     self._authentication_manager = manager.AuthenticationManager(
-        self._event_hub, self._flow_manager, self._tap_manager, self._backend)
-    self._drink_manager = manager.DrinkManager(self._event_hub, self._backend)
-    self._thermo_manager = manager.ThermoManager(self._event_hub, self._backend)
+        self._event_hub, self._flow_manager, self._tap_manager, self._backend,
+        clock=self._clock)
+    self._drink_manager = manager.DrinkManager(self._event_hub, self._backend,
+        store=self._local_store, clock=self._clock)
+    self._thermo_manager = manager.ThermoManager(self._event_hub, self._backend,
+        store=self._local_store, clock=self._clock)
+    self._cluster_manager = None
+    if isinstance(ownership, cluster.ClusterOwnership):
+      self._cluster_manager = manager.ClusterManager(self._event_hub,
+          self._flow_manager, ownership)
+      self._cluster_manager.Refresh()
+    self._replication_manager = None
+    if isinstance(ownership, replication.ReplicaOwnership):
+      self._replication_manager = manager.ReplicationManager(self._event_hub,
+          self._flow_manager, self._authentication_manager, ownership,
+          kegnet.KegnetClient(), FLAGS.replication_node_id,
+          failover_seconds=FLAGS.replication_failover_seconds,
+          clock=self._clock)
+    self._snapshot_manager = None
+    if FLAGS.snapshot_path:
+      self._snapshot_manager = manager.SnapshotManager(self._event_hub,
+          self._flow_manager, self._authentication_manager,
+          snapshot.SnapshotFile(FLAGS.snapshot_path),
+          interval=FLAGS.snapshot_interval,
+          sync_interval=FLAGS.snapshot_sync_interval, clock=self._clock)
+      self._snapshot_manager.Restore(max_age=FLAGS.snapshot_max_age)
 
     self._AttachListeners()
 
@@ -63,8 +153,15 @@ class KegbotEnv(object):
     self.AddThread(self._watchdog_thread)
 
   def _AllManagers(self):
-    return (self._tap_manager, self._flow_manager, self._drink_manager,
-        self._thermo_manager, self._authentication_manager)
+    ret = [self._tap_manager, self._flow_manager, self._drink_manager,
+        self._thermo_manager, self._authentication_manager]
+    if self._snapshot_manager:
+      ret.append(self._snapshot_manager)
+    if self._cluster_manager:
+      ret.append(self._cluster_manager)
+    if self._replication_manager:
+      ret.append(self._replication_manager)
+    return ret
 
   def _AttachListeners(self):
     for mgr in self._AllManagers():
@@ -81,6 +178,18 @@ class KegbotEnv(object):
   def GetBackend(self):
     return self._backend
 
+  def GetClock(self):
+    return self._clock
+
+  def GetConsumerGroup(self):
+    return self._consumer_group
+
+  def GetOwnership(self):
+    return self._ownership
+
+  def GetLocalStore(self):
+    return self._local_store
+
   def GetEventHub(self):
     return self._event_hub
 
@@ -105,9 +214,20 @@ class KegbotCoreApp(app.App):
   def __init__(self, name='core'):
     app.App.__init__(self, name)
     self._logger.info('Kegbot is starting up.')
-    self._env = KegbotEnv()
+    self._env = None
+    self._supervisor = None
+    if FLAGS.core_workers:
+      self._logger.info('Running as supervisor of %d workers.' %
+          FLAGS.core_workers)
+      self._supervisor = supervisor.Supervisor(FLAGS.core_workers, KegbotEnv)
+    else:
+      self._env = KegbotEnv()
 
   def _MainLoop(self):
+    startup.LogStartupReport(self._logger)
+    if self._supervisor:
+      self._SupervisorMainLoop()
+      return
     watchdog = self._env.GetWatchdogThread()
     while not self._do_quit:
       try:
@@ -121,16 +241,32 @@ class KegbotCoreApp(app.App):
         self.Quit()
         return
 
+  def _SupervisorMainLoop(self):
+    while not self._do_quit:
+      try:
+        self._supervisor.CheckWorkers()
+        time.sleep(0.5)
+      except KeyboardInterrupt:
+        self._logger.info("Got keyboard interrupt, quitting")
+        self.Quit()
+        return
+
   def _Setup(self):
     app.App._Setup(self)
+    if self._supervisor:
+      self._supervisor.Start()
+      return
     for thr in self._env.GetThreads():
       self._AddAppThread(thr)
     self._env.GetEventHub().PublishEvent(kbevent.StartedEvent())
 
   def Quit(self):
     self._do_quit = True
-    event = kbevent.QuitEvent()
-    self._env.GetEventHub().PublishEvent(event)
-    time.sleep(0.5)
+    if self._supervisor:
+      self._supervisor.Stop()
+    else:
+      event = kbevent.QuitEvent()
+      self._env.GetEventHub().PublishEvent(event)
+      time.sleep(0.5)
     self._logger.info('Kegbot stopped.')
 
@@ -1,4 +1,23 @@
-"""Kegnet client/server implementation."""
+"""Kegnet client/server implementation.
+
+Events are carried over Redis, using one of two transports selected by
+--kegnet_transport:
+
+  pubsub:  Events are PUBLISHed on --redis_channel_name.  Events published while
+           no listener is subscribed are lost.  The core also subscribes to
+           a presence channel, --redis_channel_name plus ".core", so that a
+           publisher can tell whether a core, rather than only a daemon such
+           as the LCD daemon, received its events (see `require_core`).
+  streams: Events are appended with XADD to a stream named
+           --redis_channel_name, capped at about --redis_stream_maxlen entries.
+           Listeners read with XREADGROUP, each program in its own consumer
+           group (--redis_consumer_group, by default the program name; the
+           core uses "pycore"), and acknowledge each batch once handled.
+           Unacknowledged entries are read again when a listener restarts
+           or reconnects, and entries added meanwhile are not missed.  A
+           group created on first read starts at the beginning of the
+           stream, so entries added before the listener started are read.
+"""
 
 # TODO(mikey): need to isolate internal-only events (like QuitEvent) from
 # external ones (like FlowUpdate).
@@ -8,28 +27,95 @@ from builtins import object
 import os
 import gflags
 import logging
+import socket
+import sys
 import time
 
-import redis
-
 from kegbot.util import util
 
 from . import kbevent
+from . import tracing
 
 FLAGS = gflags.FLAGS
 
+# Default consumer group of the core.
+CORE_CONSUMER_GROUP = 'pycore'
+
 gflags.DEFINE_string('redis_url', os.getenv('KEGBOT_REDIS_URL', 'redis://localhost:6379/0'),
     'URL of the Redis service.')
 
 gflags.DEFINE_string('redis_channel_name', 'kegnet',
-    'Pub/sub channel name.')
+    'Pub/sub channel name, or stream name with --kegnet_transport=streams.')
+
+gflags.DEFINE_enum('kegnet_transport', 'pubsub', ['pubsub', 'streams'],
+    'Redis transport used for kegnet events.')
+
+gflags.DEFINE_integer('redis_stream_maxlen', 10000,
+    'Approximate maximum number of entries kept in the kegnet stream.',
+    lower_bound=1)
+
+gflags.DEFINE_string('redis_consumer_group', '',
+    'Consumer group used to read the kegnet stream.  Each program which '
+    'listens for events needs its own group.  Defaults to "%s" in the core, '
+    'and to the program name elsewhere.' % CORE_CONSUMER_GROUP)
+
+gflags.DEFINE_string('redis_group_start_id', '$',
+    'Stream entry id after which a new consumer group starts reading.  The '
+    'default, "$", skips entries already in the stream, which may be hours '
+    'old; "0" reads every entry still retained.')
+
+gflags.DEFINE_string('redis_consumer_name', socket.gethostname(),
+    'Consumer name used to read the kegnet stream.  Must be stable across '
+    'restarts, so unacknowledged entries are read again.')
+
+# Maximum number of stream entries read at once.
+STREAM_READ_COUNT = 100
+
+# Milliseconds a stream read blocks waiting for new entries.
+STREAM_BLOCK_MS = 1000
+
+def _redis():
+  """Returns the redis module, importing it on first use.
+
+  redis is slow to import, so it is kept off the core's startup path until a
+  client is built.
+  """
+  import redis
+  return redis
+
+def DefaultConsumerGroup():
+  """Returns --redis_consumer_group, or else the name of this program."""
+  return FLAGS.redis_consumer_group or \
+      os.path.basename(sys.argv[0]).replace('.py', '')
 
 class KegnetClient(object):
-  def __init__(self, redis_url=None, channel_name=None):
+  """Client of the kegnet bus.
+
+  With the streams transport, events are read in `consumer_group`, by default
+  DefaultConsumerGroup().
+
+  With the pubsub transport, a client with `core` set listens on the core
+  presence channel too.  A client with `require_core` set counts a message as
+  received only if a core is subscribed when it is published.
+  """
+  def __init__(self, redis_url=None, channel_name=None, transport=None,
+      redis_client=None, consumer_group=None, core=False,
+      require_core=False, group_start_id=None):
     redis_url = redis_url or FLAGS.redis_url
     channel_name = channel_name or FLAGS.redis_channel_name
-    self._redis = redis.from_url(redis_url)
+    self._transport = transport or FLAGS.kegnet_transport
+    if redis_client is None:
+      redis_client = _redis().from_url(redis_url)
+    self._redis = redis_client
     self._channel_name = channel_name
+    self._consumer_group = consumer_group or DefaultConsumerGroup()
+    self._group_start_id = group_start_id or FLAGS.redis_group_start_id
+    self._core = core
+    self._require_core = require_core
+    self._stream_read_id = '0'
+    # Id of the last stream entry handled, from which the consumer group is
+    # recreated if it disappears.
+    self._last_entry_id = None
     self._logger = logging.getLogger('kegnet')
     self._logger.info('Connecting to redis at {} '.format(redis_url))
 
@@ -37,15 +123,80 @@ class KegnetClient(object):
     """Tests the liveness of the redis connection."""
     try:
       return self._redis.ping()
-    except redis.exceptions.ConnectionError as e:
+    except _redis().exceptions.ConnectionError as e:
       return False
 
   def send_message(self, message):
+    """Publishes `message`.
+
+    Returns True if it was received by at least one listener (with
+    `require_core`, by a running core), or with the streams transport, if it
+    was added to the stream.  Otherwise False is returned; the message may
+    still have been received by other listeners.
+
+    With --trace_sample_rate, a trace is started on some messages (see the
+    tracing module).
+    """
+    self._MaybeTrace(message)
+    return self._publish(message.ToJson())
+
+  def send_messages(self, messages):
+    """Publishes `messages` in one round trip.
+
+    Returns the number of leading messages received, as for send_message.
+    """
+    for message in messages:
+      self._MaybeTrace(message)
+    return self._publish_many([m.ToJson() for m in messages])
+
+  def _MaybeTrace(self, message):
+    if message.GetTrace() is None:
+      if tracing.ShouldSample():
+        message.SetTrace(tracing.Trace.Start())
+    else:
+      message.AddTraceHop(tracing.HOP_SEND)
+
+  def _publish(self, data):
+    """Publishes encoded event `data`; see send_message."""
+    return self._publish_many([data]) == 1
+
+  def _CoreChannel(self):
+    """Returns the name of the core presence channel."""
+    return '%s.core' % self._channel_name
+
+  def _publish_many(self, datas):
+    """Publishes encoded events `datas`; see send_messages."""
+    redis = _redis()
+    check_core = self._require_core and self._transport != 'streams'
     try:
-      self._redis.publish(self._channel_name, message.ToJson())
-    except redis.exceptions.ConnectionError as e:
-      self._logger.error('Connection unavailable, dropping message: %s' % message)
+      pipe = self._redis.pipeline(transaction=False)
+      if check_core:
+        pipe.pubsub_numsub(self._CoreChannel())
+      for data in datas:
+        if self._transport == 'streams':
+          pipe.xadd(self._channel_name, {'data': data},
+              maxlen=FLAGS.redis_stream_maxlen, approximate=True)
+        else:
+          pipe.publish(self._channel_name, data)
+      results = pipe.execute()
+    except (redis.exceptions.ConnectionError,
+        redis.exceptions.TimeoutError) as e:
+      self._logger.error('Connection unavailable, %d message(s) not sent' %
+          len(datas))
       self._logger.debug('Exception was: %s' % e)
+      return 0
+    if self._transport == 'streams':
+      return len(results)
+    if check_core:
+      numsub = results.pop(0)
+      if not numsub or not numsub[0][1]:
+        return 0
+    count = 0
+    for receivers in results:
+      if not receivers:
+        break
+      count += 1
+    return count
 
   ### convenience functions
   def SendControllerConnectedEvent(self, controller_name):
@@ -94,28 +245,104 @@ class KegnetClient(object):
     return self.send_message(message)
 
   def Listen(self):
+    if self._transport == 'streams':
+      self._ListenStream()
+      return
     while True:
       try:
         ps = self._redis.pubsub()
-        ps.subscribe([self._channel_name])
+        channels = [self._channel_name]
+        if self._core:
+          channels.append(self._CoreChannel())
+        ps.subscribe(channels)
         self._logger.info('Listening on redis channel "%s"' % self._channel_name)
 
         for message in ps.listen():
           self._handle_message(message)
-      except redis.exceptions.ConnectionError as e:
+      except _redis().exceptions.ConnectionError as e:
         self._logger.warning('Error listening: %s' % e)
         time.sleep(5)
 
+  def GetConsumerGroup(self):
+    return self._consumer_group
+
+  def _ListenStream(self):
+    self._logger.info('Reading redis stream "%s" as %s/%s' % (
+        self._channel_name, self._consumer_group, FLAGS.redis_consumer_name))
+    while True:
+      try:
+        self._ReadStream()
+      except _redis().exceptions.ConnectionError as e:
+        self._logger.warning('Error reading stream: %s' % e)
+        # Entries delivered but not acknowledged are read again.
+        self._stream_read_id = '0'
+        time.sleep(5)
+
+  def _EnsureConsumerGroup(self):
+    """Creates the consumer group if missing.
+
+    A new group starts after --redis_group_start_id, by default at the end of
+    the stream, so a new program (or core worker, or cluster node) does not
+    act on stale events such as old auth token additions.  If the group
+    disappears later, it is recreated after the last entry handled.
+    """
+    try:
+      self._redis.xgroup_create(self._channel_name, self._consumer_group,
+          id=self._last_entry_id or self._group_start_id, mkstream=True)
+    except _redis().exceptions.ResponseError as e:
+      if 'BUSYGROUP' not in str(e):
+        raise
+
+  def _ReadStream(self, block_ms=STREAM_BLOCK_MS):
+    """Reads, handles and acknowledges one batch of stream entries.
+
+    Entries delivered to this consumer but never acknowledged, for example
+    because the process died, are read first.  Returns the number of entries
+    read.
+    """
+    group = self._consumer_group
+    pending = self._stream_read_id != '>'
+    try:
+      response = self._redis.xreadgroup(group, FLAGS.redis_consumer_name,
+          {self._channel_name: self._stream_read_id}, count=STREAM_READ_COUNT,
+          block=None if pending else block_ms)
+    except _redis().exceptions.ResponseError as e:
+      if 'NOGROUP' not in str(e):
+        raise
+      self._EnsureConsumerGroup()
+      return 0
+
+    entries = response[0][1] if response else []
+    if pending and not entries:
+      self._stream_read_id = '>'
+      return 0
+    if pending:
+      # Continue after the last pending entry.
+      self._stream_read_id = entries[-1][0]
+
+    for entry_id, fields in entries:
+      # Entries trimmed from the stream while pending have no fields.
+      data = (fields or {}).get(b'data')
+      if data is not None:
+        self._handle_message({'type': 'message', 'data': data})
+    if entries:
+      self._redis.xack(self._channel_name, group,
+          *[entry_id for entry_id, fields in entries])
+      self._last_entry_id = entries[-1][0]
+    return len(entries)
+
   def _handle_message(self, message):
       if message['type'] != 'message':
         return
       data = message['data']
 
-      try:
-        event = kbevent.DecodeEvent(data)
-      except ValueError:
+      event_cls = kbevent.PeekEventClass(data)
+      if event_cls is None:
         # Forward-compatibility: Ignore unknown events.
         return
+      if not self.wantsEvent(event_cls):
+        return
+      event = kbevent.LazyDecodeEvent(data, event_cls)
 
       self.onNewEvent(event)
       if isinstance(event, kbevent.FlowUpdate):
@@ -125,6 +352,14 @@ class KegnetClient(object):
       elif isinstance(event, kbevent.SetRelayOutputEvent):
         self.onSetRelayOutput(event)
 
+  def wantsEvent(self, event_cls):
+    """Returns whether events of `event_cls` should be handled at all.
+
+    Messages for unwanted classes are discarded without being decoded.
+    Override this method to filter events in your client.
+    """
+    return True
+
   def onNewEvent(self, event):
     """Method called whenever a new event is received.
 
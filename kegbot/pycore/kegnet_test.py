@@ -0,0 +1,258 @@
+"""Unittest for kegnet module"""
+
+import sys
+import unittest
+
+from . import kbevent
+from . import kegnet
+
+class RecordingClient(kegnet.KegnetClient):
+  def __init__(self, wanted, consumer_group=None, group_start_id=None):
+    super(RecordingClient, self).__init__(redis_url='redis://localhost:6379/0',
+        consumer_group=consumer_group, group_start_id=group_start_id)
+    self.wanted = wanted
+    self.received = []
+
+  def wantsEvent(self, event_cls):
+    return event_cls in self.wanted
+
+  def onNewEvent(self, event):
+    self.received.append(event)
+
+
+class KegnetClientTestCase(unittest.TestCase):
+  def _Message(self, event):
+    return {'type': 'message', 'data': event.ToJson().encode('utf-8')}
+
+  def testHandleMessage(self):
+    client = RecordingClient(wanted=(kbevent.ThermoEvent,))
+
+    thermo = kbevent.ThermoEvent()
+    thermo.sensor_name = 'sensor0'
+    thermo.sensor_value = 4.5
+    client._handle_message(self._Message(thermo))
+    client._handle_message(self._Message(kbevent.MeterUpdate()))
+    client._handle_message({'type': 'subscribe', 'data': 1})
+    client._handle_message({'type': 'message', 'data': b'{"event": "Nope"}'})
+
+    self.assertEqual(1, len(client.received))
+    event = client.received[0]
+    self.assertIsInstance(event, kbevent.ThermoEvent)
+    self.assertEqual('sensor0', event.sensor_name)
+    self.assertEqual(4.5, event.sensor_value)
+
+class FakeStreamRedis(object):
+  """In-process stand-in for the Redis stream commands used by kegnet."""
+  def __init__(self):
+    self.entries = []  # list of (id, fields)
+    self.groups = {}  # group name to last delivered index
+    self.pending = {}  # (group, consumer) to list of ids
+    self.next_id = 1
+
+  def pipeline(self, transaction=True):
+    return FakePipeline(self)
+
+  def xadd(self, name, fields, maxlen=None, approximate=True):
+    entry_id = ('%d-0' % self.next_id).encode('ascii')
+    self.next_id += 1
+    fields = dict((k.encode('utf-8'), v.encode('utf-8'))
+        for k, v in fields.items())
+    self.entries.append((entry_id, fields))
+    if maxlen is not None:
+      del self.entries[:-maxlen]
+    return entry_id
+
+  def xgroup_create(self, name, groupname, id='$', mkstream=False):
+    import redis
+    if groupname in self.groups:
+      raise redis.exceptions.ResponseError('BUSYGROUP Consumer Group name '
+          'already exists')
+    if id == '$':
+      self.groups[groupname] = self.next_id - 1
+    else:
+      if isinstance(id, bytes):
+        id = id.decode('ascii')
+      self.groups[groupname] = int(id.split('-')[0])
+
+  def xreadgroup(self, groupname, consumername, streams, count=None,
+      block=None):
+    import redis
+    if groupname not in self.groups:
+      raise redis.exceptions.ResponseError('NOGROUP No such consumer group')
+    stream_name, read_id = list(streams.items())[0]
+    pending = self.pending.setdefault((groupname, consumername), [])
+    entries = dict(self.entries)
+    if read_id == '>':
+      new = [(i, f) for i, f in self.entries
+          if int(i.split(b'-')[0]) > self.groups[groupname]][:count]
+      if new:
+        self.groups[groupname] = int(new[-1][0].split(b'-')[0])
+      pending += [i for i, f in new]
+      result = new
+    else:
+      after = 0 if read_id == '0' else int(read_id.split(b'-')[0])
+      result = [(i, entries.get(i)) for i in pending
+          if int(i.split(b'-')[0]) > after][:count]
+    if not result:
+      return []
+    return [[stream_name.encode('utf-8'), result]]
+
+  def xack(self, name, groupname, *ids):
+    for pending in self.pending.values():
+      for entry_id in ids:
+        if entry_id in pending:
+          pending.remove(entry_id)
+    return len(ids)
+
+
+class FakePipeline(object):
+  def __init__(self, redis):
+    self._redis = redis
+    self._calls = []
+
+  def __getattr__(self, name):
+    def call(*args, **kwargs):
+      self._calls.append((getattr(self._redis, name), args, kwargs))
+    return call
+
+  def execute(self):
+    return [f(*args, **kwargs) for f, args, kwargs in self._calls]
+
+
+class FakePubsubRedis(object):
+  """In-process stand-in for the Redis pub/sub commands used by kegnet."""
+  def __init__(self):
+    self.subscribers = {}  # channel name to number of subscribers
+
+  def pipeline(self, transaction=True):
+    return FakePipeline(self)
+
+  def publish(self, channel, data):
+    return self.subscribers.get(channel, 0)
+
+  def pubsub_numsub(self, *channels):
+    return [(c.encode('utf-8'), self.subscribers.get(c, 0)) for c in channels]
+
+
+class PubsubTransportTestCase(unittest.TestCase):
+  def testRequireCore(self):
+    redis = FakePubsubRedis()
+    client = kegnet.KegnetClient(channel_name='kegnet', transport='pubsub',
+        redis_client=redis)
+    publisher = kegnet.KegnetClient(channel_name='kegnet', transport='pubsub',
+        redis_client=redis, require_core=True)
+    update = kbevent.MeterUpdate(meter_name='flow0', reading=1)
+
+    # Only the LCD daemon is listening.
+    redis.subscribers['kegnet'] = 1
+    self.assertTrue(client.send_message(update))
+    self.assertFalse(publisher.send_message(update))
+
+    # The core is listening too.
+    redis.subscribers['kegnet'] = 2
+    redis.subscribers['kegnet.core'] = 1
+    self.assertTrue(publisher.send_message(update))
+    self.assertEqual(2, publisher.send_messages([update, update]))
+
+
+class StreamTransportTestCase(unittest.TestCase):
+  def setUp(self):
+    self.redis = FakeStreamRedis()
+
+  def _Client(self, wanted=(kbevent.ThermoEvent,), consumer_group='pycore',
+      group_start_id=None):
+    client = RecordingClient(wanted=wanted, consumer_group=consumer_group,
+        group_start_id=group_start_id)
+    client._transport = 'streams'
+    client._redis = self.redis
+    return client
+
+  def _Thermo(self, value):
+    event = kbevent.ThermoEvent()
+    event.sensor_name = 'sensor0'
+    event.sensor_value = value
+    return event
+
+  def testPublishAndRead(self):
+    listener = self._Client()
+    self.assertEqual(0, listener._ReadStream())  # Creates the group.
+    self.assertEqual(0, listener._ReadStream())  # No pending entries.
+
+    sender = self._Client()
+    self.assertEqual(3, sender.send_messages(
+        [self._Thermo(1.0), kbevent.MeterUpdate(), self._Thermo(2.0)]))
+    self.assertEqual(3, listener._ReadStream())
+    self.assertEqual([1.0, 2.0], [e.sensor_value for e in listener.received])
+    self.assertEqual([[]], list(self.redis.pending.values()))
+
+  def testUnacknowledgedEntriesReadAfterRestart(self):
+    listener = self._Client()
+    listener._ReadStream()
+    sender = self._Client()
+    sender.send_message(self._Thermo(1.0))
+
+    # The listener reads an entry, then dies before acknowledging it.
+    self.redis.xreadgroup('pycore', kegnet.FLAGS.redis_consumer_name, {'kegnet': '>'}, count=10)
+    sender.send_message(self._Thermo(2.0))
+
+    restarted = self._Client()
+    self.assertEqual(1, restarted._ReadStream())
+    self.assertEqual(0, restarted._ReadStream())
+    self.assertEqual(1, restarted._ReadStream())
+    self.assertEqual([1.0, 2.0], [e.sensor_value for e in restarted.received])
+
+  def testEntriesAddedBeforeFirstRead(self):
+    sender = self._Client()
+    sender.send_message(self._Thermo(1.0))
+
+    # Skipped by a new group, by default.
+    listener = self._Client()
+    for i in range(3):
+      listener._ReadStream()
+    self.assertEqual([], listener.received)
+
+    listener = self._Client(consumer_group='lcd_daemon', group_start_id='0')
+    listener._ReadStream()  # Creates the group.
+    listener._ReadStream()  # No pending entries.
+    self.assertEqual(1, listener._ReadStream())
+    self.assertEqual([1.0], [e.sensor_value for e in listener.received])
+
+  def testGroupRecreatedAfterLastEntry(self):
+    listener = self._Client()
+    listener._ReadStream()
+    sender = self._Client()
+    sender.send_message(self._Thermo(1.0))
+    listener._ReadStream()
+    listener._ReadStream()
+
+    # The group is deleted, and an entry is added before it is recreated.
+    del self.redis.groups['pycore']
+    sender.send_message(self._Thermo(2.0))
+    self.assertEqual(0, listener._ReadStream())
+    listener._ReadStream()
+    self.assertEqual([1.0, 2.0], [e.sensor_value for e in listener.received])
+
+  def testProgramsReadInSeparateGroups(self):
+    core = self._Client()
+    lcd = self._Client(consumer_group='lcd_daemon')
+    for client in (core, lcd):
+      client._ReadStream()  # Creates the group.
+      client._ReadStream()  # No pending entries.
+    sender = self._Client()
+    sender.send_messages([self._Thermo(1.0), self._Thermo(2.0)])
+    for client in (core, lcd):
+      client._ReadStream()
+    self.assertEqual([1.0, 2.0], [e.sensor_value for e in core.received])
+    self.assertEqual([1.0, 2.0], [e.sensor_value for e in lcd.received])
+
+  def testDefaultConsumerGroup(self):
+    argv = sys.argv
+    sys.argv = ['/usr/local/bin/lcd_daemon.py']
+    try:
+      self.assertEqual('lcd_daemon', kegnet.DefaultConsumerGroup())
+    finally:
+      sys.argv = argv
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,13 +2,10 @@
 
 from __future__ import absolute_import
 
-from past.builtins import cmp
 from builtins import object
 import datetime
 import gflags
 import inspect
-import requests
-import time
 import threading
 import logging
 
@@ -16,9 +13,14 @@ from . import backend
 from . import common_defs
 from . import kbevent
 from . import kegnet
+from . import relay
+from . import replication
+from .clock import SYSTEM_CLOCK
 from .flow import Flow
 from .flow_meter import FlowMeter
 from .tap import Tap
+from .thermo import AnomalyDetector
+from .thermo import SensorWindow
 
 from kegbot.api import kbapi
 from kegbot.util import util
@@ -33,6 +35,10 @@ gflags.DEFINE_integer('maximum_event_retries', 3,
     'Maximum number of times to retry posting updates to the backend.',
     lower_bound=0)
 
+gflags.DEFINE_boolean('coalesce_meter_updates', True,
+    'If true, meter updates still waiting for dispatch are merged into a '
+    'single update per meter.')
+
 def EventHandler(event_type):
   def decorate(f):
     if not hasattr(f, 'events'):
@@ -73,14 +79,19 @@ class TapManager(Manager):
   taps.
   """
 
-  def __init__(self, event_hub, backend_obj):
+  def __init__(self, event_hub, backend_obj, ownership=None):
     super(TapManager, self).__init__(event_hub)
     self._backend = backend_obj
+    self._ownership = ownership
     self._taps = {}
 
   def GetAllTaps(self):
     return list(self._taps.values())
 
+  def OwnsMeter(self, meter_name):
+    """Returns whether this core handles flows on `meter_name`."""
+    return not self._ownership or self._ownership.OwnsMeter(meter_name)
+
   def _RegisterOrUpdateTap(self, name, ml_per_tick, relay_name=None):
     existing = self._taps.get(name)
     new_tap = Tap(name, ml_per_tick, relay_name)
@@ -117,14 +128,22 @@ class TapManager(Manager):
 
 class FlowManager(Manager):
   """Class reponsible for maintaining and servicing flows."""
-  def __init__(self, event_hub, tap_manager):
+  def __init__(self, event_hub, tap_manager, state_table=None,
+      relay_controller=None, clock=SYSTEM_CLOCK):
     super(FlowManager, self).__init__(event_hub)
     self._tap_manager = tap_manager
+    self._state_table = state_table
+    self._clock = clock
+    if relay_controller is None:
+      relay_controller = relay.RelayController(self._PublishEvent, clock=clock)
+    self._relay_controller = relay_controller
     self._meters = {}
     self._flow_map = {}
     self._logger = logging.getLogger("flowmanager")
-    self._next_flow_id = int(time.time())
+    self._next_flow_id = int(clock())
     self._lock = threading.Lock()
+    if FLAGS.coalesce_meter_updates:
+      event_hub.SetCoalescer(kbevent.MeterUpdate, self._CoalesceMeterUpdates)
 
   @util.synchronized
   def _GetNextFlowId(self):
@@ -140,13 +159,46 @@ class FlowManager(Manager):
   def GetMeter(self, meter_name):
     m = self._meters.get(meter_name)
     if not m:
-      m = FlowMeter(meter_name, 1000.0)
+      m = FlowMeter(meter_name, common_defs.FLOW_METER_MAX_DELTA)
       self._meters[meter_name] = m
     return m
 
   def GetActiveFlows(self):
     return list(self._flow_map.values())
 
+  @util.synchronized
+  def GetSnapshot(self):
+    """Returns the state of all meters and flows (see snapshot module)."""
+    meters = {}
+    for name, meter in self._meters.items():
+      meters[name] = [meter.GetLastReading(), meter.GetTicks()]
+    return {
+      'next_flow_id': self._next_flow_id,
+      'meters': meters,
+      'flows': [flow.GetSnapshot() for flow in self.GetActiveFlows()],
+    }
+
+  def RestoreSnapshot(self, snapshot):
+    """Restores state saved by GetSnapshot."""
+    with self._lock:
+      self._next_flow_id = max(self._next_flow_id, snapshot['next_flow_id'])
+    for name, (last_ticks, total_ticks) in snapshot['meters'].items():
+      self.GetMeter(name).Restore(last_ticks, total_ticks)
+    for flow_snapshot in snapshot['flows']:
+      flow = Flow.FromSnapshot(flow_snapshot, clock=self._clock)
+      self._logger.info('Restoring flow: %s' % flow)
+      self._flow_map[flow.GetMeterName()] = flow
+
+  def AbandonFlows(self):
+    """Forgets all flows and relays, without ending or recording them.
+
+    Used when another core has taken over the flows.
+    """
+    for flow in self.GetActiveFlows():
+      self._logger.info('Abandoning flow: %s' % flow)
+    self._flow_map.clear()
+    self._relay_controller.Reset()
+
   def IterIdleFlows(self, when=None):
     for flow in list(self._flow_map.values()):
       if flow.IsIdle(when):
@@ -155,13 +207,14 @@ class FlowManager(Manager):
   def GetFlow(self, tap_name):
     return self._flow_map.get(tap_name)
 
-  def StartFlow(self, meter_name, username='', max_idle_secs=10):
+  def StartFlow(self, meter_name, username='', max_idle_secs=10, when=None):
     """Starts a new flow on the given meter, or takes over the existing flow.
 
     Args
       meter_name: name of the meter producing the flow
       username: username to own the flow, or None/empty string for anonymous
       max_idle_secs: maximum number of seconds until the flow is marked idle
+      when: start time of a new flow (defaults to the clock's current time)
 
     Returns
       Tuple of (Flow, boolean is_new).
@@ -185,7 +238,7 @@ class FlowManager(Manager):
 
     # Start a new flow.
     new_flow = Flow(meter_name, flow_id=self._GetNextFlowId(), username=username,
-        max_idle_secs=max_idle_secs)
+        max_idle_secs=max_idle_secs, when=when, clock=self._clock)
     self._flow_map[meter_name] = new_flow
     self._logger.info('Starting flow: %s' % new_flow)
     self._PublishUpdate(new_flow)
@@ -212,13 +265,16 @@ class FlowManager(Manager):
     self._StateChange(flow, kbevent.FlowUpdate.FlowState.COMPLETED)
     return flow
 
-  def UpdateFlow(self, meter_name, meter_reading, when=None):
+  def UpdateFlow(self, meter_name, meter_reading, when=None,
+      base_reading=None):
     """Creates or updates a flow at `meter_name`.
 
     Args
       meter_name: name of the tap to update
       meter_reading: instantaneous meter reading
-      when: timestamp used for activity (defaults to datetime.now)
+      when: timestamp used for activity (defaults to the clock's current time)
+      base_reading: first reading of a run of coalesced readings ending at
+        `meter_reading`, if any (see FlowMeter.SetTicks)
 
     Returns
       Tuple of (flow, is_new).
@@ -226,17 +282,17 @@ class FlowManager(Manager):
     """
     meter = self.GetMeter(meter_name)
     tap = self._tap_manager.GetTap(meter_name)
-    delta = meter.SetTicks(meter_reading)
+    delta = meter.SetTicks(meter_reading, base_ticks=base_reading)
     self._logger.debug('Flow update: tap=%s meter_reading=%i (delta=%i)' %
         (meter_name, meter_reading, delta))
 
+    if when is None:
+      when = self._clock.Now()
     is_new = False
     flow = self.GetFlow(meter_name)
     if flow is None:
       self._logger.debug('Starting flow implicitly due to activity.')
-      flow, is_new = self.StartFlow(meter_name)
-    if when is None:
-      when = datetime.datetime.now()
+      flow, is_new = self.StartFlow(meter_name, when=when)
 
     flow.AddTicks(delta, when, tap)
     self._PublishUpdate(flow)
@@ -248,11 +304,35 @@ class FlowManager(Manager):
 
   def _PublishUpdate(self, flow):
     event = flow.GetUpdateEvent()
+    if self._state_table:
+      self._state_table.UpdateFlow(event)
     self._PublishEvent(event)
 
   @EventHandler(kbevent.MeterUpdate)
   def HandleFlowActivityEvent(self, event):
-    flow_instance, is_new = self.UpdateFlow(event.meter_name, event.reading)
+    flow_instance, is_new = self.UpdateFlow(event.meter_name, event.reading,
+        when=kbevent.GetEventTime(event),
+        base_reading=getattr(event, 'base_reading', None))
+
+  def _CoalesceMeterUpdates(self, queued, newer):
+    """Merges two queued readings of the same meter, if possible.
+
+    Readings are cumulative, so only the newest one needs dispatching.  The
+    first reading of the run is kept as `base_reading` so the step from the
+    meter's last reading can still be validated.  Runs are only extended by
+    steps the meter would itself accept; otherwise the readings are kept
+    apart so an invalid step is discarded exactly as it would be unmerged.
+    """
+    meter = self.GetMeter(newer.meter_name)
+    if not meter.IsValidDelta(int(newer.reading) - int(queued.reading)):
+      return None
+    merged = kbevent.MeterUpdate()
+    merged.meter_name = newer.meter_name
+    merged.reading = newer.reading
+    merged.when = newer.when
+    merged.base_reading = getattr(queued, 'base_reading', queued.reading)
+    merged.SetTrace(newer.GetTrace() or queued.GetTrace())
+    return merged
 
   @EventHandler(kbevent.HeartbeatSecondEvent)
   def _HandleHeartbeatEvent(self, event):
@@ -264,28 +344,28 @@ class FlowManager(Manager):
       else:
         if flow.GetUsername():
           self._PublishRelayEvent(flow, enable=True)
+    self._relay_controller.Renew()
 
   def _PublishRelayEvent(self, flow, enable=True):
-    self._logger.debug('Publishing relay event: flow=%s, enable=%s' % (flow,
-        enable))
+    """Sets the desired state of the relay of `flow`'s tap.
+
+    The RelayController only publishes a SetRelayOutputEvent if the relay
+    changes state.
+    """
+    self._logger.debug('Setting relay: flow=%s, enable=%s' % (flow, enable))
     tap = self._tap_manager.GetTap(flow.GetMeterName())
     if not tap:
       # Unknown meter; don't attempt to enable any relays for it
       # since we don't know its configuration.
       return
 
-    relay = tap.GetRelayName()
-    if not relay:
+    relay_name = tap.GetRelayName()
+    if not relay_name:
       self._logger.debug('No relay for this tap')
       return
 
-    self._logger.debug('Relay for this tap: %s' % relay)
-    if enable:
-      mode = kbevent.SetRelayOutputEvent.Mode.ENABLED
-    else:
-      mode = kbevent.SetRelayOutputEvent.Mode.DISABLED
-    ev = kbevent.SetRelayOutputEvent(output_name=relay, output_mode=mode)
-    self._PublishEvent(ev)
+    self._logger.debug('Relay for this tap: %s' % relay_name)
+    self._relay_controller.SetDesired(relay_name, enable)
 
   @EventHandler(kbevent.FlowRequest)
   def _HandleFlowRequestEvent(self, event):
@@ -296,31 +376,50 @@ class FlowManager(Manager):
 
 
 class DrinkManager(Manager):
-  def __init__(self, event_hub, backend_obj):
+  def __init__(self, event_hub, backend_obj, store=None, clock=SYSTEM_CLOCK):
     super(DrinkManager, self).__init__(event_hub)
     self._backend = backend_obj
+    self._store = store
+    self._clock = clock
     self._pending = []
     self._last_flush_time = 0
+    backend_obj.SetDrinkRecordedCallback(self._QueuedDrinkRecorded)
 
   @EventHandler(kbevent.FlowUpdate)
   def HandleFlowUpdateEvent(self, event):
     """Attempt to save a drink record and derived data for |flow|"""
     if event.state == event.FlowState.COMPLETED:
       self._logger.info('Flow completed: flow_id=0x%08x' % event.flow_id)
+      if self._store and self._ShouldRecord(event):
+        self._store.AddDrink(event.flow_id, event.meter_name, event.ticks,
+            event.volume_ml, event.username, event.start_time,
+            event.last_activity_time)
       self._pending.append(event)
       self._FlushPending()
 
+  def _ShouldRecord(self, event):
+    """Returns whether the completed flow `event` is worth a drink."""
+    volume_ml = event.volume_ml
+    if volume_ml is not None and volume_ml < common_defs.MIN_VOLUME_TO_RECORD:
+      self._logger.info('Not recording flow: (%i mL) <= '
+          'MIN_VOLUME_TO_RECORD (%i)' % (volume_ml, common_defs.MIN_VOLUME_TO_RECORD))
+      return False
+    if event.ticks <= 0:
+      self._logger.info('Not recording flow: no ticks.')
+      return False
+    return True
+
   @EventHandler(kbevent.HeartbeatSecondEvent)
   def _HandleHeartbeat(self, event):
     if not self._pending:
       return
 
-    need_flush = abs(time.time() - self._last_flush_time) > FLAGS.retry_interval
+    need_flush = abs(self._clock() - self._last_flush_time) > FLAGS.retry_interval
     if need_flush:
       self._FlushPending()
 
   def _FlushPending(self):
-    self._last_flush_time = time.time()
+    self._last_flush_time = self._clock()
 
     if not self._pending:
       return
@@ -330,11 +429,37 @@ class DrinkManager(Manager):
 
     self._logger.info('Posting %s pending event(s)' % len(pending))
 
+    events = []
     for event in pending:
+      self._logger.info('Processing pending drink: flow_id=0x%08x, meter=%s, volume=%s' % (
+        event.flow_id, event.meter_name, event.volume_ml))
+      if self._ShouldRecord(event):
+        events.append(event)
+
+    # Log the drinks in one batch.  If the username is empty or invalid, the
+    # backend will assign it to the default (anonymous) user.  The backend will
+    # assign each drink to a keg.
+    if events:
       try:
-        self._PostDrink(event)
+        results = self._backend.RecordDrinks(
+            [self._GetDrinkRequest(event) for event in events])
       except backend.BackendException as e:
-        self._logger.warning('Error posting drink: %s' % e)
+        results = [e] * len(events)
+    else:
+      results = []
+
+    for event, result in zip(events, results):
+      if isinstance(result, backend.BackendUnavailableException):
+        # The drink was not attempted, so does not use up a retry.
+        self._logger.info('Not posting drink yet: %s' % result)
+        self._pending.append(event)
+      elif isinstance(result, backend.DoesNotExistException):
+        self._logger.info('No drink recorded: %s' % result)
+      elif isinstance(result, backend.DrinkQueued):
+        self._logger.info('Drink queued until the backend is reachable: '
+            'flow_id=0x%08x' % event.flow_id)
+      elif isinstance(result, Exception):
+        self._logger.warning('Error posting drink: %s' % result)
 
         # Retry posting the event a finite number of times.
         # TODO(mikey): Some events can be considered fatal immediately.
@@ -349,48 +474,46 @@ class DrinkManager(Manager):
           self._pending.append(event)
         else:
           self._logger.warning('Max retries exceeded; dropping event.')
+      elif not result:
+        self._logger.warning('No drink recorded.')
+      else:
+        self._DrinkRecorded(event.flow_id, event.meter_name, result)
 
-  def _PostDrink(self, event):
-    ticks = event.ticks
-    username = event.username
-    meter_name = event.meter_name
-    volume_ml = event.volume_ml
-    pour_time = event.last_activity_time
-    duration = (event.last_activity_time - event.start_time).seconds
-    flow_id = event.flow_id
+    if self._store:
+      self._store.Flush()
 
-    self._logger.info('Processing pending drink: flow_id=0x%08x, meter=%s, volume=%s' % (
-      event.flow_id, event.meter_name, volume_ml))
+  def _QueuedDrinkRecorded(self, drink, result):
+    """Called, possibly from another thread, when a queued drink is recorded."""
+    if not result:
+      self._logger.warning('No drink recorded for queued drink.')
+      return
+    self._DrinkRecorded(drink.get('flow_id'), drink['meter_name'], result)
+    if self._store:
+      self._store.Flush()
 
+  def _GetDrinkRequest(self, event):
+    """Returns the RecordDrinks item for the completed flow `event`."""
     # TODO: add to flow event
     auth_token = None
 
-    if volume_ml is not None and volume_ml < common_defs.MIN_VOLUME_TO_RECORD:
-        self._logger.info('Not recording flow: (%i mL) <= '
-            'MIN_VOLUME_TO_RECORD (%i)' % (volume_ml, common_defs.MIN_VOLUME_TO_RECORD))
-        return
-    if ticks <= 0:
-        self._logger.info('Not recording flow: no ticks.')
-        return
-
-    # Log the drink.  If the username is empty or invalid, the backend will
-    # assign it to the default (anonymous) user.  The backend will assign the
-    # drink to a keg.
-    try:
-      d = self._backend.RecordDrink(meter_name, ticks=ticks, username=username,
-          pour_time=pour_time, duration=duration, auth_token=auth_token,
-          spilled=False)
-    except backend.DoesNotExistException as e:
-      self._logger.info('No drink recorded: %s' % e)
-      return
-
-    if not d:
-      self._logger.warning('No drink recorded.')
-      return
-
+    return {
+      'flow_id': event.flow_id,
+      'meter_name': event.meter_name,
+      'ticks': event.ticks,
+      'username': event.username,
+      'pour_time': event.last_activity_time,
+      'duration': (event.last_activity_time - event.start_time).seconds,
+      'auth_token': auth_token,
+      'spilled': False,
+    }
+
+  def _DrinkRecorded(self, flow_id, meter_name, d):
     keg_id = d.get('keg_id', None)
     username = d.get('user_id', None)
 
+    if self._store:
+      self._store.SetDrinkRecorded(flow_id, d.id, keg_id)
+
     self._logger.info('Logged drink %s username=%s keg=%s liters=%.2f ticks=%i' % (
       d.id, username, keg_id, d.volume_ml/1000.0, d.ticks))
 
@@ -406,42 +529,83 @@ class DrinkManager(Manager):
 
 
 class ThermoManager(Manager):
-  def __init__(self, event_hub, backend):
+  """Aggregates thermo sensor readings and records them once a minute.
+
+  Readings are summarized per sensor over each minute (see SensorWindow).
+  Once a minute, the mean of every sensor is passed to the backend in one
+  LogSensorReadings call; the web API has no bulk endpoint, so WebBackend
+  still makes one (parallel) request per sensor.  The backend only accepts a
+  single value per reading, so the full summary (count, min, max, mean and
+  last) is kept in the local store, if one is configured.  Every reading is
+  also checked for anomalies, which are published as ThermoAlertEvents.
+  """
+  def __init__(self, event_hub, backend, store=None, clock=SYSTEM_CLOCK):
     super(ThermoManager, self).__init__(event_hub)
     self._backend = backend
-    self._name_to_last_record = {}
+    self._store = store
+    self._clock = clock
     self._sensor_log = {}
-    seconds = common_defs.THERMO_RECORD_DELTA_SECONDS
-    self._record_interval = datetime.timedelta(seconds=seconds)
+    self._windows = {}
+    self._detectors = {}
 
   @EventHandler(kbevent.HeartbeatMinuteEvent)
   def _HandleHeartbeat(self, event):
     MAX_AGE = datetime.timedelta(minutes=2)
-    now = datetime.datetime.now()
+    now = self._clock.Now()
+    # A stale sensor's last readings are still recorded below, but its window
+    # and anomaly baseline are dropped; a sensor that comes back starts afresh.
+    stale_windows = []
     for sensor_name in list(self._sensor_log.keys()):
       last_update = self._sensor_log[sensor_name]
       if (now - last_update) > MAX_AGE:
         self._logger.warning('Stopped receiving updates for thermo sensor %s' %
             sensor_name)
         del self._sensor_log[sensor_name]
+        self._detectors.pop(sensor_name, None)
+        window = self._windows.pop(sensor_name, None)
+        if window:
+          stale_windows.append(window)
+    self._FlushReadings(list(self._windows.values()) + stale_windows)
+
+  def _FlushReadings(self, windows=None):
+    """Records the summary of each sensor's window, and starts new windows.
+
+    If `windows` is given, only those windows are flushed.
+    """
+    if windows is None:
+      windows = list(self._windows.values())
+    readings = []
+    for window in windows:
+      if not window.GetCount():
+        continue
+      self._logger.debug('Recording %s' % window)
+      readings.append((window.GetSensorName(), window.GetMean(),
+          window.GetStartTime()))
+      if self._store:
+        self._store.AddSensorReading(window.GetSensorName(),
+            window.GetStartTime(), window.GetCount(), window.GetMin(),
+            window.GetMax(), window.GetMean(), window.GetLast())
+      window.Reset()
+
+    if not readings:
+      return
+    if self._store:
+      self._store.Flush()
+    try:
+      results = self._backend.LogSensorReadings(readings)
+    except backend.BackendException as e:
+      results = [e] * len(readings)
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+      self._logger.warning('Error recording temperatures; dropped %d '
+          'reading(s): %s' % (len(failed), failed[0]))
 
   @EventHandler(kbevent.ThermoEvent)
   def _HandleThermoUpdateEvent(self, event):
     sensor_name = event.sensor_name
     sensor_value = event.sensor_value
-    now = datetime.datetime.now()
-
-    # Round down to nearest minute.
-    now = now.replace(second=0, microsecond=0)
-
-    # If we've already posted a recording for this minute, avoid doing so again.
-    # Note: the backend may also be performing this check.
-    last_record = self._name_to_last_record.get(sensor_name)
-    if last_record:
-      last_value, last_time = last_record
-      if last_time == now:
-        self._logger.debug('Dropping excessive temp event')
-        return
+    now = self._clock.Now()
+    when = kbevent.GetEventTime(event) or now
 
     # If the temperature is out of bounds, reject it.
     # Note: the backend may also be performing this check.
@@ -450,7 +614,7 @@ class ThermoManager(Manager):
     if sensor_value < min_val or sensor_value > max_val:
       return
 
-    log_message = 'Recording temperature sensor=%s value=%s' % (sensor_name,
+    log_message = 'Temperature reading sensor=%s value=%s' % (sensor_name,
         sensor_value)
 
     if sensor_name not in self._sensor_log:
@@ -460,15 +624,248 @@ class ThermoManager(Manager):
       self._logger.debug(log_message)
     self._sensor_log[sensor_name] = now
 
-    try:
-      self._backend.LogSensorReading(sensor_name, sensor_value, now)
-      self._name_to_last_record[sensor_name] = (sensor_value, now)
-    except ValueError:
-      # Value was rejected by the backend; ignore.
-      pass
+    # Readings are recorded against the start of their minute.  A late
+    # (replayed) reading from another minute than the window's closes it.
+    minute = when.replace(second=0, microsecond=0)
+    window = self._windows.get(sensor_name)
+    if not window:
+      window = self._windows[sensor_name] = SensorWindow(sensor_name)
+    elif window.GetCount() and window.GetStartTime() != minute:
+      self._FlushReadings([window])
+    if event.reading_count:
+      window.AddSummary(event.reading_count, event.min_value, event.max_value,
+          event.mean_value, sensor_value, minute)
+    else:
+      window.AddReading(sensor_value, minute)
+
+    detector = self._detectors.get(sensor_name)
+    if not detector:
+      detector = self._detectors[sensor_name] = AnomalyDetector(sensor_name)
+    alert = detector.AddReading(sensor_value)
+    if alert:
+      self._logger.warning('Thermo sensor %s alert: %s (value=%s mean=%.2f)' % (
+          sensor_name, alert, sensor_value, detector.GetMean()))
+      alert_event = kbevent.ThermoAlertEvent()
+      alert_event.sensor_name = sensor_name
+      alert_event.sensor_value = sensor_value
+      alert_event.alert = alert
+      alert_event.mean = detector.GetMean()
+      alert_event.stddev = detector.GetStddev()
+      self._PublishEvent(alert_event)
+
+def GetCoreState(flow_manager, authentication_manager):
+  """Returns the state saved by snapshots and replicated to a standby."""
+  return {
+    'flows': flow_manager.GetSnapshot(),
+    'tokens': authentication_manager.GetSnapshot(),
+  }
+
+
+def RestoreCoreState(flow_manager, authentication_manager, state):
+  """Restores the sections of `state` returned by GetCoreState."""
+  if 'flows' in state:
+    flow_manager.RestoreSnapshot(state['flows'])
+  if 'tokens' in state:
+    authentication_manager.RestoreSnapshot(state['tokens'])
+
+
+class SnapshotManager(Manager):
+  """Periodically saves flow, meter and token state to a SnapshotFile.
+
+  A snapshot is also saved as soon as a flow completes, so that a completed
+  flow is not restored (and recorded again) after a restart.  Snapshots are
+  synced to disk when flows or tokens change, and otherwise at most every
+  `sync_interval` seconds.
+  """
+  def __init__(self, event_hub, flow_manager, authentication_manager,
+      snapshot_file, interval=1, sync_interval=30, clock=SYSTEM_CLOCK):
+    super(SnapshotManager, self).__init__(event_hub)
+    self._flow_manager = flow_manager
+    self._authentication_manager = authentication_manager
+    self._snapshot_file = snapshot_file
+    self._interval = interval
+    self._sync_interval = sync_interval
+    self._clock = clock
+    self._last_save_time = 0
+    self._last_sync_time = 0
+    self._synced_flows_and_tokens = None
+
+  def GetState(self):
+    return GetCoreState(self._flow_manager, self._authentication_manager)
+
+  def Save(self):
+    now = self._last_save_time = self._clock()
+    state = self.GetState()
+    flows_and_tokens = (
+        sorted(flow['flow_id'] for flow in state['flows']['flows']),
+        state['tokens'])
+    sync = flows_and_tokens != self._synced_flows_and_tokens or \
+        abs(now - self._last_sync_time) >= self._sync_interval
+    if self._snapshot_file.Save(state, now=now, sync=sync):
+      self._logger.debug('Saved snapshot to %s' % self._snapshot_file.GetPath())
+    if sync and self._snapshot_file.IsSynced():
+      self._last_sync_time = now
+      self._synced_flows_and_tokens = flows_and_tokens
+
+  def Restore(self, max_age=None):
+    """Restores the saved snapshot, if any.  Returns True on success."""
+    state = self._snapshot_file.Load(max_age=max_age, now=self._clock())
+    if not state:
+      return False
+    self._logger.info('Restoring snapshot from %s' %
+        self._snapshot_file.GetPath())
+    RestoreCoreState(self._flow_manager, self._authentication_manager, state)
+    return True
+
+  @EventHandler(kbevent.HeartbeatSecondEvent)
+  def _HandleHeartbeat(self, event):
+    if abs(self._clock() - self._last_save_time) >= self._interval:
+      self.Save()
+
+  @EventHandler(kbevent.FlowUpdate)
+  def _HandleFlowUpdate(self, event):
+    if event.state == event.FlowState.COMPLETED:
+      self.Save()
+
+
+class ClusterManager(Manager):
+  """Keeps this core's cluster membership current (see cluster module).
+
+  Flows on meters whose controller is handed to another core are stopped, so
+  the pour so far is recorded here, and the new owner starts afresh.
+  """
+  def __init__(self, event_hub, flow_manager, ownership):
+    super(ClusterManager, self).__init__(event_hub)
+    self._flow_manager = flow_manager
+    self._ownership = ownership
+
+  def Refresh(self):
+    if not self._ownership.Refresh():
+      return
+    self._logger.info('Now %s' % self._ownership)
+    for flow in self._flow_manager.GetActiveFlows():
+      meter_name = flow.GetMeterName()
+      if not self._ownership.OwnsMeter(meter_name):
+        self._logger.info('Meter %s handed off; stopping flow %s' % (meter_name,
+            flow))
+        self._flow_manager.StopFlow(meter_name)
+
+  @EventHandler(kbevent.HeartbeatSecondEvent)
+  def _HandleHeartbeat(self, event):
+    self.Refresh()
+
+  @EventHandler(kbevent.QuitEvent)
+  def _HandleQuit(self, event):
+    self._ownership.Leave()
+
+
+class ReplicationManager(Manager):
+  """Replicates state to, or takes over from, a paired core.
+
+  See the replication module.  `ownership` is a ReplicaOwnership, and
+  ReplicationEvents are sent with `client`.
+  """
+  def __init__(self, event_hub, flow_manager, authentication_manager,
+      ownership, client, node_id, failover_seconds=2, clock=SYSTEM_CLOCK):
+    super(ReplicationManager, self).__init__(event_hub)
+    self._flow_manager = flow_manager
+    self._authentication_manager = authentication_manager
+    self._ownership = ownership
+    self._client = client
+    self._node_id = node_id
+    self._failover_seconds = failover_seconds
+    self._clock = clock
+    self._delta_tracker = replication.DeltaTracker(clock=clock)
+    self._epoch = 1 if ownership.IsActive() else 0
+    self._sequence = 0
+    self._peer_state = {}
+    self._peer_node_id = None
+    self._peer_epoch = 0
+    self._peer_sequence = None
+    self._last_peer_time = clock()
+
+  def IsActive(self):
+    return self._ownership.IsActive()
+
+  def GetEpoch(self):
+    return self._epoch
+
+  def Replicate(self):
+    """Sends the state which changed since the last ReplicationEvent."""
+    if not self.IsActive():
+      return
+    state = GetCoreState(self._flow_manager, self._authentication_manager)
+    self._sequence += 1
+    event = kbevent.ReplicationEvent(node_id=self._node_id, epoch=self._epoch,
+        sequence=self._sequence, state=self._delta_tracker.GetDelta(state))
+    self._client.send_message(event)
+
+  def Promote(self):
+    """Restores the replicated state, and takes over as the active core."""
+    self._epoch = max(self._epoch, self._peer_epoch) + 1
+    self._logger.warning('No heartbeat from active core for %.1f seconds; '
+        'taking over as epoch %d.' % (self._clock() - self._last_peer_time,
+        self._epoch))
+    RestoreCoreState(self._flow_manager, self._authentication_manager,
+        self._peer_state)
+    self._peer_state = {}
+    self._ownership.SetActive(True)
+    self._delta_tracker = replication.DeltaTracker(clock=self._clock)
+    self.Replicate()
+
+  def Demote(self, active_node_id):
+    """Becomes the standby, abandoning flows to `active_node_id`."""
+    self._logger.warning('Core %s (epoch %d) is active; standing by.' % (
+        active_node_id, self._peer_epoch))
+    self._ownership.SetActive(False)
+    self._flow_manager.AbandonFlows()
+    self._authentication_manager.AbandonTokens()
+
+  @EventHandler(kbevent.ReplicationEvent)
+  def _HandleReplication(self, event):
+    if event.node_id == self._node_id:
+      return
+    if self.IsActive():
+      if (event.epoch, event.node_id) <= (self._epoch, self._node_id):
+        # A core which has not yet noticed our takeover.
+        return
+      self._peer_epoch = event.epoch
+      self.Demote(event.node_id)
+
+    if event.node_id != self._peer_node_id:
+      self._peer_sequence = None
+    if self._peer_sequence is not None and \
+        event.sequence != self._peer_sequence + 1:
+      self._logger.info('Missed replication events %s..%s; state may be stale '
+          'until the next full state.' % (self._peer_sequence + 1,
+          event.sequence - 1))
+    self._last_peer_time = self._clock()
+    self._peer_node_id = event.node_id
+    self._peer_epoch = max(self._peer_epoch, event.epoch)
+    self._peer_sequence = event.sequence
+    self._peer_state.update(event.state or {})
+
+  @EventHandler(kbevent.HeartbeatSecondEvent)
+  def _HandleHeartbeat(self, event):
+    if self.IsActive():
+      self.Replicate()
+    elif self._clock() - self._last_peer_time >= self._failover_seconds:
+      self.Promote()
+
+  @EventHandler(kbevent.FlowUpdate)
+  def _HandleFlowUpdate(self, event):
+    if event.state == event.FlowState.COMPLETED:
+      self.Replicate()
+
 
 class TokenRecord(object):
+  """An auth token presented to a meter.
+
+  Records are equal, and hash the same, if they have the same auth device,
+  token value and meter.
+  """
   STATUS_ACTIVE = 'active'
+  STATUS_REMOVING = 'removing'
   STATUS_REMOVED = 'removed'
 
   def __init__(self, auth_device, token_value, meter_name):
@@ -476,6 +873,12 @@ class TokenRecord(object):
     self.token_value = token_value
     self.meter_name = meter_name
     self.status = self.STATUS_ACTIVE
+    # While removing, the time at which the removal is completed.
+    self.removal_time = None
+    # Id of the flow last started for this token, if any.
+    self.flow_id = None
+    # Earliest time at which starting a flow may be attempted again.
+    self.retry_time = None
 
   def __str__(self):
     return '%s:%s@%s' % self.AsTuple()
@@ -487,7 +890,11 @@ class TokenRecord(object):
     self.status = status
 
   def IsPresent(self):
-    return self.status == self.STATUS_ACTIVE
+    """Returns whether the token is attached, including while removing."""
+    return self.status != self.STATUS_REMOVED
+
+  def IsRemoving(self):
+    return self.status == self.STATUS_REMOVING
 
   def IsRemoved(self):
     return self.status == self.STATUS_REMOVED
@@ -495,26 +902,45 @@ class TokenRecord(object):
   def __hash__(self):
     return hash(self.AsTuple())
 
-  def __cmp__(self, other):
-    if not other:
-      return -1
-    return cmp(self.AsTuple(), other.AsTuple())
+  def __eq__(self, other):
+    if not isinstance(other, TokenRecord):
+      return NotImplemented
+    return self.AsTuple() == other.AsTuple()
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
 
 
 class AuthenticationManager(Manager):
-  def __init__(self, event_hub, flow_manager, tap_manager, backend):
+  """Starts and ends flows as auth tokens are attached and removed.
+
+  Attached tokens are indexed by (auth device, token value, meter), so a token
+  reported again while attached, as readers do many times a second, is
+  ignored without looking it up again, unless it owns no flow (its lookup
+  failed, or its flow ended).  Then it is looked up again, at most every
+  AUTH_TOKEN_RETRY_SECS.  A removed token stays attached for
+  the debounce window of its auth device (AUTH_DEVICE_DEBOUNCE_SECS), and if
+  reported again meanwhile, is treated as never removed.
+  """
+  def __init__(self, event_hub, flow_manager, tap_manager, backend,
+      clock=SYSTEM_CLOCK):
     super(AuthenticationManager, self).__init__(event_hub)
     self._flow_manager = flow_manager
     self._tap_manager = tap_manager
     self._backend = backend
+    self._clock = clock
     self._tokens = {}  # maps tap name to currently active token
+    self._present = {}  # maps each attached TokenRecord to itself
     self._lock = threading.RLock()
 
   @EventHandler(kbevent.TokenAuthEvent)
   def HandleAuthTokenEvent(self, event):
     taps = self._GetTapsForTapName(event.meter_name)
-    self._logger.info('event={} taps={}'.format(event, taps))
-    for tap in self._GetTapsForTapName(event.meter_name):
+    self._logger.debug('event={} taps={}'.format(event, taps))
+    for tap in taps:
       record = self._GetRecord(event.auth_device_name, event.token_value,
           tap.GetName())
       if event.status == event.TokenState.ADDED:
@@ -522,17 +948,19 @@ class AuthenticationManager(Manager):
       else:
         self._TokenRemoved(record)
 
+  @EventHandler(kbevent.HeartbeatSecondEvent)
+  def _HandleHeartbeat(self, event):
+    self._CompleteRemovals()
+
   def _GetRecord(self, auth_device, token_value, meter_name):
     new_rec = TokenRecord(auth_device, token_value, meter_name)
-    existing = self._tokens.get(meter_name)
-    if new_rec == existing:
-      return existing
-    return new_rec
+    return self._present.get(new_rec, new_rec)
 
   def _MaybeStartFlow(self, record):
     """Called when the given token has been added.
 
-    This will either start or renew a flow on the FlowManager."""
+    This will either start or renew a flow on the FlowManager.  Returns the
+    flow, or None if no flow was started."""
     username = None
     meter_name = record.meter_name
     try:
@@ -540,20 +968,30 @@ class AuthenticationManager(Manager):
       username = token.get('username')
     except kbapi.NotFoundError:
       pass
+    except backend.BackendException as e:
+      self._logger.warning('Could not look up token %s: %s' % (record, e))
+      return None
 
     if not username:
       self._logger.info('Token not assigned: %s' % record)
-      return
+      return None
 
     if not token.enabled:
       self._logger.info('Token disabled: %s' % record)
-      return
+      return None
 
     max_idle = common_defs.AUTH_DEVICE_MAX_IDLE_SECS.get(record.auth_device)
     if max_idle is None:
       max_idle = common_defs.AUTH_DEVICE_MAX_IDLE_SECS['default']
-    self._flow_manager.StartFlow(meter_name, username=username,
+    flow, is_new = self._flow_manager.StartFlow(meter_name, username=username,
         max_idle_secs=max_idle)
+    return flow
+
+  def _AttemptFlow(self, record):
+    """Starts a flow for `record`, and records whether it owns one."""
+    record.retry_time = self._clock() + common_defs.AUTH_TOKEN_RETRY_SECS
+    flow = self._MaybeStartFlow(record)
+    record.flow_id = flow.GetId() if flow else None
 
   def _MaybeEndFlow(self, record):
     """Called when the given token has been removed.
@@ -572,35 +1010,95 @@ class AuthenticationManager(Manager):
   @util.synchronized
   def _TokenAdded(self, record):
     """Processes a record when a token is added."""
-    self._logger.info('Token attached: %s' % record)
-    existing = self._tokens.get(record.meter_name)
-
-    if existing == record:
-      # Token is already known; nothing to do except update it.
-      record.SetStatus(TokenRecord.STATUS_ACTIVE)
+    if record.IsPresent() and record in self._present:
+      # Token is already attached; nothing to do, except cancel any removal,
+      # and retry if it never got a flow.  A flow it started and that has
+      # since ended is not restarted, so a token left on the reader does not
+      # cycle flows.
+      if record.IsRemoving():
+        self._logger.debug('Token reattached while removing: %s' % record)
+        record.SetStatus(TokenRecord.STATUS_ACTIVE)
+        record.removal_time = None
+      if record.flow_id is None and (record.retry_time is None or
+          self._clock() >= record.retry_time):
+        self._logger.info('Token attached without a flow, retrying: %s' %
+            record)
+        self._AttemptFlow(record)
       return
 
+    self._logger.info('Token attached: %s' % record)
+    existing = self._tokens.get(record.meter_name)
     if existing:
       self._logger.info('Removing previous token')
-      self._TokenRemoved(existing)
+      self._CompleteRemoval(existing)
 
+    record.SetStatus(TokenRecord.STATUS_ACTIVE)
     self._tokens[record.meter_name] = record
-    self._MaybeStartFlow(record)
+    self._present[record] = record
+    self._AttemptFlow(record)
 
   @util.synchronized
   def _TokenRemoved(self, record):
+    if record not in self._present:
+      self._logger.warning('Token has already been removed: %s' % record)
+      return
+    if record.IsRemoving():
+      return
+
     self._logger.info('Token detached: %s' % record)
-    if record != self._tokens.get(record.meter_name):
-      self._logger.warning('Token has already been removed')
+    debounce = common_defs.AUTH_DEVICE_DEBOUNCE_SECS.get(record.auth_device)
+    if debounce is None:
+      debounce = common_defs.AUTH_DEVICE_DEBOUNCE_SECS['default']
+    if not debounce:
+      self._CompleteRemoval(record)
       return
+    record.SetStatus(TokenRecord.STATUS_REMOVING)
+    record.removal_time = self._clock() + debounce
 
-    record.SetStatus(record.STATUS_REMOVED)
-    del self._tokens[record.meter_name]
+  @util.synchronized
+  def _CompleteRemovals(self):
+    """Completes removals whose debounce window has ended."""
+    now = self._clock()
+    for record in list(self._present):
+      if record.IsRemoving() and now >= record.removal_time:
+        self._CompleteRemoval(record)
+
+  def _CompleteRemoval(self, record):
+    record.SetStatus(TokenRecord.STATUS_REMOVED)
+    record.removal_time = None
+    self._present.pop(record, None)
+    if self._tokens.get(record.meter_name) is record:
+      del self._tokens[record.meter_name]
     self._MaybeEndFlow(record)
 
+  @util.synchronized
+  def GetSnapshot(self):
+    """Returns the attached tokens (see snapshot module)."""
+    return [list(record.AsTuple()) for record in self._tokens.values()
+        if record.IsPresent()]
+
+  @util.synchronized
+  def RestoreSnapshot(self, snapshot):
+    """Restores tokens saved by GetSnapshot, without starting flows."""
+    for auth_device, token_value, meter_name in snapshot:
+      record = TokenRecord(auth_device, token_value, meter_name)
+      self._logger.info('Restoring token: %s' % record)
+      existing = self._tokens.get(meter_name)
+      if existing:
+        self._present.pop(existing, None)
+      self._tokens[meter_name] = record
+      self._present[record] = record
+
+  @util.synchronized
+  def AbandonTokens(self):
+    """Forgets all attached tokens, without ending their flows."""
+    self._tokens.clear()
+    self._present.clear()
+
   def _GetTapsForTapName(self, meter_name):
     if not meter_name or meter_name == common_defs.ALIAS_ALL_TAPS:
-      return self._tap_manager.GetAllTaps()
+      return [tap for tap in self._tap_manager.GetAllTaps()
+          if self._tap_manager.OwnsMeter(tap.GetName())]
     else:
       tap = self._tap_manager.GetTap(meter_name)
       if tap:
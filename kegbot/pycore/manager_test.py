@@ -3,15 +3,23 @@
 """Unittest for manager module"""
 
 import datetime
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
+from . import backend
+from . import clock
 from . import common_defs
 from . import kbevent
 from . import manager
+from . import store
+from .util import AttrDict
 
 class FlowManagerTestCase(unittest.TestCase):
   def setUp(self):
-    event_hub = kbevent.EventHub()
+    self.event_hub = event_hub = kbevent.EventHub()
     backend = None
     self.tap_manager = manager.TapManager(event_hub, backend)
     self.flow_manager = manager.FlowManager(event_hub, self.tap_manager)
@@ -123,6 +131,426 @@ class FlowManagerTestCase(unittest.TestCase):
     idle_flows = list(self.flow_manager.IterIdleFlows(when=t(1000)))
     self.assertTrue(len(idle_flows) == 1)
 
+  def testCoalescedMeterUpdates(self):
+    updates = []
+    self.event_hub.Subscribe(kbevent.MeterUpdate,
+        self.flow_manager.HandleFlowActivityEvent)
+    self.event_hub.Subscribe(kbevent.FlowUpdate, updates.append)
+
+    def Publish(reading):
+      event = kbevent.MeterUpdate()
+      event.meter_name = 'flow0'
+      event.reading = reading
+      self.event_hub.PublishEvent(event)
+
+    for reading in (100, 200, 300, 400):
+      Publish(reading)
+    self.assertEqual(1, self.event_hub.GetStats()['queued'])
+    self.event_hub.Flush()
+    flow = self.flow_manager.GetFlow('flow0')
+    self.assertEqual(300, flow.GetTicks())
+
+    # A step the meter would reject is not merged, and is still rejected.
+    illegal_reading = 400 + common_defs.MAX_METER_READING_DELTA + 100
+    for reading in (450, illegal_reading, illegal_reading + 10):
+      Publish(reading)
+    self.assertEqual(2, self.event_hub.GetStats()['queued'])
+    self.event_hub.Flush()
+    self.assertEqual(360, flow.GetTicks())
+
+    # Each dispatch produced a single update (plus the flow start).
+    self.assertEqual(4, len(updates))
+
+  def testLateMeterUpdates(self):
+    self.event_hub.Subscribe(kbevent.MeterUpdate,
+        self.flow_manager.HandleFlowActivityEvent)
+    for reading, when in ((100, 1000), (200, 1005)):
+      event = kbevent.MeterUpdate()
+      event.meter_name = 'flow0'
+      event.reading = reading
+      event.when = when
+      self.event_hub.PublishEvent(event)
+      self.event_hub.Flush()
+
+    # The flow is credited to the time of the readings, not of their delivery.
+    update = self.flow_manager.GetFlow('flow0').GetUpdateEvent()
+    self.assertEqual(datetime.datetime.fromtimestamp(1000), update.start_time)
+    self.assertEqual(datetime.datetime.fromtimestamp(1005),
+        update.last_activity_time)
+
+  def testRelayEvents(self):
+    self.tap_manager._RegisterOrUpdateTap(name='flow0',
+        ml_per_tick=1000/2200.0, relay_name='kegboard.relay0')
+    relay_events = []
+    self.event_hub.Subscribe(kbevent.SetRelayOutputEvent, relay_events.append)
+    self.event_hub.Subscribe(kbevent.HeartbeatSecondEvent,
+        self.flow_manager._HandleHeartbeatEvent)
+
+    # Heartbeats do not re-send the command until the lease is due.
+    flow, is_new = self.flow_manager.StartFlow('flow0', username='guest')
+    for i in range(3):
+      self.event_hub.PublishEvent(kbevent.HeartbeatSecondEvent())
+    self.event_hub.Flush()
+    self.assertEqual(1, len(relay_events))
+    self.assertEqual('kegboard.relay0', relay_events[0].output_name)
+    self.assertEqual(kbevent.SetRelayOutputEvent.Mode.ENABLED,
+        relay_events[0].output_mode)
+
+    self.flow_manager.StopFlow('flow0')
+    self.event_hub.Flush()
+    self.assertEqual(2, len(relay_events))
+    self.assertEqual(kbevent.SetRelayOutputEvent.Mode.DISABLED,
+        relay_events[1].output_mode)
+
+  def testSnapshotRestore(self):
+    flow, is_new = self.flow_manager.UpdateFlow('flow0', 2000)
+    self.flow_manager.UpdateFlow('flow0', 2100)
+    state = json.loads(json.dumps(self.flow_manager.GetSnapshot()))
+
+    # A new core restores the flow and credits ticks counted while it was down.
+    restored = manager.FlowManager(kbevent.EventHub(), self.tap_manager)
+    restored.RestoreSnapshot(state)
+    restored_flow = restored.GetFlow('flow0')
+    self.assertEqual(flow.GetId(), restored_flow.GetId())
+    self.assertEqual(flow.GetUpdateEvent().start_time,
+        restored_flow.GetUpdateEvent().start_time)
+    self.assertEqual(100, restored_flow.GetTicks())
+
+    new_flow, is_new = restored.UpdateFlow('flow0', 2300)
+    self.assertFalse(is_new)
+    self.assertIs(restored_flow, new_flow)
+    self.assertEqual(300, new_flow.GetTicks())
+    self.assertEqual(300, restored.GetMeter('flow0').GetTicks())
+
+
+class RecordingSnapshotFile(object):
+  def __init__(self):
+    self.syncs = []
+
+  def GetPath(self):
+    return 'snapshot'
+
+  def Save(self, state, now=None, sync=True):
+    self.syncs.append(sync)
+    return True
+
+  def IsSynced(self):
+    return self.syncs[-1]
+
+
+class SnapshotManagerTestCase(unittest.TestCase):
+  def testSyncedOnFlowChanges(self):
+    sim_clock = clock.SimulatedClock(1000)
+    event_hub = kbevent.EventHub()
+    tap_manager = manager.TapManager(event_hub, None)
+    flow_manager = manager.FlowManager(event_hub, tap_manager, clock=sim_clock)
+    auth_manager = manager.AuthenticationManager(event_hub, flow_manager,
+        tap_manager, None, clock=sim_clock)
+    snapshot_file = RecordingSnapshotFile()
+    snapshot_manager = manager.SnapshotManager(event_hub, flow_manager,
+        auth_manager, snapshot_file, sync_interval=30, clock=sim_clock)
+
+    flow_manager.UpdateFlow('flow0', 2000)
+    flow_manager.UpdateFlow('flow0', 2100)
+    snapshot_manager.Save()  # Flow started.
+    for i in range(3):
+      sim_clock.Advance(1)
+      flow_manager.UpdateFlow('flow0', 2200 + i)
+      snapshot_manager.Save()
+    sim_clock.Advance(30)
+    snapshot_manager.Save()  # Interval passed.
+    flow_manager.StopFlow('flow0')
+    snapshot_manager.Save()  # Flow ended.
+    self.assertEqual([True, False, False, False, True, True],
+        snapshot_file.syncs)
+
+
+class RecordingBackend(backend.Backend):
+  def __init__(self):
+    self.sensor_batches = []
+
+  def LogSensorReadings(self, readings):
+    self.sensor_batches.append(list(readings))
+    return [None] * len(readings)
+
+
+class ThermoManagerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.event_hub = kbevent.EventHub()
+    self.backend = RecordingBackend()
+    self.clock = clock.SimulatedClock(
+        datetime.datetime(2020, 1, 1, 12, 0, 30).timestamp())
+    self.thermo_manager = manager.ThermoManager(self.event_hub, self.backend,
+        clock=self.clock)
+
+  def _Reading(self, sensor_name, value, when=None):
+    event = kbevent.ThermoEvent()
+    event.sensor_name = sensor_name
+    event.sensor_value = value
+    event.when = when
+    self.thermo_manager._HandleThermoUpdateEvent(event)
+
+  def testBatchedUpload(self):
+    for value in (2.0, 3.0, 4.0):
+      self._Reading('sensor0', value)
+    self._Reading('sensor1', 10.0)
+    self._Reading('sensor1', common_defs.THERMO_SENSOR_RANGE[1] + 1)
+    self.assertEqual([], self.backend.sensor_batches)
+
+    self.thermo_manager._HandleHeartbeat(kbevent.HeartbeatMinuteEvent())
+    self.assertEqual(1, len(self.backend.sensor_batches))
+    batch = sorted(self.backend.sensor_batches[0])
+    self.assertEqual(['sensor0', 'sensor1'], [r[0] for r in batch])
+    self.assertEqual([3.0, 10.0], [r[1] for r in batch])
+    self.assertEqual(0, batch[0][2].second)
+
+    # Nothing new to report.
+    self.thermo_manager._HandleHeartbeat(kbevent.HeartbeatMinuteEvent())
+    self.assertEqual(1, len(self.backend.sensor_batches))
+
+  def testLateReadings(self):
+    # Replayed readings are recorded against their own minutes.
+    start = self.clock() - 3600
+    for offset, value in ((0, 2.0), (20, 4.0), (60, 8.0)):
+      self._Reading('sensor0', value, when=start + offset)
+    self._Reading('sensor0', 5.0)
+    self.thermo_manager._HandleHeartbeat(kbevent.HeartbeatMinuteEvent())
+
+    readings = [r for batch in self.backend.sensor_batches for r in batch]
+    self.assertEqual([3.0, 8.0, 5.0], [r[1] for r in readings])
+    self.assertEqual([datetime.datetime.fromtimestamp(start - 30),
+        datetime.datetime.fromtimestamp(start + 30), self.clock.Now().replace(
+        second=0)], [r[2] for r in readings])
+
+  def testSummaryReading(self):
+    event = kbevent.ThermoEvent()
+    event.sensor_name = 'sensor0'
+    event.sensor_value = 4.0
+    event.reading_count = 3
+    event.min_value = 2.0
+    event.max_value = 6.0
+    event.mean_value = 3.0
+    self.thermo_manager._HandleThermoUpdateEvent(event)
+    self._Reading('sensor0', 7.0)
+    self.thermo_manager._HandleHeartbeat(kbevent.HeartbeatMinuteEvent())
+    self.assertEqual([4.0], [r[1] for r in self.backend.sensor_batches[0]])
+
+  def testStaleSensorForgotten(self):
+    for value in (2.0, 2.1, 1.9):
+      self._Reading('sensor0', value)
+    self.clock.Advance(180)
+    self.thermo_manager._HandleHeartbeat(kbevent.HeartbeatMinuteEvent())
+
+    # Its last readings are recorded, and its state dropped.
+    self.assertEqual([2.0], [r[1] for r in self.backend.sensor_batches[0]])
+    self.assertEqual({}, self.thermo_manager._windows)
+    self.assertEqual({}, self.thermo_manager._detectors)
+
+    # When it comes back, it starts a new baseline.
+    self._Reading('sensor0', 8.0)
+    self.assertEqual(8.0,
+        self.thermo_manager._detectors['sensor0'].GetMean())
+
+  def testSummaryStored(self):
+    tempdir = tempfile.mkdtemp()
+    local_store = store.LocalStore(os.path.join(tempdir, 'kegbot.db'))
+    try:
+      self.thermo_manager = manager.ThermoManager(self.event_hub, self.backend,
+          store=local_store, clock=self.clock)
+      for value in (2.0, 6.0, 4.0):
+        self._Reading('sensor0', value)
+      self.thermo_manager._HandleHeartbeat(kbevent.HeartbeatMinuteEvent())
+
+      self.assertEqual([('sensor0', 4.0)],
+          [r[:2] for r in self.backend.sensor_batches[0]])
+      readings = local_store.GetLastSensorReadings()
+      self.assertEqual([(3, 2.0, 6.0, 4.0, 4.0)], [(r.count, r.min, r.max,
+          r.mean, r.last) for r in readings])
+    finally:
+      local_store.Close()
+      shutil.rmtree(tempdir)
+
+
+class UnavailableBackend(backend.Backend):
+  def __init__(self):
+    self.calls = 0
+
+  def RecordDrink(self, *args, **kwargs):
+    self.calls += 1
+    raise backend.BackendUnavailableException('down')
+
+
+class QueuingBackend(backend.Backend):
+  def __init__(self):
+    self.callback = None
+
+  def SetDrinkRecordedCallback(self, callback):
+    self.callback = callback
+
+  def RecordDrink(self, *args, **kwargs):
+    return backend.DrinkQueued()
+
+
+class DrinkManagerTestCase(unittest.TestCase):
+  def testBackendUnavailable(self):
+    backend_obj = UnavailableBackend()
+    drink_manager = manager.DrinkManager(kbevent.EventHub(), backend_obj)
+    now = datetime.datetime.now()
+    event = kbevent.FlowUpdate()
+    event.flow_id = 1
+    event.meter_name = 'flow0'
+    event.state = event.FlowState.COMPLETED
+    event.username = ''
+    event.start_time = now
+    event.last_activity_time = now
+    event.ticks = 1000
+    event.volume_ml = 450.0
+
+    drink_manager.HandleFlowUpdateEvent(event)
+    for i in range(manager.FLAGS.maximum_event_retries):
+      drink_manager._FlushPending()
+
+    # The drink is kept until the backend is back, without using up retries.
+    self.assertEqual(manager.FLAGS.maximum_event_retries + 1, backend_obj.calls)
+    self.assertEqual([event], drink_manager._pending)
+    self.assertIsNone(getattr(event, 'retries', None))
+
+  def testQueuedDrinkRecorded(self):
+    backend_obj = QueuingBackend()
+    event_hub = kbevent.EventHub()
+    drink_manager = manager.DrinkManager(event_hub, backend_obj)
+    created = []
+    event_hub.Subscribe(kbevent.DrinkCreatedEvent, created.append)
+    now = datetime.datetime.now()
+    event = kbevent.FlowUpdate(flow_id=1, meter_name='flow0',
+        state=kbevent.FlowUpdate.FlowState.COMPLETED, username='',
+        start_time=now, last_activity_time=now, ticks=1000, volume_ml=450.0)
+
+    drink_manager.HandleFlowUpdateEvent(event)
+    self.assertEqual([], drink_manager._pending)
+
+    # Once the queued drink is recorded, it is announced as usual.
+    drink = drink_manager._GetDrinkRequest(event)
+    backend_obj.callback(drink, AttrDict({'id': 42, 'keg_id': 7,
+        'user_id': None, 'volume_ml': 450.0, 'ticks': 1000, 'time': now}))
+    event_hub.Flush()
+    self.assertEqual([(1, 42, 'flow0')],
+        [(e.flow_id, e.drink_id, e.meter_name) for e in created])
+
+
+class TokenBackend(backend.Backend):
+  def __init__(self):
+    self.lookups = 0
+    self.down = False
+
+  def GetAuthToken(self, auth_device, token_value):
+    self.lookups += 1
+    if self.down:
+      raise backend.BackendUnavailableException('down')
+    return AttrDict({'username': 'user-' + token_value, 'enabled': True})
+
+
+class AuthenticationManagerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.clock = clock.SimulatedClock(1000)
+    self.event_hub = kbevent.EventHub()
+    self.backend = TokenBackend()
+    self.tap_manager = manager.TapManager(self.event_hub, self.backend)
+    self.tap_manager._RegisterOrUpdateTap(name='flow0', ml_per_tick=0.5)
+    self.flow_manager = manager.FlowManager(self.event_hub, self.tap_manager,
+        clock=self.clock)
+    self.auth_manager = manager.AuthenticationManager(self.event_hub,
+        self.flow_manager, self.tap_manager, self.backend, clock=self.clock)
+
+  def _Token(self, auth_device, token_value, added=True):
+    event = kbevent.TokenAuthEvent(meter_name='flow0',
+        auth_device_name=auth_device, token_value=token_value)
+    if added:
+      event.status = event.TokenState.ADDED
+    else:
+      event.status = event.TokenState.REMOVED
+    self.auth_manager.HandleAuthTokenEvent(event)
+
+  def _Tick(self, seconds=1):
+    self.clock.Advance(seconds)
+    self.auth_manager._HandleHeartbeat(kbevent.HeartbeatSecondEvent())
+
+  def testTokenRecordEquality(self):
+    a = manager.TokenRecord('core.rfid', 'aa', 'flow0')
+    b = manager.TokenRecord('core.rfid', 'aa', 'flow0')
+    self.assertEqual(a, b)
+    self.assertEqual(1, len(set([a, b])))
+    self.assertNotEqual(a, manager.TokenRecord('core.rfid', 'bb', 'flow0'))
+    self.assertNotEqual(a, None)
+
+  def testRepeatedAddsIgnored(self):
+    for i in range(50):
+      self._Token(common_defs.AUTH_MODULE_CORE_RFID, 'aa')
+    self.assertEqual(1, self.backend.lookups)
+    flow = self.flow_manager.GetFlow('flow0')
+    self.assertEqual('user-aa', flow.GetUsername())
+
+    # A different token replaces it.
+    self._Token(common_defs.AUTH_MODULE_CORE_RFID, 'bb')
+    self.assertEqual(2, self.backend.lookups)
+    self.assertEqual('user-bb', self.flow_manager.GetFlow('flow0').GetUsername())
+
+  def testCaptiveRemovalDebounced(self):
+    onewire = common_defs.AUTH_MODULE_CORE_ONEWIRE
+    self._Token(onewire, 'aa')
+    flow = self.flow_manager.GetFlow('flow0')
+
+    # A contact bounce does not end the flow.
+    self._Token(onewire, 'aa', added=False)
+    self._Token(onewire, 'aa')
+    self._Tick(5)
+    self.assertIs(flow, self.flow_manager.GetFlow('flow0'))
+    self.assertEqual(1, self.backend.lookups)
+
+    # A removal ends it once the debounce window has passed.
+    self._Token(onewire, 'aa', added=False)
+    self.assertEqual([['core.onewire', 'aa', 'flow0']],
+        self.auth_manager.GetSnapshot())
+    self._Tick(common_defs.AUTH_DEVICE_DEBOUNCE_SECS[onewire])
+    self.assertIsNone(self.flow_manager.GetFlow('flow0'))
+    self.assertEqual([], self.auth_manager.GetSnapshot())
+
+  def testRetriedAfterLookupFailure(self):
+    self.backend.down = True
+    self._Token(common_defs.AUTH_MODULE_CORE_RFID, 'aa')
+    self.assertIsNone(self.flow_manager.GetFlow('flow0'))
+
+    # Re-reports are rate limited.
+    self.backend.down = False
+    self._Token(common_defs.AUTH_MODULE_CORE_RFID, 'aa')
+    self.assertEqual(1, self.backend.lookups)
+    self.assertIsNone(self.flow_manager.GetFlow('flow0'))
+
+    self._Tick(common_defs.AUTH_TOKEN_RETRY_SECS)
+    self._Token(common_defs.AUTH_MODULE_CORE_RFID, 'aa')
+    self.assertEqual(2, self.backend.lookups)
+    self.assertEqual('user-aa', self.flow_manager.GetFlow('flow0').GetUsername())
+
+    # Once it owns a flow, re-reports are ignored again.
+    self._Tick(common_defs.AUTH_TOKEN_RETRY_SECS)
+    self._Token(common_defs.AUTH_MODULE_CORE_RFID, 'aa')
+    self.assertEqual(2, self.backend.lookups)
+
+  def testNotRestartedAfterFlowIdle(self):
+    onewire = common_defs.AUTH_MODULE_CORE_ONEWIRE
+    self._Token(onewire, 'aa')
+    self.assertIsNotNone(self.flow_manager.GetFlow('flow0'))
+
+    self._Tick(common_defs.AUTH_DEVICE_MAX_IDLE_SECS[onewire] + 1)
+    self.flow_manager._HandleHeartbeatEvent(kbevent.HeartbeatSecondEvent())
+    self.assertIsNone(self.flow_manager.GetFlow('flow0'))
+
+    # The key is still attached and keeps being reported; no new flow starts.
+    for i in range(3):
+      self._Tick(common_defs.AUTH_TOKEN_RETRY_SECS)
+      self._Token(onewire, 'aa')
+    self.assertIsNone(self.flow_manager.GetFlow('flow0'))
+    self.assertEqual(1, self.backend.lookups)
 
 if __name__ == '__main__':
   unittest.main()
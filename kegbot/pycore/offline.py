@@ -0,0 +1,303 @@
+"""Backend which keeps working while the web backend is unreachable.
+
+OfflineCapableBackend wraps another Backend (normally a WebBackend) and keeps a
+local mirror of what the core needs to keep pouring:
+
+  * Taps, refreshed from every successful GetStatus (as made by SyncThread).
+    GetAllTaps is answered from the mirror once it has been filled.
+  * Auth tokens, keyed by (auth_device, token_value).  See below.
+  * Drinks that could not be recorded because the backend was unreachable.
+    These are queued (with a DrinkQueued result), and replayed in order after
+    the next successful sync, or on a background thread after the next
+    successful drink, so the caller is not held up.  The drink recorded
+    callback (see Backend.SetDrinkRecordedCallback) is called for each
+    replayed drink.  With a local store (--local_store_path), the queue is
+    kept in it, so queued drinks survive a restart of the core.
+
+The token mirror is deliberately narrow.  The web API has no call listing
+tokens or users, so the mirror cannot be filled by the periodic sync.  It
+holds only tokens that have been looked up successfully since the core
+started, with the user each one is assigned to.  Tokens the backend does not
+know are not mirrored.  Lookups always go to the backend, so that a token
+assigned, disabled or deleted by an admin takes effect at once.  The mirror
+answers only while the backend cannot be reached.  A token first presented
+during an outage is therefore rejected, as it would be without this backend.
+
+Enable with --offline_backend.
+"""
+
+from builtins import object
+import collections
+import datetime
+import json
+import logging
+import threading
+
+import gflags
+
+from kegbot.api import kbapi
+from . import backend
+from . import breaker
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_boolean('offline_backend', False,
+    'If true, the core keeps a local mirror of taps and auth tokens, and '
+    'queues drinks, so pours continue while the web backend is unreachable.')
+
+gflags.DEFINE_integer('offline_drink_queue_size', 1000,
+    'Maximum number of drinks queued while the backend is unreachable.',
+    lower_bound=1)
+
+
+# Name of the drink queue kept in the local store by a single core.
+DEFAULT_QUEUE_NAME = 'core'
+
+
+def _EncodeDrink(drink):
+  drink = dict(drink)
+  if isinstance(drink.get('pour_time'), datetime.datetime):
+    drink['pour_time'] = drink['pour_time'].timestamp()
+  return json.dumps(drink, sort_keys=True)
+
+
+def _DecodeDrink(data):
+  drink = json.loads(data)
+  if drink.get('pour_time') is not None:
+    drink['pour_time'] = datetime.datetime.fromtimestamp(drink['pour_time'])
+  return drink
+
+
+class OfflineCapableBackend(backend.Backend):
+  """Backend which keeps a local mirror of `delegate` (see module docstring).
+
+  If `store` (a store.LocalStore) is given, queued drinks are kept in it, in
+  the queue named `queue_name`, and the queue is reloaded from it.
+  """
+  def __init__(self, delegate, queue_size=None, store=None,
+      queue_name=DEFAULT_QUEUE_NAME):
+    self._delegate = delegate
+    if queue_size is None:
+      queue_size = FLAGS.offline_drink_queue_size
+    self._queue_size = queue_size
+    self._store = store
+    self._queue_name = queue_name
+    self._logger = logging.getLogger('offline-backend')
+    self._lock = threading.RLock()
+    self._reconcile_lock = threading.Lock()
+    self._reconcile_thread = None
+    self._taps = None
+    self._tokens = {}  # maps (auth_device, token_value) to token
+    # Each entry is a list of [id in the store or None, drink].
+    self._drink_queue = collections.deque()
+    self._drink_recorded_callback = None
+    if store:
+      self._LoadQueue()
+
+  def _LoadQueue(self):
+    for queued_id, data in self._store.GetQueuedDrinks(self._queue_name):
+      try:
+        self._drink_queue.append([queued_id, _DecodeDrink(data)])
+      except ValueError as e:
+        self._logger.warning('Dropping undecodable queued drink: %s' % e)
+        self._store.RemoveQueuedDrink(queued_id)
+    if self._drink_queue:
+      self._logger.info('Loaded %d queued drink(s) from the local store.' %
+          len(self._drink_queue))
+
+  def _UnqueueDrink(self, entry):
+    """Removes `entry` from the queue and store.  Called with `_lock` held."""
+    for i, queued in enumerate(self._drink_queue):
+      if queued is entry:
+        del self._drink_queue[i]
+        break
+    if self._store and entry[0] is not None:
+      self._store.RemoveQueuedDrink(entry[0])
+
+  def SetDrinkRecordedCallback(self, callback):
+    self._drink_recorded_callback = callback
+
+  def _UpdateTaps(self, taps):
+    with self._lock:
+      self._taps = collections.OrderedDict(
+          (tap['meter_name'], tap) for tap in taps)
+
+  def GetStatus(self):
+    status = self._delegate.GetStatus()
+    if status and 'taps' in status:
+      self._UpdateTaps(status['taps'])
+    self.ReconcileDrinks()
+    return status
+
+  def GetAllTaps(self):
+    with self._lock:
+      if self._taps is not None:
+        return list(self._taps.values())
+    taps = self._delegate.GetAllTaps()
+    self._UpdateTaps(taps)
+    return taps
+
+  def _TokenResult(self, key, result):
+    """Mirrors a lookup result, falling back to the mirror on failure."""
+    if isinstance(result, kbapi.NotFoundError):
+      with self._lock:
+        self._tokens.pop(key, None)
+      return result
+    if isinstance(result, backend.BackendException):
+      with self._lock:
+        token = self._tokens.get(key)
+      if token is None:
+        return result
+      self._logger.info('Backend unreachable (%s); using mirrored token %s:%s' %
+          (result, key[0], key[1]))
+      return token
+    if not isinstance(result, Exception):
+      with self._lock:
+        self._tokens[key] = result
+    return result
+
+  def GetAuthToken(self, auth_device, token_value):
+    result = self.GetAuthTokens([(auth_device, token_value)])[0]
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  def GetAuthTokens(self, tokens):
+    keys = [tuple(key) for key in tokens]
+    try:
+      lookups = self._delegate.GetAuthTokens(keys)
+    except backend.BackendException as e:
+      lookups = [e] * len(keys)
+    return [self._TokenResult(key, result)
+        for key, result in zip(keys, lookups)]
+
+  def RecordDrink(self, meter_name, ticks, **kwargs):
+    kwargs['meter_name'] = meter_name
+    kwargs['ticks'] = ticks
+    result = self.RecordDrinks([kwargs])[0]
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  def RecordDrinks(self, drinks):
+    drinks = list(drinks)
+    try:
+      results = self._delegate.RecordDrinks(drinks)
+    except backend.BackendException as e:
+      results = [e] * len(drinks)
+
+    recorded = False
+    for i, (drink, result) in enumerate(zip(drinks, results)):
+      if isinstance(result, backend.BackendException) and \
+          breaker.IsFailure(result):
+        self._QueueDrink(drink, result)
+        results[i] = backend.DrinkQueued()
+      elif not isinstance(result, Exception):
+        recorded = True
+    if recorded and self.GetQueuedDrinkCount():
+      self._StartReconcile()
+    return results
+
+  def _StartReconcile(self):
+    """Starts ReconcileDrinks on a background thread, unless running."""
+    with self._lock:
+      if self._reconcile_thread and self._reconcile_thread.is_alive():
+        return
+      self._reconcile_thread = threading.Thread(target=self.ReconcileDrinks,
+          name='offline-reconcile')
+      self._reconcile_thread.daemon = True
+      self._reconcile_thread.start()
+
+  def _QueueDrink(self, drink, error):
+    with self._lock:
+      if len(self._drink_queue) >= self._queue_size:
+        self._logger.warning('Drink queue full; dropping oldest drink.')
+        self._UnqueueDrink(self._drink_queue[0])
+      queued_id = None
+      if self._store:
+        queued_id = self._store.AddQueuedDrink(self._queue_name,
+            _EncodeDrink(drink))
+      self._drink_queue.append([queued_id, drink])
+      self._logger.warning('Backend unreachable (%s); queued drink for later '
+          '(%d queued).' % (error, len(self._drink_queue)))
+
+  def GetQueuedDrinkCount(self):
+    with self._lock:
+      return len(self._drink_queue)
+
+  def ReconcileDrinks(self):
+    """Records queued drinks, in order, until the queue is empty or the backend
+    fails.  Returns the number of drinks recorded.
+
+    Drinks are sent in batches of up to --api_batch_parallelism.
+    """
+    if not self._reconcile_lock.acquire(False):
+      # Already being done by another thread.
+      return 0
+    count = 0
+    try:
+      while True:
+        with self._lock:
+          batch = list(self._drink_queue)[:FLAGS.api_batch_parallelism]
+        if not batch:
+          break
+        try:
+          results = self._delegate.RecordDrinks([drink for i, drink in batch])
+        except backend.BackendException as e:
+          results = [e] * len(batch)
+
+        failed = False
+        recorded = []
+        with self._lock:
+          for entry, result in zip(batch, results):
+            if isinstance(result, backend.BackendException) and \
+                breaker.IsFailure(result):
+              failed = True
+              continue
+            if isinstance(result, Exception):
+              self._logger.warning('Dropping queued drink: %s' % result)
+            else:
+              count += 1
+              recorded.append((entry[1], result))
+            # The drink may have been pushed out by a full queue meanwhile.
+            self._UnqueueDrink(entry)
+        if self._drink_recorded_callback:
+          for drink, result in recorded:
+            self._drink_recorded_callback(drink, result)
+        if failed:
+          self._logger.info('Backend still unreachable; %d drink(s) remain '
+              'queued.' % self.GetQueuedDrinkCount())
+          break
+    finally:
+      self._reconcile_lock.release()
+    if count:
+      self._logger.info('Recorded %d queued drink(s).' % count)
+    return count
+
+  def CancelDrink(self, *args, **kwargs):
+    return self._delegate.CancelDrink(*args, **kwargs)
+
+  def LogSensorReading(self, *args, **kwargs):
+    return self._delegate.LogSensorReading(*args, **kwargs)
+
+  def LogSensorReadings(self, *args, **kwargs):
+    return self._delegate.LogSensorReadings(*args, **kwargs)
+
+  def CreateController(self, *args, **kwargs):
+    return self._delegate.CreateController(*args, **kwargs)
+
+  def GetLatencyStats(self):
+    return self._delegate.GetLatencyStats()
+
+
+def BuildWebBackend(local_store=None, queue_name=DEFAULT_QUEUE_NAME):
+  """Returns a WebBackend, wrapped as configured by flags.
+
+  Drinks queued by an offline backend are kept in `local_store`, if given,
+  under `queue_name`.
+  """
+  backend_obj = breaker.WithCircuitBreaker(backend.WebBackend())
+  if FLAGS.offline_backend:
+    backend_obj = OfflineCapableBackend(backend_obj, store=local_store,
+        queue_name=queue_name)
+  return backend_obj
@@ -0,0 +1,172 @@
+"""Unittest for offline module"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from kegbot.api import kbapi
+from . import backend
+from . import offline
+from . import store
+from .util import AttrDict
+
+class FakeBackend(backend.Backend):
+  def __init__(self):
+    self.down = False
+    self.drinks = []
+    self.drink_threads = []
+    self.token_lookups = 0
+    self.tokens = {
+      ('core.rfid', 'aa'): AttrDict({'username': 'guest', 'enabled': True}),
+    }
+
+  def _Check(self):
+    if self.down:
+      raise backend.BackendUnavailableException('down')
+
+  def GetStatus(self):
+    self._Check()
+    return {'taps': [AttrDict({'meter_name': 'flow0'})]}
+
+  def GetAllTaps(self):
+    self._Check()
+    return [AttrDict({'meter_name': 'flow0'})]
+
+  def GetAuthToken(self, auth_device, token_value):
+    self._Check()
+    self.token_lookups += 1
+    token = self.tokens.get((auth_device, token_value))
+    if not token:
+      raise kbapi.NotFoundError()
+    return token
+
+  def RecordDrink(self, meter_name, ticks, **kwargs):
+    self._Check()
+    if meter_name == 'unknown':
+      raise backend.DoesNotExistException(meter_name)
+    self.drinks.append((meter_name, ticks))
+    self.drink_threads.append(threading.current_thread())
+    return AttrDict({'id': len(self.drinks)})
+
+
+class OfflineCapableBackendTestCase(unittest.TestCase):
+  def setUp(self):
+    self.delegate = FakeBackend()
+    self.backend = offline.OfflineCapableBackend(self.delegate, queue_size=3)
+
+  def testTapMirror(self):
+    self.backend.GetStatus()
+    self.delegate.down = True
+    self.assertEqual(['flow0'],
+        [t.meter_name for t in self.backend.GetAllTaps()])
+
+  def testTokenMirror(self):
+    token = self.backend.GetAuthToken('core.rfid', 'aa')
+    self.assertEqual('guest', token.username)
+    self.assertRaises(kbapi.NotFoundError, self.backend.GetAuthToken,
+        'core.rfid', 'bb')
+
+    # Answered from the mirror only while the backend is down.
+    self.delegate.down = True
+    self.assertEqual('guest',
+        self.backend.GetAuthToken('core.rfid', 'aa').username)
+    self.assertRaises(backend.BackendUnavailableException,
+        self.backend.GetAuthToken, 'core.rfid', 'bb')
+    self.delegate.down = False
+    self.backend.GetAuthToken('core.rfid', 'aa')
+    self.assertEqual(3, self.delegate.token_lookups)
+
+  def testTokenChangesSeenImmediately(self):
+    self.assertRaises(kbapi.NotFoundError, self.backend.GetAuthToken,
+        'core.rfid', 'bb')
+    # An admin assigns the unknown tag.
+    self.delegate.tokens[('core.rfid', 'bb')] = AttrDict({'username': 'new',
+        'enabled': True})
+    self.assertEqual('new',
+        self.backend.GetAuthToken('core.rfid', 'bb').username)
+
+    # ... then disables it.
+    self.delegate.tokens[('core.rfid', 'bb')] = AttrDict({'username': 'new',
+        'enabled': False})
+    self.assertFalse(self.backend.GetAuthToken('core.rfid', 'bb').enabled)
+
+    # A deleted token is not answered from the mirror during an outage.
+    del self.delegate.tokens[('core.rfid', 'bb')]
+    self.assertRaises(kbapi.NotFoundError, self.backend.GetAuthToken,
+        'core.rfid', 'bb')
+    self.delegate.down = True
+    self.assertRaises(backend.BackendUnavailableException,
+        self.backend.GetAuthToken, 'core.rfid', 'bb')
+
+  def testDrinksQueuedAndReconciled(self):
+    recorded = []
+    self.backend.SetDrinkRecordedCallback(
+        lambda drink, result: recorded.append((drink['flow_id'], result.id)))
+    self.delegate.down = True
+    for flow_id, meter_name, ticks in ((1, 'flow0', 100), (2, 'unknown', 200),
+        (3, 'flow0', 300)):
+      self.assertIsInstance(self.backend.RecordDrink(meter_name, ticks=ticks,
+          flow_id=flow_id), backend.DrinkQueued)
+    self.assertEqual(3, self.backend.GetQueuedDrinkCount())
+    self.assertEqual([], self.delegate.drinks)
+
+    self.delegate.down = False
+    self.backend.GetStatus()
+    self.assertEqual(0, self.backend.GetQueuedDrinkCount())
+    self.assertEqual([('flow0', 100), ('flow0', 300)], self.delegate.drinks)
+    self.assertEqual([(1, 1), (3, 2)], recorded)
+
+  def testQueueLimit(self):
+    self.delegate.down = True
+    for ticks in range(5):
+      self.backend.RecordDrink('flow0', ticks=ticks)
+    self.assertEqual(3, self.backend.GetQueuedDrinkCount())
+
+    self.delegate.down = False
+    self.backend.RecordDrink('flow0', ticks=5)
+    self.backend._reconcile_thread.join()
+    self.assertEqual([5, 2, 3, 4], [t for m, t in self.delegate.drinks])
+
+    # Queued drinks are replayed off the recording thread.
+    self.assertEqual([threading.current_thread()],
+        self.delegate.drink_threads[:1])
+    self.assertNotIn(threading.current_thread(),
+        self.delegate.drink_threads[1:])
+
+  def testQueuePersisted(self):
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'kegbot.db')
+    pour_time = datetime.datetime(2020, 1, 1, 12, 0, 0)
+    try:
+      local_store = store.LocalStore(path)
+      self.backend = offline.OfflineCapableBackend(self.delegate,
+          queue_size=3, store=local_store, queue_name='core.0')
+      self.delegate.down = True
+      for ticks in range(4):
+        self.backend.RecordDrink('flow0', ticks=ticks, pour_time=pour_time)
+      local_store.Close()
+
+      # After a restart, the queue is reloaded, and emptied as it is replayed.
+      local_store = store.LocalStore(path)
+      self.assertEqual([], local_store.GetQueuedDrinks('core.1'))
+      self.backend = offline.OfflineCapableBackend(self.delegate,
+          store=local_store, queue_name='core.0')
+      self.assertEqual(3, self.backend.GetQueuedDrinkCount())
+      self.delegate.down = False
+      self.backend.GetStatus()
+      self.assertEqual([1, 2, 3], [t for m, t in self.delegate.drinks])
+      self.assertEqual([], local_store.GetQueuedDrinks('core.0'))
+      local_store.Close()
+    finally:
+      shutil.rmtree(tempdir)
+
+  def testErrorsNotQueued(self):
+    self.assertRaises(backend.DoesNotExistException, self.backend.RecordDrink,
+        'unknown', ticks=100)
+    self.assertEqual(0, self.backend.GetQueuedDrinkCount())
+
+if __name__ == '__main__':
+  unittest.main()
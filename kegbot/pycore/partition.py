@@ -0,0 +1,70 @@
+"""Assignment of controllers to core processes.
+
+Meter and sensor names are prefixed with the name of the controller reporting
+them (for example "kegboard-1234abcd.flow0").  A core process may be made
+responsible for only some controllers, in which case it ignores events
+concerning the others.
+"""
+
+from builtins import object
+import zlib
+
+from . import common_defs
+from . import kbevent
+
+def ControllerName(name):
+  """Returns the controller portion of a meter or sensor name."""
+  return name.split('.', 1)[0]
+
+
+class Ownership(object):
+  """Decides which controllers the current process is responsible for."""
+
+  def OwnsController(self, controller_name):
+    raise NotImplementedError
+
+  def OwnsMeter(self, meter_name):
+    return self.OwnsController(ControllerName(meter_name))
+
+  def OwnsEvent(self, event):
+    """Returns whether `event` concerns a controller owned by this process.
+
+    Events not tied to a single controller, such as a token presented to all
+    taps, are always owned.
+    """
+    if isinstance(event, (kbevent.MeterUpdate, kbevent.FlowRequest)):
+      return self.OwnsMeter(event.meter_name or '')
+    elif isinstance(event, kbevent.TokenAuthEvent):
+      meter_name = event.meter_name
+      if not meter_name or meter_name == common_defs.ALIAS_ALL_TAPS:
+        return True
+      return self.OwnsMeter(meter_name)
+    elif isinstance(event, kbevent.ThermoEvent):
+      return self.OwnsMeter(event.sensor_name or '')
+    elif isinstance(event, kbevent.ControllerConnectedEvent):
+      return self.OwnsController(event.controller_name or '')
+    return True
+
+
+class OwnEverything(Ownership):
+  """Ownership of a process that handles every controller."""
+
+  def OwnsController(self, controller_name):
+    return True
+
+
+class HashPartition(Ownership):
+  """Ownership of one of `count` processes, by hash of controller name."""
+
+  def __init__(self, index, count):
+    if not 0 <= index < count:
+      raise ValueError('Partition index %s out of range' % index)
+    self._index = index
+    self._count = count
+
+  def __str__(self):
+    return '<HashPartition %d of %d>' % (self._index, self._count)
+
+  def OwnsController(self, controller_name):
+    digest = zlib.crc32(controller_name.encode('utf-8'))
+    return digest % self._count == self._index
@@ -0,0 +1,120 @@
+"""Relay output state tracking.
+
+RelayController remembers the desired state of each relay output, and the
+state last sent to its controller.  A SetRelayOutputEvent is published only
+when the two differ, rather than on every request.
+
+Controllers turn an enabled output off again if it is not refreshed, so
+enabled outputs are renewed every --relay_renew_interval seconds.  Renewals are
+batched per controller: when any enabled output of a controller is due, all of
+its enabled outputs are renewed together, keeping each controller's writes in
+one burst.
+
+Relay names are of the form "<controller name>.<output name>", for example
+"kegboard-1234abcd.relay0".
+"""
+
+from builtins import object
+import collections
+import logging
+import threading
+import time
+
+import gflags
+
+from . import kbevent
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('relay_renew_interval', 5,
+    'Seconds between renewals of an enabled relay output.  Must be shorter '
+    'than the time after which the controller turns the output off.',
+    lower_bound=1)
+
+
+def GetControllerName(relay_name):
+  """Returns the name of the controller owning relay `relay_name`."""
+  return relay_name.rsplit('.', 1)[0]
+
+
+class RelayController(object):
+  """Tracks relay outputs, and publishes commands when they need changing.
+
+  `publish_fn` is called with each SetRelayOutputEvent to send.
+  """
+  def __init__(self, publish_fn, renew_interval=None, clock=time.time):
+    if renew_interval is None:
+      renew_interval = FLAGS.relay_renew_interval
+    self._publish = publish_fn
+    self._renew_interval = renew_interval
+    self._clock = clock
+    self._logger = logging.getLogger('relay-controller')
+    self._lock = threading.Lock()
+    self._desired = {}  # relay name to desired state (True if enabled)
+    self._sent = {}  # relay name to (state, time) last sent
+
+  def _Send(self, relay_name, enable, now):
+    self._sent[relay_name] = (enable, now)
+    if enable:
+      mode = kbevent.SetRelayOutputEvent.Mode.ENABLED
+    else:
+      mode = kbevent.SetRelayOutputEvent.Mode.DISABLED
+    return kbevent.SetRelayOutputEvent(output_name=relay_name,
+        output_mode=mode)
+
+  def SetDesired(self, relay_name, enable):
+    """Requests that `relay_name` be enabled or disabled.
+
+    A command is published only if the relay is not known to be in that state
+    already.  Returns True if one was published.
+    """
+    with self._lock:
+      self._desired[relay_name] = enable
+      sent = self._sent.get(relay_name)
+      if sent and sent[0] == enable:
+        return False
+      event = self._Send(relay_name, enable, self._clock())
+    self._logger.debug('Relay %s: %s' % (relay_name, event.output_mode))
+    self._publish(event)
+    return True
+
+  def IsEnabled(self, relay_name):
+    """Returns the desired state of `relay_name`."""
+    with self._lock:
+      return self._desired.get(relay_name, False)
+
+  def GetSentState(self, relay_name):
+    """Returns the state last sent for `relay_name`, or None if never sent."""
+    with self._lock:
+      sent = self._sent.get(relay_name)
+    return sent[0] if sent else None
+
+  def Reset(self):
+    """Forgets every relay, without publishing anything."""
+    with self._lock:
+      self._desired.clear()
+      self._sent.clear()
+
+  def Renew(self):
+    """Renews enabled outputs, as described in the module docstring.
+
+    Returns the number of commands published.
+    """
+    with self._lock:
+      now = self._clock()
+      by_controller = collections.OrderedDict()
+      for relay_name in sorted(self._desired):
+        if self._desired[relay_name]:
+          by_controller.setdefault(GetControllerName(relay_name),
+              []).append(relay_name)
+
+      events = []
+      for controller_name, relay_names in by_controller.items():
+        due = any(now - self._sent[r][1] >= self._renew_interval
+            for r in relay_names)
+        if due:
+          events += [self._Send(r, True, now) for r in relay_names]
+
+    for event in events:
+      self._publish(event)
+    return len(events)
@@ -0,0 +1,67 @@
+"""Unittest for relay module"""
+
+import unittest
+
+from . import kbevent
+from . import relay
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class RelayControllerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.published = []
+    self.controller = relay.RelayController(self.published.append,
+        renew_interval=5, clock=self.clock)
+
+  def _Published(self):
+    ret = [(e.output_name, e.output_mode) for e in self.published]
+    del self.published[:]
+    return ret
+
+  def testTransitionsOnly(self):
+    enabled = kbevent.SetRelayOutputEvent.Mode.ENABLED
+    disabled = kbevent.SetRelayOutputEvent.Mode.DISABLED
+    self.assertIsNone(self.controller.GetSentState('kb-1.relay0'))
+
+    self.assertTrue(self.controller.SetDesired('kb-1.relay0', True))
+    self.assertFalse(self.controller.SetDesired('kb-1.relay0', True))
+    self.assertEqual([('kb-1.relay0', enabled)], self._Published())
+    self.assertTrue(self.controller.IsEnabled('kb-1.relay0'))
+    self.assertTrue(self.controller.GetSentState('kb-1.relay0'))
+
+    self.assertTrue(self.controller.SetDesired('kb-1.relay0', False))
+    self.assertFalse(self.controller.SetDesired('kb-1.relay0', False))
+    self.assertEqual([('kb-1.relay0', disabled)], self._Published())
+
+    # A relay never sent is disabled explicitly.
+    self.assertTrue(self.controller.SetDesired('kb-1.relay1', False))
+
+  def testRenewalBatchedPerController(self):
+    self.controller.SetDesired('kb-1.relay0', True)
+    self.clock.now += 3
+    self.controller.SetDesired('kb-1.relay1', True)
+    self.controller.SetDesired('kb-2.relay0', True)
+    self.controller.SetDesired('kb-2.relay1', False)
+    self._Published()
+
+    self.assertEqual(0, self.controller.Renew())
+    self.clock.now += 2
+    self.assertEqual(2, self.controller.Renew())
+    self.assertEqual(['kb-1.relay0', 'kb-1.relay1'],
+        [name for name, mode in self._Published()])
+
+    self.clock.now += 3
+    self.assertEqual(1, self.controller.Renew())
+    self.assertEqual(['kb-2.relay0'], [name for name, mode in self._Published()])
+
+  def testGetControllerName(self):
+    self.assertEqual('kegboard-1234', relay.GetControllerName('kegboard-1234.relay0'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+"""Hot-standby replication between two cores.
+
+With --replication_role, a pair of cores share the kegnet bus: one active, the
+other standby.  Every second (and as soon as a flow completes), the active
+core publishes a ReplicationEvent carrying the sections of its state which
+changed: flows and meter readings, and attached auth tokens (the same state
+saved by the snapshot module).  The full state is sent every
+FULL_STATE_INTERVAL_SECONDS, so a standby started late, or which missed an
+event, catches up.
+
+The standby handles no controller events.  It applies the state it receives,
+and when no ReplicationEvent has arrived for --replication_failover_seconds,
+it restores that state and takes over.  Meter readings are restored too, so
+ticks counted by a controller since the last event are credited to the
+restored flows, as after a snapshot restore.
+
+Each takeover increases the epoch.  An active core which sees another active
+core with a later (epoch, node id) steps down to standby, abandoning its
+flows, which the other core now owns.
+
+Both cores must see every event, so with --kegnet_transport=streams, each
+reads the kegnet stream in its own consumer group (see
+kegbot_app.CoreConsumerGroup).
+"""
+
+from builtins import object
+import json
+import socket
+import time
+
+import gflags
+
+from . import kbevent
+from . import partition
+
+FLAGS = gflags.FLAGS
+
+ROLE_NONE = 'none'
+ROLE_ACTIVE = 'active'
+ROLE_STANDBY = 'standby'
+
+gflags.DEFINE_enum('replication_role', ROLE_NONE,
+    [ROLE_NONE, ROLE_ACTIVE, ROLE_STANDBY],
+    'Role of this core in an active/standby pair, or "none".')
+
+gflags.DEFINE_string('replication_node_id', socket.gethostname(),
+    'Name of this core in an active/standby pair.  Must differ between the '
+    'two cores.')
+
+gflags.DEFINE_float('replication_failover_seconds', 2.0,
+    'Seconds without a heartbeat from the active core after which the standby '
+    'takes over.',
+    lower_bound=1.0)
+
+# Seconds between replications of the full state.
+FULL_STATE_INTERVAL_SECONDS = 10
+
+
+class ReplicaOwnership(partition.Ownership):
+  """Ownership of a core in an active/standby pair.
+
+  The active core owns every controller.  The standby owns none, and only
+  handles ReplicationEvents.
+  """
+  def __init__(self, active=False):
+    self._active = active
+
+  def __str__(self):
+    return '<ReplicaOwnership %s>' % ('active' if self._active else 'standby')
+
+  def IsActive(self):
+    return self._active
+
+  def SetActive(self, active):
+    self._active = active
+
+  def OwnsController(self, controller_name):
+    return self._active
+
+  def OwnsEvent(self, event):
+    if isinstance(event, kbevent.ReplicationEvent):
+      return True
+    if not self._active:
+      return False
+    return super(ReplicaOwnership, self).OwnsEvent(event)
+
+
+class DeltaTracker(object):
+  """Computes the sections of a state dict which changed since last sent."""
+  def __init__(self, full_interval=FULL_STATE_INTERVAL_SECONDS,
+      clock=time.time):
+    self._full_interval = full_interval
+    self._clock = clock
+    self._sent = {}
+    self._last_full_time = None
+
+  def GetDelta(self, state):
+    """Returns the sections of `state` to send, and records them as sent."""
+    now = self._clock()
+    encoded = dict((k, json.dumps(v, sort_keys=True)) for k, v in state.items())
+    if self._last_full_time is None or \
+        now - self._last_full_time >= self._full_interval:
+      self._last_full_time = now
+      delta = dict(state)
+    else:
+      delta = dict((k, v) for k, v in state.items()
+          if encoded[k] != self._sent.get(k))
+    self._sent = encoded
+    return delta
+
+
+def BuildOwnership():
+  """Returns a ReplicaOwnership for --replication_role, or None."""
+  if FLAGS.replication_role == ROLE_NONE:
+    return None
+  return ReplicaOwnership(active=FLAGS.replication_role == ROLE_ACTIVE)
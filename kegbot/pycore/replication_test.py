@@ -0,0 +1,118 @@
+"""Unittest for replication module"""
+
+import unittest
+
+from . import kbevent
+from . import manager
+from . import replication
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class FakeClient(object):
+  """Delivers sent events to every core on the same bus."""
+  def __init__(self, bus):
+    self.bus = bus
+
+  def send_message(self, event):
+    self.bus.append(kbevent.DecodeEvent(event.ToJson()))
+    return True
+
+class Core(object):
+  def __init__(self, node_id, active, bus, clock):
+    self.event_hub = kbevent.EventHub()
+    self.ownership = replication.ReplicaOwnership(active=active)
+    self.tap_manager = manager.TapManager(self.event_hub, None,
+        ownership=self.ownership)
+    self.flow_manager = manager.FlowManager(self.event_hub, self.tap_manager)
+    self.authentication_manager = manager.AuthenticationManager(
+        self.event_hub, self.flow_manager, self.tap_manager, None)
+    self.replication_manager = manager.ReplicationManager(self.event_hub,
+        self.flow_manager, self.authentication_manager, self.ownership,
+        FakeClient(bus), node_id, failover_seconds=2, clock=clock)
+    for mgr in (self.flow_manager, self.replication_manager):
+      for event_type, methods in mgr.GetEventHandlers().items():
+        for method in methods:
+          self.event_hub.Subscribe(event_type, method)
+
+  def Receive(self, event):
+    """Delivers `event` as the net thread would."""
+    if self.ownership.OwnsEvent(event):
+      self.event_hub.PublishEvent(event)
+      self.event_hub.Flush()
+
+  def Heartbeat(self):
+    self.event_hub.PublishEvent(kbevent.HeartbeatSecondEvent())
+    self.event_hub.Flush()
+
+class DeltaTrackerTestCase(unittest.TestCase):
+  def testDeltas(self):
+    clock = FakeClock()
+    tracker = replication.DeltaTracker(full_interval=10, clock=clock)
+    state = {'flows': {'a': 1}, 'tokens': []}
+    self.assertEqual(state, tracker.GetDelta(state))
+    self.assertEqual({}, tracker.GetDelta(state))
+    state = {'flows': {'a': 2}, 'tokens': []}
+    self.assertEqual({'flows': {'a': 2}}, tracker.GetDelta(state))
+    clock.now += 10
+    self.assertEqual(state, tracker.GetDelta(state))
+
+class ReplicationTestCase(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.bus = []
+    self.active = Core('a', True, self.bus, self.clock)
+    self.standby = Core('b', False, self.bus, self.clock)
+
+  def _Tick(self, cores):
+    """Advances one second, and delivers what the cores sent."""
+    self.clock.now += 1
+    for core in cores:
+      core.Heartbeat()
+    sent, self.bus[:] = list(self.bus), []
+    for event in sent:
+      for core in cores:
+        core.Receive(event)
+
+  def _Meter(self, core, reading):
+    core.Receive(kbevent.MeterUpdate(meter_name='kegboard.flow0',
+        reading=reading))
+
+  def testFailover(self):
+    both = [self.active, self.standby]
+    self._Meter(self.active, 100)
+    self._Meter(self.standby, 100)
+    self.assertIsNone(self.standby.flow_manager.GetFlow('kegboard.flow0'))
+    self._Meter(self.active, 150)
+    self._Tick(both)
+    self._Tick(both)
+    self.assertFalse(self.standby.replication_manager.IsActive())
+
+    # The active core dies; ticks counted meanwhile are not lost.
+    self._Tick([self.standby])
+    self.assertFalse(self.standby.replication_manager.IsActive())
+    self._Tick([self.standby])
+    self.assertTrue(self.standby.replication_manager.IsActive())
+    self.assertEqual(2, self.standby.replication_manager.GetEpoch())
+    self._Meter(self.standby, 180)
+    flow = self.standby.flow_manager.GetFlow('kegboard.flow0')
+    self.assertEqual(80, flow.GetTicks())
+
+    # The old active core comes back, and stands by.
+    self._Tick(both)
+    self.assertFalse(self.active.replication_manager.IsActive())
+    self.assertIsNone(self.active.flow_manager.GetFlow('kegboard.flow0'))
+    self.assertTrue(self.standby.replication_manager.IsActive())
+
+  def testStandbyIgnoresControllers(self):
+    self._Tick([self.active, self.standby])
+    self._Meter(self.standby, 100)
+    self._Meter(self.standby, 200)
+    self.assertEqual([], self.standby.flow_manager.GetActiveFlows())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,168 @@
+"""Deterministic, accelerated simulation of a kegbot core.
+
+A Simulation runs a KegbotEnv on a SimulatedClock, in the calling thread.
+Instead of starting the core's threads, it advances the clock one second at a
+time, publishing the heartbeats the HeartbeatThread would and dispatching every
+event before moving on.  A day of bar traffic thus runs in seconds, and runs
+the same way every time, for capacity planning and soak testing.
+
+Traffic is injected as the kegboard and auth daemons would send it (see Pour,
+Thermo and Publish).  SimulatedBackend stands in for the Kegbot server, and
+can be made unavailable to simulate outages.
+"""
+
+from builtins import object
+
+from kegbot.api import kbapi
+
+from . import backend
+from . import common_defs
+from . import kbevent
+from . import kegbot_app
+from .clock import SimulatedClock
+from .util import AttrDict
+
+# Seconds between syncs with the backend, as done by the SyncThread when idle.
+SYNC_INTERVAL_SECONDS = 60
+
+
+class SimulatedBackend(backend.Backend):
+  """In-memory backend, recording what the core sends it.
+
+  `taps` is a list of tap dicts, as returned by GetAllTaps, and `tokens` maps
+  (auth_device, token_value) to a username.  While `available` is False, every
+  call fails with BackendUnavailableException.
+  """
+  def __init__(self, taps, tokens=None):
+    self.taps = taps
+    self.tokens = tokens or {}
+    self.available = True
+    self.drinks = []
+    self.sensor_readings = []
+    self.calls = 0
+
+  def _Check(self):
+    self.calls += 1
+    if not self.available:
+      raise backend.BackendUnavailableException('Simulated outage')
+
+  def _GetTap(self, meter_name):
+    for tap in self.taps:
+      if tap['meter_name'] == meter_name:
+        return tap
+    raise backend.DoesNotExistException('No tap for meter %s' % meter_name)
+
+  def GetStatus(self):
+    return {'taps': self.GetAllTaps()}
+
+  def GetAllTaps(self):
+    self._Check()
+    return [AttrDict(tap) for tap in self.taps]
+
+  def RecordDrink(self, meter_name, ticks, volume_ml=None, username=None,
+      pour_time=None, duration=0, auth_token=None, spilled=False, shout=''):
+    self._Check()
+    tap = self._GetTap(meter_name)
+    drink = AttrDict({
+      'id': len(self.drinks) + 1,
+      'ticks': ticks,
+      'volume_ml': ticks * tap['ml_per_tick'],
+      'user_id': username or None,
+      'keg_id': None,
+      'time': pour_time,
+    })
+    self.drinks.append(drink)
+    return drink
+
+  def LogSensorReading(self, sensor_name, temperature, when=None):
+    self._Check()
+    self.sensor_readings.append((sensor_name, temperature, when))
+
+  def GetAuthToken(self, auth_device, token_value):
+    self._Check()
+    username = self.tokens.get((auth_device, token_value))
+    if not username:
+      raise kbapi.NotFoundError()
+    return AttrDict({'username': username, 'enabled': True})
+
+  def CreateController(self, controller_name):
+    self._Check()
+    return AttrDict({'name': controller_name})
+
+
+class Simulation(object):
+  """Runs a KegbotEnv with `backend_obj` on simulated time from `start`."""
+  def __init__(self, backend_obj, start=0, ownership=None):
+    self.clock = SimulatedClock(start)
+    self.env = kegbot_app.KegbotEnv(backend_obj=backend_obj,
+        ownership=ownership, clock=self.clock)
+    self._hub = self.env.GetEventHub()
+    self._seconds = 0
+    self._readings = {}
+    self.Publish(kbevent.StartedEvent())
+    self._Sync()
+
+  def GetElapsed(self):
+    """Returns the number of simulated seconds run so far."""
+    return self._seconds
+
+  def _Sync(self):
+    self.env.SyncNow()
+    self._hub.Flush()
+
+  def Publish(self, event):
+    """Publishes `event`, and dispatches it and all events it causes."""
+    self._hub.PublishEvent(event)
+    self._hub.Flush()
+
+  def Run(self, seconds):
+    """Advances the clock by whole `seconds`, one heartbeat at a time."""
+    for i in range(int(seconds)):
+      self.clock.Advance(1)
+      self._seconds += 1
+      self._hub.PublishEvent(kbevent.HeartbeatSecondEvent())
+      if (self._seconds % 60) == 0:
+        self._hub.PublishEvent(kbevent.HeartbeatMinuteEvent())
+      if (self._seconds % SYNC_INTERVAL_SECONDS) == 0:
+        self.env.SyncNow()
+      self._hub.Flush()
+
+  def Token(self, meter_name, auth_device, token_value, added=True):
+    """Presents (or removes) an auth token, as an auth daemon would."""
+    event = kbevent.TokenAuthEvent(meter_name=meter_name,
+        auth_device_name=auth_device, token_value=token_value)
+    if added:
+      event.status = event.TokenState.ADDED
+    else:
+      event.status = event.TokenState.REMOVED
+    self.Publish(event)
+
+  def Meter(self, meter_name, ticks):
+    """Reports `ticks` more on `meter_name`, as a kegboard daemon would."""
+    reading = self._readings.get(meter_name, 0) + ticks
+    self._readings[meter_name] = reading
+    self.Publish(kbevent.MeterUpdate(meter_name=meter_name, reading=reading))
+
+  def Pour(self, meter_name, ticks, seconds=10, token=None,
+      auth_device=common_defs.AUTH_MODULE_CORE_RFID):
+    """Pours `ticks` on `meter_name` evenly over `seconds`.
+
+    If `token` is given, it is presented before the pour and removed after.
+    """
+    if meter_name not in self._readings:
+      self.Meter(meter_name, 0)
+    if token:
+      self.Token(meter_name, auth_device, token)
+    seconds = max(1, int(seconds))
+    poured = 0
+    for i in range(seconds):
+      self.Run(1)
+      step = ticks * (i + 1) // seconds - poured
+      poured += step
+      self.Meter(meter_name, step)
+    if token:
+      self.Token(meter_name, auth_device, token, added=False)
+
+  def Thermo(self, sensor_name, value):
+    self.Publish(kbevent.ThermoEvent(sensor_name=sensor_name,
+        sensor_value=value))
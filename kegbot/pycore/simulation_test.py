@@ -0,0 +1,87 @@
+"""Unittest for simulation and clock modules"""
+
+import random
+import threading
+import unittest
+
+from . import clock
+from . import common_defs
+from . import simulation
+
+TAPS = [
+  {'meter_name': 'kegboard.flow0', 'ml_per_tick': 0.5,
+      'relay_name': 'kegboard.relay0'},
+  {'meter_name': 'kegboard.flow1', 'ml_per_tick': 0.5,
+      'relay_name': 'kegboard.relay1'},
+]
+
+TOKENS = {
+  (common_defs.AUTH_MODULE_CORE_RFID, 'tag%d' % i): 'user%d' % i
+  for i in range(5)
+}
+
+class SimulatedClockTestCase(unittest.TestCase):
+  def testSleep(self):
+    c = clock.SimulatedClock(100)
+    self.assertEqual(100, c())
+    self.assertEqual(100, c.Now().timestamp())
+
+    woke = threading.Event()
+    def Sleeper():
+      c.Sleep(5)
+      woke.set()
+    thr = threading.Thread(target=Sleeper)
+    thr.start()
+    c.Advance(4)
+    self.assertFalse(woke.wait(0.05))
+    c.Advance(1)
+    self.assertTrue(woke.wait(5))
+    thr.join()
+    self.assertRaises(ValueError, c.Advance, -1)
+
+class SimulationTestCase(unittest.TestCase):
+  def testIdleFlowEnds(self):
+    backend = simulation.SimulatedBackend(TAPS, TOKENS)
+    sim = simulation.Simulation(backend)
+    flow_manager = sim.env.GetFlowManager()
+
+    sim.Pour('kegboard.flow0', 1000, seconds=5)
+    self.assertIsNotNone(flow_manager.GetFlow('kegboard.flow0'))
+    sim.Run(10)
+    self.assertIsNotNone(flow_manager.GetFlow('kegboard.flow0'))
+    sim.Run(2)
+    self.assertIsNone(flow_manager.GetFlow('kegboard.flow0'))
+    self.assertEqual([1000], [d.ticks for d in backend.drinks])
+
+  def testDayOfTraffic(self):
+    """Runs a day of pours, auth and thermo readings, with an outage."""
+    rand = random.Random(1234)
+    backend = simulation.SimulatedBackend(TAPS, TOKENS)
+    sim = simulation.Simulation(backend)
+
+    expected = []
+    while sim.GetElapsed() < 24 * 3600:
+      hour = sim.GetElapsed() // 3600
+      backend.available = hour != 14
+      meter_name = rand.choice(TAPS)['meter_name']
+      ticks = rand.randint(200, 1200)
+      token = rand.choice([None] + [t for d, t in sorted(TOKENS)])
+      sim.Pour(meter_name, ticks, seconds=rand.randint(3, 15), token=token)
+      # Tokens cannot be looked up during the outage, so pours are anonymous.
+      username = ''
+      if backend.available:
+        username = TOKENS.get((common_defs.AUTH_MODULE_CORE_RFID, token), '')
+      expected.append((ticks, username))
+      for i in range(rand.randint(2, 8)):
+        sim.Thermo('kegboard.thermo0', rand.uniform(2.0, 6.0))
+        sim.Run(60)
+
+    backend.available = True
+    sim.Run(120)
+    self.assertTrue(len(expected) > 250)
+    recorded = [(d.ticks, d.user_id or '') for d in backend.drinks]
+    self.assertEqual(sorted(expected), sorted(recorded))
+    self.assertTrue(len(backend.sensor_readings) > 1000)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,162 @@
+"""Crash-safe snapshots of core state.
+
+When enabled with --snapshot_path, the core periodically saves the state it
+would otherwise lose on restart: active flows, the last reading of each flow
+meter, and attached auth tokens.  The snapshot is restored when the core starts,
+so pours in progress resume, and ticks counted by a controller while the core
+was down are credited to them.
+
+Snapshots are small JSON documents.  Each is written to a temporary file,
+synced to disk, and then atomically replaces the previous snapshot, so a crash
+or power loss never leaves a partial file behind.  Unchanged state is not
+rewritten.
+
+To spare SD cards, snapshots are only written to --snapshot_path when flows or
+auth tokens come or go, and at most every --snapshot_sync_interval seconds
+while only meter readings change.  In between, the latest meter readings are
+written, without syncing, to a separate "<snapshot_path>.recent" file.  It is
+restored instead of the snapshot if it is intact and newer.  A power loss may
+lose the ticks of the last few seconds, but not a flow.
+"""
+
+from builtins import object
+import json
+import logging
+import os
+import time
+
+import gflags
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string('snapshot_path', '',
+    'If set, active flows, meter readings and auth tokens are periodically '
+    'saved to this file and restored on startup.')
+
+gflags.DEFINE_integer('snapshot_interval', 1,
+    'Minimum number of seconds between state snapshots.',
+    lower_bound=1)
+
+gflags.DEFINE_integer('snapshot_sync_interval', 30,
+    'Maximum number of seconds a snapshot in which only meter readings '
+    'changed may stay unsynced to disk.',
+    lower_bound=1)
+
+gflags.DEFINE_integer('snapshot_max_age', 300,
+    'Snapshots older than this many seconds are not restored.',
+    lower_bound=0)
+
+SNAPSHOT_VERSION = 1
+
+
+def _SyncDirectory(path):
+  """Syncs the directory containing `path`, so a rename in it is durable."""
+  fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+class SnapshotFile(object):
+  """Reads and atomically writes a snapshot at `path`.
+
+  Unsynced snapshots go to `path` + '.recent', and never replace the synced
+  snapshot.
+  """
+  def __init__(self, path):
+    self._path = path
+    self._recent_path = '%s.recent' % path
+    self._logger = logging.getLogger('snapshot')
+    self._last_data = None
+    # Whether the last snapshot written has not been synced to disk.
+    self._unsynced = False
+
+  def GetPath(self):
+    return self._path
+
+  def Save(self, state, now=None, sync=True):
+    """Saves `state`, a JSON-serializable dict.
+
+    If `sync` is true, the snapshot is synced to disk, even if unchanged but
+    last written without syncing.  Otherwise it is only written to the
+    ".recent" file.  Returns True if the snapshot was written, or False if it
+    was unchanged or could not be written.
+    """
+    data = json.dumps(state, sort_keys=True)
+    if data == self._last_data and not (sync and self._unsynced):
+      return False
+
+    if now is None:
+      now = time.time()
+    contents = json.dumps({'version': SNAPSHOT_VERSION, 'time': now,
+        'state': state}, sort_keys=True)
+    path = self._path if sync else self._recent_path
+    tmp_path = '%s.tmp' % path
+    try:
+      with open(tmp_path, 'w') as f:
+        f.write(contents)
+        if sync:
+          f.flush()
+          os.fsync(f.fileno())
+      os.replace(tmp_path, path)
+      if sync:
+        _SyncDirectory(path)
+    except (IOError, OSError) as e:
+      self._logger.warning('Error writing snapshot %s: %s' % (path, e))
+      # Write it again next time, even if unchanged.
+      self._last_data = None
+      return False
+
+    if sync:
+      # Superseded; it would be ignored by Load anyway, as it is older.
+      try:
+        os.remove(self._recent_path)
+      except OSError:
+        pass
+    self._last_data = data
+    self._unsynced = not sync
+    return True
+
+  def IsSynced(self):
+    """Returns whether the last state saved is synced to disk."""
+    return self._last_data is not None and not self._unsynced
+
+  def _Read(self, path):
+    """Returns the contents of the snapshot at `path`, or None."""
+    try:
+      with open(path) as f:
+        contents = json.load(f)
+    except (IOError, OSError):
+      return None
+    except ValueError as e:
+      self._logger.warning('Ignoring corrupt snapshot %s: %s' % (path, e))
+      return None
+
+    if contents.get('version') != SNAPSHOT_VERSION:
+      self._logger.warning('Ignoring snapshot with unknown version: %s' %
+          contents.get('version'))
+      return None
+    return contents
+
+  def Load(self, max_age=None, now=None):
+    """Returns the saved state, or None if there is no usable snapshot.
+
+    Snapshots older than `max_age` seconds are ignored.
+    """
+    contents = self._Read(self._path)
+    recent = self._Read(self._recent_path)
+    if recent and (not contents or
+        recent.get('time', 0) > contents.get('time', 0)):
+      contents = recent
+    if not contents:
+      return None
+
+    if now is None:
+      now = time.time()
+    age = now - contents.get('time', 0)
+    if max_age is not None and age > max_age:
+      self._logger.info('Ignoring stale snapshot (%i seconds old)' % age)
+      return None
+
+    return contents.get('state')
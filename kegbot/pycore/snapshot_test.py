@@ -0,0 +1,68 @@
+"""Unittest for snapshot module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import snapshot
+
+class SnapshotFileTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'core.snapshot')
+    self.snapshot_file = snapshot.SnapshotFile(self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testSaveAndLoad(self):
+    self.assertIsNone(self.snapshot_file.Load())
+    state = {'flows': {'meters': {'flow0': [100, 20]}}, 'tokens': []}
+    self.assertTrue(self.snapshot_file.Save(state))
+    self.assertEqual(state, snapshot.SnapshotFile(self.path).Load())
+    self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+  def testUnchangedStateNotRewritten(self):
+    self.assertTrue(self.snapshot_file.Save({'tokens': []}, now=100))
+    self.assertFalse(self.snapshot_file.Save({'tokens': []}, now=200))
+    self.assertTrue(self.snapshot_file.Save({'tokens': [1]}, now=300))
+
+  def testUnsyncedStateSyncedOnRequest(self):
+    self.assertTrue(self.snapshot_file.Save({'tokens': []}, sync=False))
+    self.assertFalse(self.snapshot_file.IsSynced())
+    self.assertFalse(self.snapshot_file.Save({'tokens': []}, sync=False))
+    self.assertTrue(self.snapshot_file.Save({'tokens': []}))
+    self.assertTrue(self.snapshot_file.IsSynced())
+    self.assertFalse(self.snapshot_file.Save({'tokens': []}))
+
+  def testUnsyncedStateKeptApart(self):
+    self.snapshot_file.Save({'tokens': []}, now=100)
+    self.snapshot_file.Save({'tokens': [1]}, now=101, sync=False)
+    with open(self.path) as f:
+      self.assertIn('"time": 100', f.read())
+    self.assertEqual({'tokens': [1]},
+        snapshot.SnapshotFile(self.path).Load())
+
+    # Lost or damaged by a power loss: the synced snapshot is used.
+    with open(self.path + '.recent', 'w') as f:
+      f.write('{"version": 1, "st')
+    self.assertEqual({'tokens': []}, snapshot.SnapshotFile(self.path).Load())
+
+    self.snapshot_file.Save({'tokens': [2]}, now=102)
+    self.assertFalse(os.path.exists(self.path + '.recent'))
+    self.assertEqual({'tokens': [2]}, snapshot.SnapshotFile(self.path).Load())
+
+  def testStaleSnapshotIgnored(self):
+    self.snapshot_file.Save({'tokens': []}, now=100)
+    self.assertEqual({'tokens': []},
+        self.snapshot_file.Load(max_age=60, now=150))
+    self.assertIsNone(self.snapshot_file.Load(max_age=60, now=200))
+
+  def testCorruptSnapshotIgnored(self):
+    with open(self.path, 'w') as f:
+      f.write('{"version": 1, "st')
+    self.assertIsNone(self.snapshot_file.Load())
+
+if __name__ == '__main__':
+  unittest.main()
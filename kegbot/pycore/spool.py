@@ -0,0 +1,347 @@
+"""Store-and-forward spooling of kegnet messages.
+
+When enabled with --spool_path, a publisher such as the kegboard daemon spools
+messages to a SQLite database while the kegbot core cannot be reached, rather
+than dropping them.  Once a message has been spooled, later messages are
+spooled behind it, so the core always sees them in order.  The spool is
+replayed at a limited rate (--spool_replay_rate) once the core is reachable
+again.  Meter and thermo readings are stamped with the time they were spooled
+(their `when` field), so the core credits them to that time rather than to
+the time they are replayed.
+
+Before replay, the spool is compacted (see CompactEntries).  Meter readings are
+cumulative, so a run of readings collapses to the latest reading per meter,
+plus the readings needed to keep every step valid for the core's FlowMeter.
+Thermo readings of each sensor are merged into one summary (count, min, max,
+mean and last; see ThermoEvent) per THERMO_RECORD_DELTA_SECONDS, the window
+the core aggregates them over.  Any other message, such as an auth token
+event, is kept, and meter readings are never moved across it.
+
+The spool is bounded by --spool_max_messages.  When it is full it is compacted,
+and if that does not make room, the oldest message is dropped.
+"""
+
+from builtins import object
+import logging
+import sqlite3
+import threading
+import time
+
+import gflags
+
+from . import common_defs
+from . import kbevent
+from . import kegnet
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string('spool_path', '',
+    'If set, messages which cannot be delivered to the core are spooled to a '
+    'SQLite database at this path, and replayed when it is reachable.')
+
+gflags.DEFINE_integer('spool_max_messages', 10000,
+    'Maximum number of messages kept in the spool.',
+    lower_bound=1)
+
+gflags.DEFINE_integer('spool_replay_rate', 50,
+    'Maximum number of spooled messages replayed per second.',
+    lower_bound=1)
+
+SCHEMA = (
+  '''CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT,
+    value REAL,
+    data TEXT NOT NULL
+  )''',
+)
+
+KIND_METER = 'meter'
+KIND_THERMO = 'thermo'
+KIND_OTHER = 'other'
+
+# Minimum seconds between compactions while replaying.
+COMPACT_INTERVAL_SECONDS = 5
+
+# Seconds to wait before retrying a replay which failed.
+REPLAY_RETRY_SECONDS = 1
+
+
+def _Describe(event):
+  """Returns the (kind, name, value) of `event` used for compaction."""
+  if isinstance(event, kbevent.MeterUpdate):
+    return KIND_METER, event.meter_name, event.reading
+  if isinstance(event, kbevent.ThermoEvent):
+    return KIND_THERMO, event.sensor_name, event.sensor_value
+  return KIND_OTHER, None, None
+
+
+def GroupThermoEntries(entries,
+    thermo_interval=common_defs.THERMO_RECORD_DELTA_SECONDS):
+  """Groups the thermo readings among spooled entries for merging.
+
+  `entries` is a sequence of (id, time, kind, name, value), in spool order.
+  Returns a dict mapping the id of the last reading of each sensor in each
+  `thermo_interval` to the ids of all its readings in that interval, in order.
+  """
+  groups = {}  # (sensor name, interval) to ids
+  for entry_id, when, kind, name, value in entries:
+    if kind == KIND_THERMO:
+      groups.setdefault((name, int(when // thermo_interval)), []).append(
+          entry_id)
+  return dict((ids[-1], ids) for ids in groups.values())
+
+
+def MergeThermoEvents(events):
+  """Returns a ThermoEvent summarizing `events`, in order.
+
+  Readings out of THERMO_SENSOR_RANGE, which the core would reject, are left
+  out of the summary, unless there are no others.
+  """
+  min_val, max_val = common_defs.THERMO_SENSOR_RANGE
+  valid = [e for e in events if min_val <= e.sensor_value <= max_val]
+  if not valid:
+    return events[-1]
+  count = 0
+  total = 0.0
+  for event in valid:
+    n = event.reading_count or 1
+    mean = event.sensor_value if event.mean_value is None else event.mean_value
+    count += n
+    total += mean * n
+  last = valid[-1]
+  merged = kbevent.ThermoEvent()
+  merged.sensor_name = last.sensor_name
+  merged.sensor_value = last.sensor_value
+  merged.when = last.when
+  merged.reading_count = count
+  merged.min_value = min(e.sensor_value if e.min_value is None else e.min_value
+      for e in valid)
+  merged.max_value = max(e.sensor_value if e.max_value is None else e.max_value
+      for e in valid)
+  merged.mean_value = total / count
+  return merged
+
+
+def CompactEntries(entries, max_step=common_defs.FLOW_METER_MAX_DELTA,
+    thermo_interval=common_defs.THERMO_RECORD_DELTA_SECONDS):
+  """Returns the set of ids of spooled entries worth keeping.
+
+  `entries` is a sequence of (id, time, kind, name, value), in spool order.
+
+  Of the thermo readings, only the last of each group (see GroupThermoEntries)
+  is kept; Spool.Compact replaces it with a summary of the group.
+
+  For each meter, the first reading is kept, as the base for the readings after
+  it.  Later readings are dropped while the next one is at most `max_step`
+  ahead of the last kept reading; the reading before one which is not (because
+  it is too far ahead, or because the meter was reset) is kept instead.  The
+  latest reading of each meter is kept before any other message, and at the
+  end.  Replaying the kept readings thus adds the same ticks to the core's
+  FlowMeter as replaying them all.
+  """
+  keep = set(GroupThermoEntries(entries, thermo_interval))
+  last_kept = {}  # meter name to the last kept reading
+  pending = {}  # meter name to (id, reading) of the latest unkept reading
+
+  def IsValidStep(delta):
+    return 0 <= delta <= max_step
+
+  def FlushPending():
+    for meter_name, (entry_id, reading) in pending.items():
+      keep.add(entry_id)
+      last_kept[meter_name] = reading
+    pending.clear()
+
+  for entry_id, when, kind, name, value in entries:
+    if kind == KIND_METER:
+      base = last_kept.get(name)
+      previous = pending.pop(name, None)
+      if base is not None and not IsValidStep(value - base) and previous:
+        keep.add(previous[0])
+        base = last_kept[name] = previous[1]
+      if base is None or not IsValidStep(value - base):
+        keep.add(entry_id)
+        last_kept[name] = value
+      else:
+        pending[name] = (entry_id, value)
+    elif kind == KIND_OTHER:
+      FlushPending()
+      keep.add(entry_id)
+
+  FlushPending()
+  return keep
+
+
+class Spool(object):
+  """Bounded, ordered queue of encoded events, stored in SQLite."""
+  def __init__(self, path, max_messages=None):
+    if max_messages is None:
+      max_messages = FLAGS.spool_max_messages
+    self._logger = logging.getLogger('spool')
+    self._max_messages = max_messages
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    with self._conn:
+      for statement in SCHEMA:
+        self._conn.execute(statement)
+    self._count = self._conn.execute(
+        'SELECT COUNT(*) FROM messages').fetchone()[0]
+    self._appended_since_compact = self._count
+
+  def Close(self):
+    with self._lock:
+      self._conn.close()
+
+  def GetCount(self):
+    return self._count
+
+  def Append(self, event, now=None):
+    """Adds `event` to the end of the spool."""
+    if now is None:
+      now = time.time()
+    kind, name, value = _Describe(event)
+    if kind != KIND_OTHER and event.when is None:
+      # The core uses the original time of readings replayed late.
+      event.when = now
+    if self._count >= self._max_messages:
+      self.Compact()
+    with self._lock:
+      with self._conn:
+        if self._count >= self._max_messages:
+          self._logger.warning('Spool full; dropping oldest message.')
+          self._conn.execute('DELETE FROM messages WHERE id = '
+              '(SELECT MIN(id) FROM messages)')
+          self._count -= 1
+        self._conn.execute('INSERT INTO messages (time, kind, name, value, '
+            'data) VALUES (?, ?, ?, ?, ?)', (now, kind, name, value,
+            event.ToJson(indent=None)))
+      self._count += 1
+      self._appended_since_compact += 1
+
+  def Peek(self, limit):
+    """Returns up to `limit` (id, data) pairs from the start of the spool."""
+    with self._lock:
+      return self._conn.execute('SELECT id, data FROM messages ORDER BY id '
+          'LIMIT ?', (limit,)).fetchall()
+
+  def Remove(self, last_id):
+    """Removes entries from the start of the spool, up to `last_id`."""
+    with self._lock:
+      with self._conn:
+        removed = self._conn.execute('DELETE FROM messages WHERE id <= ?',
+            (last_id,)).rowcount
+      self._count -= removed
+
+  def Compact(self):
+    """Drops redundant entries (see CompactEntries).
+
+    Returns the number of entries dropped.
+    """
+    with self._lock:
+      if not self._appended_since_compact:
+        return 0
+      entries = self._conn.execute('SELECT id, time, kind, name, value '
+          'FROM messages ORDER BY id').fetchall()
+      keep = CompactEntries(entries)
+      drop = [(entry[0],) for entry in entries if entry[0] not in keep]
+      merges = [self._MergeThermo(ids)
+          for ids in GroupThermoEntries(entries).values() if len(ids) > 1]
+      with self._conn:
+        self._conn.executemany('UPDATE messages SET value = ?, data = ? '
+            'WHERE id = ?', merges)
+        self._conn.executemany('DELETE FROM messages WHERE id = ?', drop)
+      self._count -= len(drop)
+      self._appended_since_compact = 0
+    if drop:
+      self._logger.info('Compacted spool: dropped %d of %d messages.' %
+          (len(drop), len(entries)))
+    return len(drop)
+
+
+  def _MergeThermo(self, ids):
+    """Returns (value, data, id) of the summary of thermo readings `ids`.
+
+    Must be called with `_lock` held.
+    """
+    rows = self._conn.execute('SELECT data FROM messages WHERE id IN (%s) '
+        'ORDER BY id' % ', '.join('?' * len(ids)), ids).fetchall()
+    merged = MergeThermoEvents([kbevent.DecodeEvent(row[0]) for row in rows])
+    return (merged.sensor_value, merged.ToJson(indent=None), ids[-1])
+
+
+class SpoolingClient(kegnet.KegnetClient):
+  """KegnetClient which spools messages the core does not receive.
+
+  With the pubsub transport, messages received only by other listeners, such
+  as the LCD daemon, are spooled too (see KegnetClient's `require_core`).
+
+  Spooled messages are sent by Replay(), which should be called regularly.
+  """
+  def __init__(self, spool, replay_rate=None, clock=time.time, **kwargs):
+    kwargs.setdefault('require_core', True)
+    super(SpoolingClient, self).__init__(**kwargs)
+    if replay_rate is None:
+      replay_rate = FLAGS.spool_replay_rate
+    self._spool = spool
+    self._replay_rate = replay_rate
+    self._clock = clock
+    self._replay_budget = 0
+    self._last_replay_time = None
+    self._last_compact_time = None
+    self._retry_time = None
+
+  def send_message(self, message):
+    """Publishes or spools `message`.
+
+    Returns True if the message was received; False if it was spooled.
+    """
+    if not self._spool.GetCount() and super(SpoolingClient,
+        self).send_message(message):
+      return True
+    self._spool.Append(message, now=self._clock())
+    return False
+
+  def GetSpooledCount(self):
+    return self._spool.GetCount()
+
+  def Replay(self):
+    """Sends spooled messages, as allowed by the replay rate.
+
+    Returns the number of messages sent.
+    """
+    now = self._clock()
+    if self._last_replay_time is not None:
+      elapsed = max(0, now - self._last_replay_time)
+      self._replay_budget = min(self._replay_rate,
+          self._replay_budget + elapsed * self._replay_rate)
+    self._last_replay_time = now
+
+    if not self._spool.GetCount():
+      return 0
+    if self._retry_time is not None and now < self._retry_time:
+      return 0
+    if self._last_compact_time is None or \
+        now - self._last_compact_time >= COMPACT_INTERVAL_SECONDS:
+      self._spool.Compact()
+      self._last_compact_time = now
+
+    limit = int(self._replay_budget)
+    if not limit:
+      return 0
+    entries = self._spool.Peek(limit)
+    sent = self._publish_many([data for entry_id, data in entries])
+    if sent < len(entries):
+      self._retry_time = now + REPLAY_RETRY_SECONDS
+    else:
+      self._retry_time = None
+    if sent:
+      self._spool.Remove(entries[sent - 1][0])
+    self._replay_budget -= sent
+    if sent:
+      self._logger.info('Replayed %d spooled message(s), %d remaining.' %
+          (sent, self._spool.GetCount()))
+    return sent
@@ -0,0 +1,210 @@
+"""Unittest for spool module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import flow_meter
+from . import kbevent
+from . import spool
+
+def _MeterUpdate(meter_name, reading):
+  event = kbevent.MeterUpdate()
+  event.meter_name = meter_name
+  event.reading = reading
+  return event
+
+def _ThermoEvent(sensor_name, value, when):
+  event = kbevent.ThermoEvent()
+  event.sensor_name = sensor_name
+  event.sensor_value = value
+  event.when = when
+  return event
+
+def _TokenAdded(token_value):
+  event = kbevent.TokenAuthEvent()
+  event.meter_name = '__all_taps__'
+  event.auth_device_name = 'core.onewire'
+  event.token_value = token_value
+  event.status = event.TokenState.ADDED
+  return event
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class RecordingSpoolingClient(spool.SpoolingClient):
+  def __init__(self, *args, **kwargs):
+    super(RecordingSpoolingClient, self).__init__(*args,
+        redis_url='redis://localhost:6379/0', **kwargs)
+    self.online = True
+    self.sent = []
+
+  def _publish_many(self, datas):
+    if not self.online:
+      return 0
+    self.sent += [kbevent.DecodeEvent(data) for data in datas]
+    return len(datas)
+
+class CompactEntriesTestCase(unittest.TestCase):
+  def _Compact(self, entries, **kwargs):
+    entries = [(i, when, kind, name, value)
+        for i, (when, kind, name, value) in enumerate(entries)]
+    keep = spool.CompactEntries(entries, **kwargs)
+    return [e[1:] for e in entries if e[0] in keep]
+
+  def testMeterReadingsCollapse(self):
+    entries = [(0, 'meter', 'flow0', r) for r in range(0, 3000, 100)]
+    entries.insert(5, (0, 'meter', 'flow1', 7))
+    kept = self._Compact(entries, max_step=1000)
+    self.assertEqual([0, 7, 1000, 2000, 2900], [e[3] for e in kept])
+
+  def testSameTicksCredited(self):
+    readings = [5, 400, 900, 1300, 1350, 20, 30, 800, 1900, 2300, 2300]
+    entries = [(0, 'meter', 'flow0', r) for r in readings]
+    kept = [e[3] for e in self._Compact(entries, max_step=1000)]
+    self.assertTrue(len(kept) < len(readings))
+
+    def Replay(values):
+      meter = flow_meter.FlowMeter('flow0', 1000)
+      for value in values:
+        meter.SetTicks(value)
+      return meter.GetTicks()
+    self.assertEqual(Replay(readings), Replay(kept))
+
+  def testBoundaries(self):
+    entries = [
+      (0, 'meter', 'flow0', 100),
+      (0, 'meter', 'flow0', 200),
+      (0, 'meter', 'flow0', 300),
+      (0, 'other', None, None),
+      (0, 'meter', 'flow0', 400),
+      (0, 'meter', 'flow0', 500),
+    ]
+    kept = self._Compact(entries)
+    self.assertEqual([100, 300, None, 500], [e[3] for e in kept])
+
+  def testThermoGrouped(self):
+    entries = [(t, 'thermo', 'thermo0', 4.0) for t in range(0, 130, 5)]
+    kept = self._Compact(entries, thermo_interval=60)
+    self.assertEqual([55, 115, 125], [e[0] for e in kept])
+
+  def testMergeThermoEvents(self):
+    events = [_ThermoEvent('thermo0', value, 1000 + i)
+        for i, value in enumerate((2.0, 6.0, 1000.0, 4.0))]
+    merged = spool.MergeThermoEvents(events[:2])
+    merged = spool.MergeThermoEvents([merged] + events[2:])
+    self.assertEqual((3, 2.0, 6.0, 4.0, 4.0, 1003), (merged.reading_count,
+        merged.min_value, merged.max_value, merged.mean_value,
+        merged.sensor_value, merged.when))
+
+class SpoolTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'spool.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testBounded(self):
+    s = spool.Spool(self.path, max_messages=3)
+    for i in range(5):
+      s.Append(_TokenAdded('token%d' % i))
+    self.assertEqual(3, s.GetCount())
+    values = [kbevent.DecodeEvent(data).token_value for i, data in s.Peek(10)]
+    self.assertEqual(['token2', 'token3', 'token4'], values)
+    s.Close()
+
+  def testFullSpoolCompacted(self):
+    s = spool.Spool(self.path, max_messages=3)
+    for reading in (0, 10, 20, 30):
+      s.Append(_MeterUpdate('flow0', reading))
+    readings = [kbevent.DecodeEvent(data).reading for i, data in s.Peek(10)]
+    self.assertEqual([0, 20, 30], readings)
+    s.Close()
+
+  def testThermoMerged(self):
+    s = spool.Spool(self.path)
+    for i, value in enumerate((2.0, 6.0, 4.0)):
+      s.Append(_ThermoEvent('thermo0', value, 60 + i), now=60 + i)
+    s.Append(_ThermoEvent('thermo0', 5.0, 120), now=120)
+    self.assertEqual(2, s.Compact())
+    events = [kbevent.DecodeEvent(data) for i, data in s.Peek(10)]
+    self.assertEqual([(3, 4.0, 4.0), (None, None, 5.0)], [(e.reading_count,
+        e.mean_value, e.sensor_value) for e in events])
+    s.Close()
+
+  def testPersistent(self):
+    s = spool.Spool(self.path)
+    s.Append(_TokenAdded('token0'))
+    s.Append(_TokenAdded('token1'))
+    s.Remove(s.Peek(1)[0][0])
+    s.Close()
+
+    s = spool.Spool(self.path)
+    self.assertEqual(1, s.GetCount())
+    self.assertEqual('token1',
+        kbevent.DecodeEvent(s.Peek(1)[0][1]).token_value)
+    s.Close()
+
+class SpoolingClientTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.spool = spool.Spool(os.path.join(self.tempdir, 'spool.db'))
+    self.clock = FakeClock()
+    self.client = RecordingSpoolingClient(self.spool, replay_rate=10,
+        clock=self.clock)
+
+  def tearDown(self):
+    self.spool.Close()
+    shutil.rmtree(self.tempdir)
+
+  def testSpoolAndReplay(self):
+    self.assertTrue(self.client._require_core)
+    self.assertTrue(self.client.SendMeterUpdate('flow0', 0))
+    self.client.online = False
+    self.client.SendAuthTokenAdd('__all_taps__', 'core.onewire', 'abc')
+    for reading in range(10, 110, 10):
+      self.assertFalse(self.client.SendMeterUpdate('flow0', reading))
+    self.client.online = True
+
+    # Messages are spooled behind earlier ones, even when online.
+    self.assertFalse(self.client.SendMeterUpdate('flow0', 110))
+    self.assertEqual(12, self.client.GetSpooledCount())
+
+    # Replay is compacted, and limited to the replay rate.
+    self.client.Replay()
+    self.clock.now += 0.2
+    self.assertEqual(2, self.client.Replay())
+    self.assertEqual(1, self.client.GetSpooledCount())
+    self.clock.now += 1
+    self.assertEqual(1, self.client.Replay())
+    self.assertEqual(0, self.client.GetSpooledCount())
+
+    sent = self.client.sent
+    self.assertIsInstance(sent[1], kbevent.TokenAuthEvent)
+    self.assertEqual([0, 10, 110], [e.reading for e in sent
+        if isinstance(e, kbevent.MeterUpdate)])
+    # Replayed readings carry the time they were spooled.
+    self.assertEqual([None, 1000.0, 1000.0], [e.when for e in sent
+        if isinstance(e, kbevent.MeterUpdate)])
+    self.assertTrue(self.client.SendMeterUpdate('flow0', 120))
+
+  def testReplayStopsOnFailure(self):
+    self.client.online = False
+    self.client.SendAuthTokenAdd('__all_taps__', 'core.onewire', 'abc')
+    self.client.Replay()
+    self.clock.now += 1
+    self.assertEqual(0, self.client.Replay())
+    self.assertEqual(1, self.client.GetSpooledCount())
+
+    self.client.online = True
+    self.clock.now += spool.REPLAY_RETRY_SECONDS
+    self.assertEqual(1, self.client.Replay())
+
+if __name__ == '__main__':
+  unittest.main()
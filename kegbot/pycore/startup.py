@@ -0,0 +1,84 @@
+"""Startup timing for the core.
+
+The start time is taken when this module is first imported, so programs should
+import it before anything else.  If the KEGBOT_PROFILE_IMPORTS environment
+variable is set, InstallImportTimer also times every module imported from then
+on, and LogStartupReport lists the slowest ones.  (Flags are not parsed until
+all modules are imported, so an environment variable is used instead.)
+"""
+
+import builtins
+import logging
+import os
+import sys
+import time
+
+_START_TIME = time.time()
+
+_import_times = {}
+_original_import = None
+
+PROFILE_IMPORTS_ENV = 'KEGBOT_PROFILE_IMPORTS'
+
+
+def GetElapsed():
+  """Returns seconds elapsed since the start of the program."""
+  return time.time() - _START_TIME
+
+
+def _ModuleNames(name, globals_, fromlist, level):
+  """Returns the absolute names of the modules an import statement loads."""
+  if not level:
+    return [name]
+  package = (globals_ or {}).get('__package__') or ''
+  if level > 1:
+    package = package.rsplit('.', level - 1)[0]
+  if name:
+    return ['%s.%s' % (package, name)]
+  return ['%s.%s' % (package, item) for item in fromlist or ()]
+
+
+def _TimedImport(name, globals=None, locals=None, fromlist=(), level=0):
+  names = _ModuleNames(name, globals, fromlist, level)
+  new_names = [n for n in names if n not in sys.modules]
+  if not new_names:
+    return _original_import(name, globals, locals, fromlist, level)
+  start = time.time()
+  try:
+    return _original_import(name, globals, locals, fromlist, level)
+  finally:
+    elapsed = time.time() - start
+    for module_name in new_names:
+      if module_name in sys.modules and module_name not in _import_times:
+        _import_times[module_name] = elapsed
+
+
+def InstallImportTimer():
+  """Times each new module import, including the modules it imports."""
+  global _original_import
+  if _original_import is not None:
+    return
+  _original_import = builtins.__import__
+  builtins.__import__ = _TimedImport
+
+
+def MaybeInstallImportTimer():
+  if os.environ.get(PROFILE_IMPORTS_ENV):
+    InstallImportTimer()
+
+
+def GetSlowestImports(count=15):
+  """Returns up to `count` (module name, seconds) tuples, slowest first."""
+  ret = sorted(_import_times.items(), key=lambda item: item[1], reverse=True)
+  return ret[:count]
+
+
+def LogStartupReport(logger=None):
+  if logger is None:
+    logger = logging.getLogger('startup')
+  logger.info('Started in %.3f seconds.' % GetElapsed())
+  slowest = GetSlowestImports()
+  if slowest:
+    logger.info('Slowest imports (cumulative):')
+    for name, seconds in slowest:
+      logger.info('  %8.1f ms  %s' % (seconds * 1000, name))
@@ -0,0 +1,19 @@
+"""Unittest for startup module"""
+
+import unittest
+
+from . import startup
+
+class ModuleNamesTestCase(unittest.TestCase):
+  def testModuleNames(self):
+    globals_ = {'__package__': 'kegbot.pycore'}
+    self.assertEqual(['json'], startup._ModuleNames('json', globals_, (), 0))
+    self.assertEqual(['kegbot.pycore.util'],
+        startup._ModuleNames('util', globals_, ('AttrDict',), 1))
+    self.assertEqual(['kegbot.pycore.kbevent', 'kegbot.pycore.kegnet'],
+        startup._ModuleNames('', globals_, ('kbevent', 'kegnet'), 1))
+    self.assertEqual(['kegbot.util'],
+        startup._ModuleNames('util', globals_, (), 2))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,257 @@
+"""Memory-mapped table of live pour state, for local readers.
+
+When enabled with --state_table_path, the core keeps a fixed-layout file with
+one slot per tap, describing the tap's current (or most recent) flow.  Local
+processes may map the same file with StateTableReader and poll it without
+locks, Redis or HTTP.
+
+File layout (little endian):
+
+  header: magic 'KBST', version (u32), slot count (u32), slot size (u32)
+  slots:  sequence (u64), meter name (64s), flow id (u64), ticks (i64),
+          volume in mL (f64, NaN if unknown), username (32s), state (16s),
+          update time (f64, unix seconds)
+
+Slots are updated seqlock-style: the writer makes the sequence odd, writes the
+slot, then makes it even again.  A reader retries a slot if the sequence is odd
+or changes while it is being read.  Slots are assigned to meters in order of
+first use and are never reused while the core runs.
+
+The file is never resized in place, which would fault readers mapping it.
+Each time the core starts, it writes a new file and renames it over the old
+one.  Readers keep the old mapping until they notice the file was replaced,
+then open the new one.
+"""
+
+from builtins import object
+import datetime
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+
+import gflags
+
+from . import kbevent
+from .util import AttrDict
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string('state_table_path', '',
+    'If set, the state of each tap\'s flow is published to a memory-mapped '
+    'file at this path.')
+
+gflags.DEFINE_integer('state_table_slots', 16,
+    'Number of tap slots in the state table.',
+    lower_bound=1)
+
+MAGIC = b'KBST'
+VERSION = 1
+
+HEADER = struct.Struct('<4sIII')
+SEQUENCE = struct.Struct('<Q')
+SLOT_BODY = struct.Struct('<64sQqd32s16sd')
+SLOT_SIZE = SEQUENCE.size + SLOT_BODY.size
+
+MAX_READ_ATTEMPTS = 100
+
+
+class StateTableError(Exception):
+  """The state table file is missing or malformed."""
+
+
+def _SlotOffset(index):
+  return HEADER.size + index * SLOT_SIZE
+
+
+def _Encode(value, size):
+  return (value or '').encode('utf-8')[:size]
+
+
+def _Decode(value):
+  return value.rstrip(b'\0').decode('utf-8', 'replace')
+
+
+class StateTable(object):
+  """Writer side of the state table.  Only one writer may use a file."""
+  def __init__(self, path, slots=16):
+    self._logger = logging.getLogger('state-table')
+    self._num_slots = slots
+    self._slots = {}
+    self._sequences = [0] * slots
+    self._lock = threading.Lock()
+
+    # Start from a clean table; slot assignment does not survive restarts.
+    size = _SlotOffset(slots)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+      os.ftruncate(fd, size)
+      self._mmap = mmap.mmap(fd, size)
+      HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, slots, SLOT_SIZE)
+      os.replace(tmp_path, path)
+    except:
+      os.unlink(tmp_path)
+      raise
+    finally:
+      os.close(fd)
+
+  def Close(self):
+    with self._lock:
+      self._mmap.close()
+
+  def _GetSlot(self, meter_name):
+    index = self._slots.get(meter_name)
+    if index is None:
+      if len(self._slots) >= self._num_slots:
+        return None
+      index = self._slots[meter_name] = len(self._slots)
+    return index
+
+  def Update(self, meter_name, flow_id, ticks, volume_ml, username, state,
+      when):
+    """Writes the state of the flow on `meter_name`."""
+    with self._lock:
+      index = self._GetSlot(meter_name)
+      if index is None:
+        self._logger.warning('No free slot for meter %s' % meter_name)
+        return
+      offset = _SlotOffset(index)
+      if volume_ml is None:
+        volume_ml = float('nan')
+
+      sequence = self._sequences[index] + 1
+      SEQUENCE.pack_into(self._mmap, offset, sequence)
+      SLOT_BODY.pack_into(self._mmap, offset + SEQUENCE.size,
+          _Encode(meter_name, 64), flow_id, ticks, volume_ml,
+          _Encode(username, 32), _Encode(state, 16), when.timestamp())
+      sequence += 1
+      SEQUENCE.pack_into(self._mmap, offset, sequence)
+      self._sequences[index] = sequence
+
+  def UpdateFlow(self, event):
+    """Writes the state described by a FlowUpdate event."""
+    self.Update(event.meter_name, event.flow_id, event.ticks, event.volume_ml,
+        event.username, event.state, event.last_activity_time)
+
+
+class StateTableReader(object):
+  """Lock-free reader of a state table written by another process.
+
+  If the file is replaced, as when the core restarts, the new file is opened
+  on the next read, and all its taps are reported as changed.
+  """
+  def __init__(self, path):
+    self._path = path
+    self._mmap = None
+    self._Open()
+
+  def _Open(self):
+    path = self._path
+    with open(path, 'rb') as f:
+      inode = os.fstat(f.fileno()).st_ino
+      try:
+        new_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError:
+        raise StateTableError('State table is empty: %s' % path)
+    try:
+      num_slots = self._CheckHeader(new_mmap)
+    except StateTableError:
+      new_mmap.close()
+      raise
+    if self._mmap is not None:
+      self._mmap.close()
+    self._mmap = new_mmap
+    self._inode = inode
+    self._num_slots = num_slots
+    self._last_sequences = [0] * self._num_slots
+
+  def _CheckHeader(self, table):
+    """Returns the slot count of mapped `table`, if it is valid."""
+    path = self._path
+    if len(table) < HEADER.size:
+      raise StateTableError('State table is truncated: %s' % path)
+    magic, version, num_slots, slot_size = HEADER.unpack_from(table, 0)
+    if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+      raise StateTableError('Unrecognized state table: %s' % path)
+    if len(table) < _SlotOffset(num_slots):
+      raise StateTableError('State table is truncated: %s' % path)
+    return num_slots
+
+  def _MaybeReopen(self):
+    """Opens the file again if it was replaced since it was opened."""
+    try:
+      inode = os.stat(self._path).st_ino
+    except OSError:
+      return
+    if inode == self._inode:
+      return
+    try:
+      self._Open()
+    except (IOError, StateTableError) as e:
+      # Keep reading the old table, and try again on the next read.
+      logging.getLogger('state-table').warning(
+          'Could not reopen state table: %s' % e)
+
+  def Close(self):
+    self._mmap.close()
+
+  def _ReadSlot(self, index):
+    """Returns (sequence, body) of a consistent read of slot `index`."""
+    offset = _SlotOffset(index)
+    for i in range(MAX_READ_ATTEMPTS):
+      sequence, = SEQUENCE.unpack_from(self._mmap, offset)
+      if sequence % 2:
+        continue
+      body = SLOT_BODY.unpack_from(self._mmap, offset + SEQUENCE.size)
+      if SEQUENCE.unpack_from(self._mmap, offset)[0] == sequence:
+        return sequence, body
+    return None, None
+
+  def _BuildFlow(self, body):
+    meter_name, flow_id, ticks, volume_ml, username, state, when = body
+    if math.isnan(volume_ml):
+      volume_ml = None
+    return AttrDict({
+      'meter_name': _Decode(meter_name),
+      'flow_id': flow_id,
+      'ticks': ticks,
+      'volume_ml': volume_ml,
+      'username': _Decode(username),
+      'state': _Decode(state),
+      'last_activity_time': datetime.datetime.fromtimestamp(when),
+    })
+
+  def ReadFlows(self):
+    """Returns the state of every tap in use, as a list of AttrDicts."""
+    self._MaybeReopen()
+    ret = []
+    for index in range(self._num_slots):
+      sequence, body = self._ReadSlot(index)
+      if sequence:
+        ret.append(self._BuildFlow(body))
+    return ret
+
+  def ReadChangedFlows(self):
+    """Like ReadFlows, but only returns taps updated since the last call."""
+    self._MaybeReopen()
+    ret = []
+    for index in range(self._num_slots):
+      sequence, body = self._ReadSlot(index)
+      if not sequence or sequence == self._last_sequences[index]:
+        continue
+      self._last_sequences[index] = sequence
+      ret.append(self._BuildFlow(body))
+    return ret
+
+  def GetFlowUpdates(self):
+    """Returns changed taps as FlowUpdate events."""
+    ret = []
+    for flow in self.ReadChangedFlows():
+      event = kbevent.FlowUpdate()
+      for name, value in flow.items():
+        setattr(event, name, value)
+      ret.append(event)
+    return ret
@@ -0,0 +1,112 @@
+"""Unittest for state_table module"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import kbevent
+from . import manager
+from . import state_table
+
+class StateTableTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'state')
+    self.table = state_table.StateTable(self.path, slots=2)
+    self.reader = state_table.StateTableReader(self.path)
+    self.when = datetime.datetime(2020, 1, 1, 12, 0, 0)
+
+  def tearDown(self):
+    self.reader.Close()
+    self.table.Close()
+    shutil.rmtree(self.tempdir)
+
+  def testEmptyTable(self):
+    self.assertEqual([], self.reader.ReadFlows())
+
+  def testUpdate(self):
+    self.table.Update('kegboard.flow0', 42, 100, 45.5, 'guest', 'active',
+        self.when)
+    self.table.Update('kegboard.flow1', 43, 10, None, None, 'active',
+        self.when)
+    self.table.Update('kegboard.flow0', 42, 200, 91.0, 'guest', 'completed',
+        self.when)
+
+    flows = self.reader.ReadFlows()
+    self.assertEqual(['kegboard.flow0', 'kegboard.flow1'],
+        [f.meter_name for f in flows])
+    self.assertEqual(42, flows[0].flow_id)
+    self.assertEqual(200, flows[0].ticks)
+    self.assertEqual(91.0, flows[0].volume_ml)
+    self.assertEqual('guest', flows[0].username)
+    self.assertEqual('completed', flows[0].state)
+    self.assertEqual(self.when, flows[0].last_activity_time)
+    self.assertIsNone(flows[1].volume_ml)
+    self.assertEqual('', flows[1].username)
+
+  def testReadChangedFlows(self):
+    self.table.Update('kegboard.flow0', 42, 100, 45.5, 'guest', 'active',
+        self.when)
+    self.assertEqual(1, len(self.reader.ReadChangedFlows()))
+    self.assertEqual([], self.reader.ReadChangedFlows())
+
+    self.table.Update('kegboard.flow1', 43, 10, None, None, 'active',
+        self.when)
+    events = self.reader.GetFlowUpdates()
+    self.assertEqual(1, len(events))
+    self.assertIsInstance(events[0], kbevent.FlowUpdate)
+    self.assertEqual('kegboard.flow1', events[0].meter_name)
+
+  def testSlotsExhausted(self):
+    for i in range(3):
+      self.table.Update('flow%d' % i, i, 0, None, None, 'active', self.when)
+    self.assertEqual(['flow0', 'flow1'],
+        [f.meter_name for f in self.reader.ReadFlows()])
+
+  def testFlowManagerUpdates(self):
+    event_hub = kbevent.EventHub()
+    tap_manager = manager.TapManager(event_hub, None)
+    flow_manager = manager.FlowManager(event_hub, tap_manager,
+        state_table=self.table)
+    flow_manager.UpdateFlow('flow0', 2000)
+    flow_manager.UpdateFlow('flow0', 2100)
+
+    flows = self.reader.ReadFlows()
+    self.assertEqual(1, len(flows))
+    self.assertEqual(100, flows[0].ticks)
+    self.assertEqual('active', flows[0].state)
+
+    flow_manager.StopFlow('flow0')
+    self.assertEqual('completed', self.reader.ReadFlows()[0].state)
+
+  def testCoreRestart(self):
+    self.table.Update('kegboard.flow0', 42, 100, 45.5, 'guest', 'active',
+        self.when)
+    self.assertEqual(1, len(self.reader.ReadChangedFlows()))
+
+    # The restarted core replaces the file; the old mapping stays readable.
+    old_mmap = self.reader._mmap
+    self.table.Close()
+    self.table = state_table.StateTable(self.path, slots=3)
+    self.assertEqual((2,), state_table.SEQUENCE.unpack_from(old_mmap,
+        state_table._SlotOffset(0)))
+    self.assertEqual(['state'], os.listdir(self.tempdir))
+
+    self.assertEqual([], self.reader.ReadChangedFlows())
+    self.table.Update('kegboard.flow0', 43, 10, None, 'guest', 'active',
+        self.when)
+    flows = self.reader.ReadChangedFlows()
+    self.assertEqual([43], [f.flow_id for f in flows])
+    self.assertEqual(3, self.reader._num_slots)
+
+  def testBadFile(self):
+    path = os.path.join(self.tempdir, 'bad')
+    with open(path, 'wb') as f:
+      f.write(b'x' * 64)
+    self.assertRaises(state_table.StateTableError,
+        state_table.StateTableReader, path)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,227 @@
+"""Local history of drinks and sensor readings.
+
+When enabled with --local_store_path, the core records completed pours and
+per-minute sensor summaries to a SQLite database in WAL mode.  Other local
+processes (displays, tools) may open the same file with LocalStore to answer
+questions such as "last drinks on this tap" without a trip to the server.
+
+Writes are buffered and committed in batches by Flush(), except for the
+queue of drinks not yet recorded by the server (see the offline module), which
+is committed immediately.
+"""
+
+from builtins import object
+import datetime
+import logging
+import sqlite3
+import threading
+
+import gflags
+
+from .util import AttrDict
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string('local_store_path', '',
+    'If set, drinks and sensor readings are also recorded to a local SQLite '
+    'database at this path.')
+
+SCHEMA = (
+  '''CREATE TABLE IF NOT EXISTS drinks (
+    flow_id INTEGER PRIMARY KEY,
+    meter_name TEXT NOT NULL,
+    drink_id INTEGER,
+    keg_id INTEGER,
+    username TEXT,
+    ticks INTEGER NOT NULL,
+    volume_ml REAL,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL
+  )''',
+  'CREATE INDEX IF NOT EXISTS drinks_by_meter ON drinks (meter_name, end_time)',
+  'CREATE INDEX IF NOT EXISTS drinks_by_keg ON drinks (keg_id, end_time)',
+  'CREATE INDEX IF NOT EXISTS drinks_by_time ON drinks (end_time)',
+  '''CREATE TABLE IF NOT EXISTS sensor_readings (
+    sensor_name TEXT NOT NULL,
+    time REAL NOT NULL,
+    count INTEGER NOT NULL,
+    min REAL,
+    max REAL,
+    mean REAL,
+    last REAL
+  )''',
+  '''CREATE INDEX IF NOT EXISTS sensor_readings_by_sensor
+    ON sensor_readings (sensor_name, time)''',
+  '''CREATE TABLE IF NOT EXISTS drink_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue_name TEXT NOT NULL,
+    data TEXT NOT NULL
+  )''',
+)
+
+DRINK_COLUMNS = ('flow_id', 'meter_name', 'drink_id', 'keg_id', 'username',
+    'ticks', 'volume_ml', 'start_time', 'end_time')
+
+SENSOR_COLUMNS = ('sensor_name', 'time', 'count', 'min', 'max', 'mean', 'last')
+
+
+def _ToTimestamp(when):
+  return when.timestamp()
+
+
+class LocalStore(object):
+  """Drinks and sensor readings stored in a local SQLite database."""
+  def __init__(self, path, read_only=False):
+    self._logger = logging.getLogger('local-store')
+    if read_only:
+      self._conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True,
+          check_same_thread=False)
+    else:
+      self._conn = sqlite3.connect(path, check_same_thread=False)
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      self._conn.execute('PRAGMA synchronous=NORMAL')
+      with self._conn:
+        for statement in SCHEMA:
+          self._conn.execute(statement)
+    self._lock = threading.Lock()
+    self._pending_drinks = []
+    self._pending_recorded = []
+    self._pending_readings = []
+
+  def Close(self):
+    self.Flush()
+    with self._lock:
+      self._conn.close()
+
+  def AddDrink(self, flow_id, meter_name, ticks, volume_ml, username,
+      start_time, end_time):
+    """Buffers a completed pour."""
+    with self._lock:
+      self._pending_drinks.append((flow_id, meter_name, username, ticks,
+          volume_ml, _ToTimestamp(start_time), _ToTimestamp(end_time)))
+
+  def SetDrinkRecorded(self, flow_id, drink_id, keg_id=None):
+    """Buffers the server drink and keg ids of a pour added with AddDrink."""
+    with self._lock:
+      self._pending_recorded.append((drink_id, keg_id, flow_id))
+
+  def AddSensorReading(self, sensor_name, when, count, min_value, max_value,
+      mean, last):
+    """Buffers the summary of a sensor's readings starting at `when`."""
+    with self._lock:
+      self._pending_readings.append((sensor_name, _ToTimestamp(when), count,
+          min_value, max_value, mean, last))
+
+  def Flush(self):
+    """Commits all buffered writes in a single transaction."""
+    with self._lock:
+      if not (self._pending_drinks or self._pending_recorded or
+          self._pending_readings):
+        return
+      try:
+        with self._conn:
+          self._conn.executemany('INSERT OR REPLACE INTO drinks '
+              '(flow_id, meter_name, username, ticks, volume_ml, start_time, '
+              'end_time) VALUES (?, ?, ?, ?, ?, ?, ?)', self._pending_drinks)
+          self._conn.executemany('UPDATE drinks SET drink_id=?, keg_id=? '
+              'WHERE flow_id=?', self._pending_recorded)
+          self._conn.executemany('INSERT INTO sensor_readings '
+              'VALUES (?, ?, ?, ?, ?, ?, ?)', self._pending_readings)
+      except sqlite3.Error as e:
+        self._logger.warning('Error writing to local store: %s' % e)
+      del self._pending_drinks[:]
+      del self._pending_recorded[:]
+      del self._pending_readings[:]
+
+  def AddQueuedDrink(self, queue_name, data):
+    """Adds `data`, an encoded drink, to the end of queue `queue_name`.
+
+    Returns the id of the queued drink, or None if it could not be written.
+    """
+    with self._lock:
+      try:
+        with self._conn:
+          return self._conn.execute('INSERT INTO drink_queue (queue_name, '
+              'data) VALUES (?, ?)', (queue_name, data)).lastrowid
+      except sqlite3.Error as e:
+        self._logger.warning('Error writing to local store: %s' % e)
+        return None
+
+  def RemoveQueuedDrink(self, queued_id):
+    with self._lock:
+      try:
+        with self._conn:
+          self._conn.execute('DELETE FROM drink_queue WHERE id = ?',
+              (queued_id,))
+      except sqlite3.Error as e:
+        self._logger.warning('Error writing to local store: %s' % e)
+
+  def GetQueuedDrinks(self, queue_name):
+    """Returns the (id, data) of each drink in queue `queue_name`, in order."""
+    return self._Query('SELECT id, data FROM drink_queue WHERE queue_name=? '
+        'ORDER BY id', (queue_name,))
+
+  def _Query(self, sql, params):
+    with self._lock:
+      return self._conn.execute(sql, params).fetchall()
+
+  def GetLastDrinks(self, meter_name=None, count=10):
+    """Returns the latest `count` drinks, newest first.
+
+    If `meter_name` is given, only drinks poured on that meter are returned.
+    Each drink is an AttrDict with keys from DRINK_COLUMNS; times are
+    datetimes.
+    """
+    sql = 'SELECT %s FROM drinks' % ', '.join(DRINK_COLUMNS)
+    params = []
+    if meter_name is not None:
+      sql += ' WHERE meter_name=?'
+      params.append(meter_name)
+    sql += ' ORDER BY end_time DESC LIMIT ?'
+    params.append(count)
+
+    ret = []
+    for row in self._Query(sql, params):
+      drink = AttrDict(dict(zip(DRINK_COLUMNS, row)))
+      drink.start_time = datetime.datetime.fromtimestamp(drink.start_time)
+      drink.end_time = datetime.datetime.fromtimestamp(drink.end_time)
+      ret.append(drink)
+    return ret
+
+  def GetLastSensorReadings(self, sensor_name=None, count=10):
+    """Returns the latest `count` sensor summaries, newest first.
+
+    If `sensor_name` is given, only that sensor's summaries are returned.
+    Each summary is an AttrDict with keys from SENSOR_COLUMNS; `time` is the
+    start of the summarized minute, as a datetime.
+    """
+    sql = 'SELECT %s FROM sensor_readings' % ', '.join(SENSOR_COLUMNS)
+    params = []
+    if sensor_name is not None:
+      sql += ' WHERE sensor_name=?'
+      params.append(sensor_name)
+    sql += ' ORDER BY time DESC LIMIT ?'
+    params.append(count)
+
+    ret = []
+    for row in self._Query(sql, params):
+      reading = AttrDict(dict(zip(SENSOR_COLUMNS, row)))
+      reading.time = datetime.datetime.fromtimestamp(reading.time)
+      ret.append(reading)
+    return ret
+
+  def GetVolumeByKegSince(self, since):
+    """Returns a dict of keg id to volume (mL) poured since `since`.
+
+    Only drinks already recorded by the server are attributed to a keg.
+    """
+    rows = self._Query('SELECT keg_id, SUM(volume_ml) FROM drinks '
+        'WHERE end_time >= ? AND keg_id IS NOT NULL GROUP BY keg_id',
+        (_ToTimestamp(since),))
+    return dict(rows)
+
+  def GetVolumeByMeterSince(self, since):
+    """Returns a dict of meter name to volume (mL) poured since `since`."""
+    rows = self._Query('SELECT meter_name, SUM(volume_ml) FROM drinks '
+        'WHERE end_time >= ? GROUP BY meter_name', (_ToTimestamp(since),))
+    return dict(rows)
@@ -0,0 +1,90 @@
+"""Unittest for store module"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import store
+
+class LocalStoreTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'kegbot.db')
+    self.store = store.LocalStore(self.path)
+    self.start = datetime.datetime(2020, 1, 1, 12, 0, 0)
+
+  def tearDown(self):
+    self.store.Close()
+    shutil.rmtree(self.tempdir)
+
+  def _AddDrink(self, flow_id, meter_name, volume_ml, minutes):
+    start_time = self.start + datetime.timedelta(minutes=minutes)
+    end_time = start_time + datetime.timedelta(seconds=10)
+    self.store.AddDrink(flow_id, meter_name, int(volume_ml * 2.2), volume_ml,
+        'guest', start_time, end_time)
+
+  def testDrinksBufferedUntilFlush(self):
+    self._AddDrink(1, 'kegboard.flow0', 300, 0)
+    self.assertEqual([], self.store.GetLastDrinks())
+    self.store.Flush()
+    drinks = self.store.GetLastDrinks()
+    self.assertEqual(1, len(drinks))
+    self.assertEqual('kegboard.flow0', drinks[0].meter_name)
+    self.assertEqual(self.start, drinks[0].start_time)
+    self.assertIsNone(drinks[0].drink_id)
+
+  def testLastDrinks(self):
+    self._AddDrink(1, 'kegboard.flow0', 300, 0)
+    self._AddDrink(2, 'kegboard.flow1', 200, 1)
+    self._AddDrink(3, 'kegboard.flow0', 100, 2)
+    self.store.Flush()
+
+    drinks = self.store.GetLastDrinks()
+    self.assertEqual([3, 2, 1], [d.flow_id for d in drinks])
+    drinks = self.store.GetLastDrinks(meter_name='kegboard.flow0', count=1)
+    self.assertEqual([3], [d.flow_id for d in drinks])
+
+  def testSensorReadings(self):
+    self.store.AddSensorReading('sensor0', self.start, 3, 2.0, 4.0, 3.0, 4.0)
+    self.store.AddSensorReading('sensor1', self.start, 1, 9.0, 9.0, 9.0, 9.0)
+    self.store.AddSensorReading('sensor0',
+        self.start + datetime.timedelta(minutes=1), 1, 5.0, 5.0, 5.0, 5.0)
+    self.assertEqual([], self.store.GetLastSensorReadings())
+    self.store.Flush()
+
+    readings = self.store.GetLastSensorReadings(sensor_name='sensor0')
+    self.assertEqual([5.0, 3.0], [r.mean for r in readings])
+    self.assertEqual(self.start, readings[1].time)
+    self.assertEqual((3, 2.0, 4.0, 4.0),
+        (readings[1].count, readings[1].min, readings[1].max, readings[1].last))
+    self.assertEqual(3, len(self.store.GetLastSensorReadings()))
+
+  def testVolumeSince(self):
+    self._AddDrink(1, 'kegboard.flow0', 300, 0)
+    self._AddDrink(2, 'kegboard.flow1', 200, 1)
+    self._AddDrink(3, 'kegboard.flow0', 100, 2)
+    self.store.SetDrinkRecorded(1, 101, keg_id=7)
+    self.store.SetDrinkRecorded(3, 103, keg_id=7)
+    self.store.Flush()
+
+    self.assertEqual({'kegboard.flow0': 400, 'kegboard.flow1': 200},
+        self.store.GetVolumeByMeterSince(self.start))
+    self.assertEqual({'kegboard.flow0': 100, 'kegboard.flow1': 200},
+        self.store.GetVolumeByMeterSince(self.start + datetime.timedelta(minutes=1)))
+    self.assertEqual({7: 400}, self.store.GetVolumeByKegSince(self.start))
+
+  def testReadOnly(self):
+    self._AddDrink(1, 'kegboard.flow0', 300, 0)
+    self.store.AddSensorReading('thermo-0', self.start, 60, 3.5, 4.5, 4.0, 4.1)
+    self.store.Flush()
+
+    reader = store.LocalStore(self.path, read_only=True)
+    try:
+      self.assertEqual([1], [d.flow_id for d in reader.GetLastDrinks()])
+    finally:
+      reader.Close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,251 @@
+"""Multi-process core: a supervisor and its worker processes.
+
+In supervisor mode, the core forks one worker process per `--core_workers`.
+Each worker runs a complete KegbotEnv, but only handles the controllers
+assigned to it by a partition.HashPartition, so flow, auth and drink
+processing for different kegboards runs in parallel.
+
+Workers fetch system status and auth tokens through the supervisor, which
+caches the answers and shares them between workers.  Drinks and sensor
+readings are recorded by each worker directly.
+"""
+
+from builtins import object
+import logging
+import multiprocessing
+import threading
+import time
+
+import gflags
+
+from kegbot.util import util
+
+from . import backend
+from . import kbevent
+from . import kegnet
+from . import offline
+from . import partition
+from . import store
+from . import tracing
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('core_workers', 0,
+    'If greater than zero, the core runs as a supervisor of this many worker '
+    'processes, each handling a share of the controllers.',
+    lower_bound=0)
+
+gflags.DEFINE_integer('broker_cache_seconds', 10,
+    'Number of seconds the supervisor reuses a system status or auth token '
+    'fetched on behalf of a worker.',
+    lower_bound=0)
+
+# Backend calls made by workers through the supervisor.
+BROKERED_METHODS = ('GetStatus', 'GetAllTaps', 'GetAuthToken')
+
+# Maximum number of cached answers kept before expired ones are pruned.
+MAX_CACHE_ENTRIES = 1000
+
+
+class BrokeredBackend(backend.Backend):
+  """Backend used by a worker process.
+
+  Calls in BROKERED_METHODS are sent to the supervisor over `conn`; all
+  others are made directly against `delegate`.
+  """
+  def __init__(self, conn, delegate):
+    self._conn = conn
+    self._delegate = delegate
+    self._lock = threading.Lock()
+
+  def _Call(self, method, *args):
+    with self._lock:
+      try:
+        self._conn.send((method, args))
+        ok, result = self._conn.recv()
+      except (EOFError, IOError) as e:
+        raise backend.BackendException('Supervisor unavailable: %s' % e)
+    if not ok:
+      raise result
+    return result
+
+  def GetStatus(self):
+    return self._Call('GetStatus')
+
+  def GetAllTaps(self):
+    return self._Call('GetAllTaps')
+
+  def GetAuthToken(self, auth_device, token_value):
+    return self._Call('GetAuthToken', auth_device, token_value)
+
+  def RecordDrink(self, *args, **kwargs):
+    return self._delegate.RecordDrink(*args, **kwargs)
+
+  def RecordDrinks(self, drinks):
+    return self._delegate.RecordDrinks(drinks)
+
+  def SetDrinkRecordedCallback(self, callback):
+    self._delegate.SetDrinkRecordedCallback(callback)
+
+  def CancelDrink(self, *args, **kwargs):
+    return self._delegate.CancelDrink(*args, **kwargs)
+
+  def LogSensorReading(self, *args, **kwargs):
+    return self._delegate.LogSensorReading(*args, **kwargs)
+
+  def LogSensorReadings(self, *args, **kwargs):
+    return self._delegate.LogSensorReadings(*args, **kwargs)
+
+  def CreateController(self, *args, **kwargs):
+    return self._delegate.CreateController(*args, **kwargs)
+
+  def GetLatencyStats(self):
+    return self._delegate.GetLatencyStats()
+
+
+class Broker(object):
+  """Answers brokered backend calls, caching successful results."""
+  def __init__(self, backend_obj, cache_seconds=None):
+    self._backend = backend_obj
+    if cache_seconds is None:
+      cache_seconds = FLAGS.broker_cache_seconds
+    self._cache_seconds = cache_seconds
+    self._cache = {}
+    self._lock = threading.Lock()
+
+  def Call(self, method, args):
+    if method not in BROKERED_METHODS:
+      raise ValueError('Method not brokered: %s' % method)
+    key = (method,) + tuple(args)
+    now = time.time()
+    with self._lock:
+      cached = self._cache.get(key)
+      if cached and cached[0] > now:
+        return cached[1]
+
+    result = getattr(self._backend, method)(*args)
+
+    with self._lock:
+      if len(self._cache) >= MAX_CACHE_ENTRIES:
+        for k in [k for k, v in self._cache.items() if v[0] <= now]:
+          del self._cache[k]
+      self._cache[key] = (now + self._cache_seconds, result)
+    return result
+
+  def HandleRequest(self, conn):
+    """Reads one request from `conn` and sends back the reply."""
+    method, args = conn.recv()
+    try:
+      reply = (True, self.Call(method, args))
+    except Exception as e:
+      reply = (False, e)
+    conn.send(reply)
+
+
+class BrokerThread(util.KegbotThread):
+  """Serves brokered calls from a single worker."""
+  def __init__(self, name, broker, conn):
+    super(BrokerThread, self).__init__(name)
+    self._broker = broker
+    self._conn = conn
+
+  def ThreadMain(self):
+    while not self._quit:
+      try:
+        if self._conn.poll(0.5):
+          self._broker.HandleRequest(self._conn)
+      except (EOFError, IOError):
+        self._logger.info('Worker channel closed.')
+        return
+
+
+def RunWorker(index, count, conn, env_factory):
+  """Entry point of a worker process."""
+  logger = logging.getLogger('core-worker-%d' % index)
+  ownership = partition.HashPartition(index, count)
+  logger.info('Worker starting: %s' % ownership)
+
+  # Each worker owns different meters, so keeps its own snapshot, state table
+  # and trace file.
+  if FLAGS.snapshot_path:
+    FLAGS.snapshot_path = '%s.%d' % (FLAGS.snapshot_path, index)
+  if FLAGS.state_table_path:
+    FLAGS.state_table_path = '%s.%d' % (FLAGS.state_table_path, index)
+  if FLAGS.trace_file:
+    FLAGS.trace_file = '%s.%d' % (FLAGS.trace_file, index)
+  # Every worker must see every event, so each reads the stream in its own
+  # consumer group.
+  consumer_group = '%s.%d' % (
+      FLAGS.redis_consumer_group or kegnet.CORE_CONSUMER_GROUP, index)
+
+  local_store = None
+  if FLAGS.local_store_path:
+    local_store = store.LocalStore(FLAGS.local_store_path)
+  backend_obj = BrokeredBackend(conn, offline.BuildWebBackend(
+      local_store=local_store, queue_name=consumer_group))
+  env = env_factory(backend_obj=backend_obj, ownership=ownership,
+      consumer_group=consumer_group, local_store=local_store)
+  for thr in env.GetThreads():
+    thr.start()
+  env.GetEventHub().PublishEvent(kbevent.StartedEvent())
+
+  env.GetWatchdogThread().join()
+  logger.error('Watchdog thread exited, worker stopping.')
+
+
+class Supervisor(object):
+  """Starts, monitors and restarts the worker processes."""
+  def __init__(self, num_workers, env_factory, backend_obj=None):
+    self._num_workers = num_workers
+    self._env_factory = env_factory
+    if not backend_obj:
+      backend_obj = offline.BuildWebBackend()
+    self._broker = Broker(backend_obj)
+    # Workers inherit parsed flags, so they must be forked.
+    self._context = multiprocessing.get_context('fork')
+    self._processes = {}
+    self._threads = {}
+    self._logger = logging.getLogger('supervisor')
+
+  def Start(self):
+    # Fork all workers before starting any broker thread.
+    conns = [self._StartProcess(i) for i in range(self._num_workers)]
+    for index, conn in enumerate(conns):
+      self._StartBrokerThread(index, conn)
+
+  def _StartProcess(self, index):
+    conn, child_conn = self._context.Pipe()
+    proc = self._context.Process(target=RunWorker,
+        name='core-worker-%d' % index,
+        args=(index, self._num_workers, child_conn, self._env_factory))
+    proc.daemon = True
+    proc.start()
+    child_conn.close()
+    self._processes[index] = proc
+    self._logger.info('Started worker %d (pid %d)' % (index, proc.pid))
+    return conn
+
+  def _StartBrokerThread(self, index, conn):
+    thr = BrokerThread('broker-thread-%d' % index, self._broker, conn)
+    thr.start()
+    self._threads[index] = thr
+
+  def CheckWorkers(self):
+    """Restarts any worker process that has exited."""
+    for index, proc in list(self._processes.items()):
+      if proc.is_alive():
+        continue
+      self._logger.error('Worker %d exited with code %s; restarting.' % (
+          index, proc.exitcode))
+      self._threads[index].Quit()
+      conn = self._StartProcess(index)
+      self._StartBrokerThread(index, conn)
+
+  def Stop(self):
+    for thr in self._threads.values():
+      thr.Quit()
+    for proc in self._processes.values():
+      proc.terminate()
+    for proc in self._processes.values():
+      proc.join(2.0)
+    self._logger.info('All workers stopped.')
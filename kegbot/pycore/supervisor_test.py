@@ -0,0 +1,101 @@
+"""Unittest for supervisor and partition modules"""
+
+import multiprocessing
+import unittest
+
+from kegbot.api import kbapi
+
+from . import backend
+from . import common_defs
+from . import kbevent
+from . import partition
+from . import supervisor
+
+class PartitionTestCase(unittest.TestCase):
+  def testHashPartition(self):
+    parts = [partition.HashPartition(i, 3) for i in range(3)]
+    for i in range(20):
+      name = 'kegboard-%08x' % i
+      owners = [p for p in parts if p.OwnsController(name)]
+      self.assertEqual(1, len(owners))
+      self.assertTrue(owners[0].OwnsMeter(name + '.flow0'))
+      self.assertTrue(owners[0].OwnsMeter(name + '.flow1'))
+    self.assertRaises(ValueError, partition.HashPartition, 3, 3)
+
+  def testOwnsEvent(self):
+    class OwnsFirst(partition.Ownership):
+      def OwnsController(self, controller_name):
+        return controller_name == 'first'
+    ownership = OwnsFirst()
+
+    event = kbevent.MeterUpdate()
+    event.meter_name = 'first.flow0'
+    self.assertTrue(ownership.OwnsEvent(event))
+    event.meter_name = 'second.flow0'
+    self.assertFalse(ownership.OwnsEvent(event))
+
+    event = kbevent.TokenAuthEvent()
+    event.meter_name = common_defs.ALIAS_ALL_TAPS
+    self.assertTrue(ownership.OwnsEvent(event))
+    event.meter_name = 'second.flow1'
+    self.assertFalse(ownership.OwnsEvent(event))
+
+    event = kbevent.ThermoEvent()
+    event.sensor_name = 'second.thermo-1234'
+    self.assertFalse(ownership.OwnsEvent(event))
+
+    self.assertTrue(ownership.OwnsEvent(kbevent.HeartbeatSecondEvent()))
+
+
+class CountingBackend(backend.Backend):
+  def __init__(self):
+    self.calls = []
+
+  def GetStatus(self):
+    self.calls.append('GetStatus')
+    return {'taps': []}
+
+  def GetAuthToken(self, auth_device, token_value):
+    self.calls.append('GetAuthToken')
+    if token_value == 'unknown':
+      raise kbapi.NotFoundError('No such token')
+    return {'username': 'user-%s' % token_value}
+
+  def RecordDrink(self, *args, **kwargs):
+    self.calls.append('RecordDrink')
+
+
+class BrokerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.remote = CountingBackend()
+    self.local = CountingBackend()
+    conn, child_conn = multiprocessing.Pipe()
+    broker = supervisor.Broker(self.remote, cache_seconds=60)
+    self.thread = supervisor.BrokerThread('broker-test', broker, conn)
+    self.thread.start()
+    self.backend = supervisor.BrokeredBackend(child_conn, self.local)
+
+  def tearDown(self):
+    self.thread.Quit()
+    self.thread.join()
+
+  def testBrokeredCallsAreShared(self):
+    self.assertEqual({'taps': []}, self.backend.GetStatus())
+    self.assertEqual({'taps': []}, self.backend.GetStatus())
+    token = self.backend.GetAuthToken('core.rfid', 'abcd')
+    self.assertEqual('user-abcd', token['username'])
+    self.backend.GetAuthToken('core.rfid', 'abcd')
+    self.assertEqual(['GetStatus', 'GetAuthToken'], self.remote.calls)
+
+  def testErrorsPropagate(self):
+    self.assertRaises(kbapi.NotFoundError, self.backend.GetAuthToken,
+        'core.rfid', 'unknown')
+
+  def testOtherCallsAreLocal(self):
+    self.backend.RecordDrink('flow0', ticks=100)
+    self.assertEqual(['RecordDrink'], self.local.calls)
+    self.assertEqual([], self.remote.calls)
+
+
+if __name__ == '__main__':
+  unittest.main()
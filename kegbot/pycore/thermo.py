@@ -0,0 +1,171 @@
+"""Module for thermo sensor data structures."""
+
+from builtins import object
+import array
+import math
+
+from . import common_defs
+from . import kbevent
+
+# Offsets of each statistic within SensorWindow's array.
+_COUNT, _MIN, _MAX, _SUM, _LAST = range(5)
+
+class SensorWindow(object):
+  """Streaming statistics of one sensor's readings over a time window.
+
+  Statistics are kept in a fixed-size array, reused from one window to the
+  next.  ThermoManager posts the mean to the backend, and records the whole
+  window to the local store.
+  """
+  def __init__(self, sensor_name):
+    self._sensor_name = sensor_name
+    self._stats = array.array('d', [0.0] * 5)
+    self._start_time = None
+
+  def __str__(self):
+    if not self.GetCount():
+      return '<SensorWindow %s: empty>' % self._sensor_name
+    return '<SensorWindow %s: n=%d min=%.2f max=%.2f mean=%.2f last=%.2f>' % (
+        self._sensor_name, self.GetCount(), self.GetMin(), self.GetMax(),
+        self.GetMean(), self.GetLast())
+
+  def AddReading(self, value, when):
+    stats = self._stats
+    if not stats[_COUNT]:
+      stats[_MIN] = stats[_MAX] = value
+      self._start_time = when
+    elif value < stats[_MIN]:
+      stats[_MIN] = value
+    elif value > stats[_MAX]:
+      stats[_MAX] = value
+    stats[_COUNT] += 1
+    stats[_SUM] += value
+    stats[_LAST] = value
+
+  def AddSummary(self, count, min_value, max_value, mean, last, when):
+    """Adds `count` readings at once, given their summary."""
+    stats = self._stats
+    if not stats[_COUNT]:
+      stats[_MIN] = min_value
+      stats[_MAX] = max_value
+      self._start_time = when
+    else:
+      stats[_MIN] = min(stats[_MIN], min_value)
+      stats[_MAX] = max(stats[_MAX], max_value)
+    stats[_COUNT] += count
+    stats[_SUM] += mean * count
+    stats[_LAST] = last
+
+  def Reset(self):
+    for i in range(len(self._stats)):
+      self._stats[i] = 0.0
+    self._start_time = None
+
+  def GetSensorName(self):
+    return self._sensor_name
+
+  def GetStartTime(self):
+    """Returns the time of the first reading in the window, or None."""
+    return self._start_time
+
+  def GetCount(self):
+    return int(self._stats[_COUNT])
+
+  def GetMin(self):
+    return self._stats[_MIN]
+
+  def GetMax(self):
+    return self._stats[_MAX]
+
+  def GetMean(self):
+    count = self._stats[_COUNT]
+    if not count:
+      return None
+    return self._stats[_SUM] / count
+
+  def GetLast(self):
+    return self._stats[_LAST]
+
+
+class AnomalyDetector(object):
+  """Flags spikes, stuck readings and drift in one sensor's readings.
+
+  Keeps an exponentially weighted running mean and variance, and a much slower
+  baseline mean.  State is constant-size and nothing is allocated per reading.
+  """
+  __slots__ = ('_sensor_name', '_count', '_mean', '_var', '_baseline',
+      '_last_value', '_repeats', '_spiking', '_stuck', '_drifting')
+
+  def __init__(self, sensor_name):
+    self._sensor_name = sensor_name
+    self._count = 0
+    self._mean = 0.0
+    self._var = 0.0
+    self._baseline = 0.0
+    self._last_value = None
+    self._repeats = 0
+    self._spiking = False
+    self._stuck = False
+    self._drifting = False
+
+  def GetMean(self):
+    return self._mean
+
+  def GetStddev(self):
+    return math.sqrt(self._var)
+
+  def AddReading(self, value):
+    """Adds a reading, returning the alert it newly raises, or None.
+
+    Alerts are taken from kbevent.ThermoAlertEvent.Alert.  An alert is only
+    returned when its condition starts; it may be raised again once the
+    condition has cleared.
+    """
+    Alert = kbevent.ThermoAlertEvent.Alert
+    if value == self._last_value:
+      self._repeats += 1
+    else:
+      self._repeats = 0
+    self._last_value = value
+
+    if not self._count:
+      self._mean = self._baseline = value
+    deviation = abs(value - self._mean)
+    is_spike = (self._count >= common_defs.THERMO_WARMUP_READINGS and
+        deviation >= common_defs.THERMO_SPIKE_MIN_DEGREES and
+        deviation > common_defs.THERMO_SPIKE_SIGMAS * self.GetStddev())
+
+    self._count += 1
+    alpha = common_defs.THERMO_ANOMALY_ALPHA
+    diff = value - self._mean
+    increment = alpha * diff
+    self._mean += increment
+    self._var = (1 - alpha) * (self._var + diff * increment)
+    self._baseline += common_defs.THERMO_BASELINE_ALPHA * (value - self._baseline)
+
+    if self._count <= common_defs.THERMO_WARMUP_READINGS:
+      return None
+
+    is_stuck = self._repeats >= common_defs.THERMO_STUCK_READINGS
+    is_drifting = (abs(self._mean - self._baseline) >
+        common_defs.THERMO_DRIFT_DEGREES)
+
+    if not is_stuck:
+      self._stuck = False
+    if not is_spike:
+      self._spiking = False
+    if not is_drifting:
+      self._drifting = False
+
+    # At most one alert is raised per reading; any other condition that has
+    # started is raised on the following reading.
+    if is_stuck and not self._stuck:
+      self._stuck = True
+      return Alert.STUCK
+    elif is_spike and not self._spiking:
+      self._spiking = True
+      return Alert.SPIKE
+    elif is_drifting and not self._drifting:
+      self._drifting = True
+      return Alert.DRIFT
+    return None
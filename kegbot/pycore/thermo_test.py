@@ -0,0 +1,90 @@
+"""Unittest for thermo module"""
+
+import datetime
+import unittest
+
+from . import common_defs
+from . import kbevent
+from . import thermo
+
+class SensorWindowTestCase(unittest.TestCase):
+  def setUp(self):
+    self.window = thermo.SensorWindow('sensor0')
+
+  def testStatistics(self):
+    self.assertEqual(0, self.window.GetCount())
+    self.assertIsNone(self.window.GetMean())
+    self.assertIsNone(self.window.GetStartTime())
+
+    start = datetime.datetime.fromtimestamp(0)
+    for i, value in enumerate((4.0, 2.0, 6.0, 4.0)):
+      when = start + datetime.timedelta(seconds=i)
+      self.window.AddReading(value, when)
+
+    self.assertEqual(4, self.window.GetCount())
+    self.assertEqual(2.0, self.window.GetMin())
+    self.assertEqual(6.0, self.window.GetMax())
+    self.assertEqual(4.0, self.window.GetMean())
+    self.assertEqual(4.0, self.window.GetLast())
+    self.assertEqual(start, self.window.GetStartTime())
+
+  def testSummary(self):
+    start = datetime.datetime.fromtimestamp(0)
+    self.window.AddReading(5.0, start)
+    self.window.AddSummary(3, 1.0, 4.0, 3.0, 2.0, start)
+    self.assertEqual(4, self.window.GetCount())
+    self.assertEqual(1.0, self.window.GetMin())
+    self.assertEqual(5.0, self.window.GetMax())
+    self.assertEqual(3.5, self.window.GetMean())
+    self.assertEqual(2.0, self.window.GetLast())
+
+  def testReset(self):
+    self.window.AddReading(10.0, datetime.datetime.fromtimestamp(0))
+    self.window.Reset()
+    self.assertEqual(0, self.window.GetCount())
+    self.assertIsNone(self.window.GetStartTime())
+
+    self.window.AddReading(-3.0, datetime.datetime.fromtimestamp(60))
+    self.assertEqual(-3.0, self.window.GetMin())
+    self.assertEqual(-3.0, self.window.GetMax())
+
+
+class AnomalyDetectorTestCase(unittest.TestCase):
+  def setUp(self):
+    self.detector = thermo.AnomalyDetector('sensor0')
+    self.Alert = kbevent.ThermoAlertEvent.Alert
+
+  def _Feed(self, values):
+    alerts = []
+    for value in values:
+      alert = self.detector.AddReading(value)
+      if alert:
+        alerts.append(alert)
+    return alerts
+
+  def _Steady(self, count, center=4.0):
+    # Alternate slightly around `center`, like a working cooler.
+    return [center + (0.1 if i % 2 else -0.1) for i in range(count)]
+
+  def testSteadyReadings(self):
+    self.assertEqual([], self._Feed(self._Steady(200)))
+    self.assertAlmostEqual(4.0, self.detector.GetMean(), places=1)
+
+  def testSpike(self):
+    self._Feed(self._Steady(100))
+    self.assertEqual([self.Alert.SPIKE], self._Feed([15.0, 15.0]))
+    # The alert is raised again once the sensor has recovered.
+    self._Feed(self._Steady(100))
+    self.assertEqual([self.Alert.SPIKE], self._Feed([-10.0]))
+
+  def testStuck(self):
+    self._Feed(self._Steady(100))
+    alerts = self._Feed([4.0] * common_defs.THERMO_STUCK_READINGS)
+    self.assertEqual([], alerts)
+    self.assertEqual([self.Alert.STUCK], self._Feed([4.0] * 10))
+
+  def testDrift(self):
+    self._Feed(self._Steady(100))
+    # Warm up slowly, as with a failing compressor.
+    values = [4.0 + i * 0.01 for i in range(1000)]
+    self.assertEqual([self.Alert.DRIFT], self._Feed(values))
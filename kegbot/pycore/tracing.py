@@ -0,0 +1,210 @@
+"""Latency tracing of events across the daemons, the kegnet bus and the core.
+
+With --trace_sample_rate, KegnetClient.send_message starts a trace on a
+fraction of the events it sends, such as a kegboard daemon's MeterUpdates.  A
+trace is carried with its event (under the "trace" key of Event.ToDict) and
+records the time of each hop:
+
+  send:      sent by KegnetClient.send_message
+  net:       received from kegnet by the core's NetProtocolThread
+  dispatch:  taken off the EventHub queue for dispatch
+  handled:   all handlers have returned
+  publish:   published by a handler of a traced event, such as a FlowUpdate or
+             SetRelayOutputEvent published while handling a MeterUpdate
+
+Events published by a handler inherit a copy of the trace of the event being
+handled, so a trace follows a reading through to the events it causes.
+
+When an event with a trace has been handled, and --trace_file is set, the
+core writes one span per hop (from the previous hop), plus a "total" span from
+the start of the trace, in the Chrome trace event format.  The file can be
+opened in chrome://tracing or Perfetto, and Summarize() reports latency
+percentiles per event class and hop.
+
+Hop times are wall-clock times, so hops between hosts are only as accurate as
+their clocks are synchronized.
+"""
+
+from builtins import object
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import gflags
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_float('trace_sample_rate', 0.0,
+    'Fraction of sent events on which to start a latency trace.',
+    lower_bound=0.0, upper_bound=1.0)
+
+gflags.DEFINE_string('trace_file', '',
+    'If set, spans of traced events handled by the core are appended to this '
+    'file, in the Chrome trace event format.')
+
+HOP_SEND = 'send'
+HOP_NET = 'net'
+HOP_DISPATCH = 'dispatch'
+HOP_HANDLED = 'handled'
+HOP_PUBLISH = 'publish'
+
+SPAN_TOTAL = 'total'
+
+
+class Trace(object):
+  """Trace context of one event: an id, and the times of its hops."""
+  def __init__(self, trace_id, hops=None, inherited=0):
+    self.trace_id = trace_id
+    self.hops = list(hops or [])
+    # Number of leading hops copied from the event which caused this one.
+    self.inherited = inherited
+
+  def __str__(self):
+    return '<Trace %s %s>' % (self.trace_id,
+        ' '.join(name for name, when in self.hops))
+
+  @classmethod
+  def Start(cls, hop=HOP_SEND, now=None):
+    trace = cls('%016x' % random.getrandbits(64))
+    trace.AddHop(hop, now)
+    return trace
+
+  @classmethod
+  def FromDict(cls, data):
+    return cls(data['id'], [tuple(hop) for hop in data['hops']])
+
+  def ToDict(self):
+    return {
+      'id': self.trace_id,
+      'hops': [list(hop) for hop in self.hops],
+    }
+
+  def GetOrigin(self):
+    return self.hops[0][1] if self.hops else None
+
+  def AddHop(self, name, now=None):
+    if now is None:
+      now = time.time()
+    self.hops.append((name, now))
+
+  def Child(self):
+    """Returns a copy of this trace, for an event caused by its event."""
+    return Trace(self.trace_id, self.hops, inherited=len(self.hops))
+
+  def GetSpans(self):
+    """Returns (name, start, duration) of each hop not inherited."""
+    spans = []
+    for i in range(max(1, self.inherited), len(self.hops)):
+      name, when = self.hops[i]
+      start = self.hops[i - 1][1]
+      spans.append((name, start, when - start))
+    if spans:
+      origin = self.GetOrigin()
+      spans.append((SPAN_TOTAL, origin, self.hops[-1][1] - origin))
+    return spans
+
+
+def ShouldSample(rate=None):
+  """Returns whether to start a trace on an event being sent."""
+  if rate is None:
+    rate = FLAGS.trace_sample_rate
+  return rate > 0 and random.random() < rate
+
+
+class TraceExporter(object):
+  """Appends spans of traced events to a Chrome trace event file.
+
+  The file is a JSON array of complete ("X") events, one per line.  The closing
+  bracket is never written, as allowed by the format, so the file can be
+  appended to by later runs.
+  """
+  def __init__(self, path):
+    self._path = path
+    self._logger = logging.getLogger('tracing')
+    self._lock = threading.Lock()
+    self._pid = os.getpid()
+    new = not os.path.exists(path) or not os.path.getsize(path)
+    self._file = open(path, 'a')
+    if new:
+      self._file.write('[\n')
+      self._file.flush()
+
+  def GetPath(self):
+    return self._path
+
+  def Close(self):
+    with self._lock:
+      self._file.close()
+
+  def Export(self, event_name, trace):
+    """Writes the spans of `trace`, of an event of class `event_name`."""
+    spans = trace.GetSpans()
+    if not spans:
+      return
+    tid = int(trace.trace_id[:7], 16)
+    lines = []
+    for name, start, duration in spans:
+      lines.append(json.dumps({
+        'name': name,
+        'cat': event_name,
+        'ph': 'X',
+        'ts': int(start * 1e6),
+        'dur': int(duration * 1e6),
+        'pid': self._pid,
+        'tid': tid,
+        'args': {'trace_id': trace.trace_id},
+      }) + ',\n')
+    with self._lock:
+      try:
+        self._file.write(''.join(lines))
+        self._file.flush()
+      except (IOError, ValueError) as e:
+        self._logger.warning('Could not write trace: %s' % e)
+
+
+def BuildExporter():
+  """Returns a TraceExporter for --trace_file, or None if not set."""
+  if not FLAGS.trace_file:
+    return None
+  return TraceExporter(FLAGS.trace_file)
+
+
+def LoadSpans(path):
+  """Returns the trace events written to `path` by TraceExporter."""
+  with open(path) as f:
+    data = f.read().strip()
+  if data.endswith(','):
+    data = data[:-1]
+  if not data.endswith(']'):
+    data += ']'
+  return json.loads(data)
+
+
+def _Percentile(values, fraction):
+  index = min(len(values) - 1, int(fraction * len(values)))
+  return values[index]
+
+
+def Summarize(path):
+  """Returns latency statistics of the spans written to `path`.
+
+  Returns a dict mapping (event class name, span name) to a dict of `count`,
+  and the `p50`, `p99` and `max` durations in milliseconds.
+  """
+  durations = collections.defaultdict(list)
+  for span in LoadSpans(path):
+    durations[(span['cat'], span['name'])].append(span['dur'] / 1000.0)
+  ret = {}
+  for key, values in durations.items():
+    values.sort()
+    ret[key] = {
+      'count': len(values),
+      'p50': _Percentile(values, 0.5),
+      'p99': _Percentile(values, 0.99),
+      'max': values[-1],
+    }
+  return ret
@@ -0,0 +1,106 @@
+"""Unittest for tracing module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import kbevent
+from . import tracing
+
+class TraceTestCase(unittest.TestCase):
+  def testEncoded(self):
+    event = kbevent.MeterUpdate(meter_name='kegboard.flow0', reading=10)
+    event.SetTrace(tracing.Trace.Start(now=100.0))
+    data = event.ToJson()
+    self.assertIs(kbevent.MeterUpdate, kbevent.PeekEventClass(data))
+
+    decoded = kbevent.LazyDecodeEvent(data)
+    trace = decoded.GetTrace()
+    self.assertEqual(event.GetTrace().trace_id, trace.trace_id)
+    self.assertEqual([('send', 100.0)], trace.hops)
+    self.assertEqual(10, decoded.reading)
+    self.assertIsNone(kbevent.DecodeEvent(
+        kbevent.MeterUpdate(reading=1).ToJson()).GetTrace())
+
+  def testUntracedStaysUndecoded(self):
+    data = kbevent.MeterUpdate(meter_name='kegboard.flow0', reading=10).ToJson()
+    event = kbevent.LazyDecodeEvent(data)
+    event.AddTraceHop(tracing.HOP_NET)
+    self.assertIsNotNone(event._raw)
+    self.assertIsNone(event.GetTrace())
+    self.assertIsNotNone(event._raw)
+    self.assertEqual(10, event.reading)
+
+    traced = kbevent.MeterUpdate(reading=10)
+    traced.SetTrace(tracing.Trace.Start(now=100.0))
+    event = kbevent.LazyDecodeEvent(traced.ToJson())
+    event.AddTraceHop(tracing.HOP_NET)
+    self.assertEqual(['send', 'net'], [name for name, when in
+        event.GetTrace().hops])
+
+  def testSpans(self):
+    trace = tracing.Trace('1', [('send', 1.0), ('net', 1.5), ('dispatch', 2.0)])
+    self.assertEqual([('net', 1.0, 0.5), ('dispatch', 1.5, 0.5),
+        ('total', 1.0, 1.0)], trace.GetSpans())
+
+    child = trace.Child()
+    child.AddHop('publish', now=2.25)
+    self.assertEqual([('publish', 2.0, 0.25), ('total', 1.0, 1.25)],
+        child.GetSpans())
+    self.assertEqual([], tracing.Trace('2').GetSpans())
+
+class EventHubTracingTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'trace.json')
+    self.exporter = tracing.TraceExporter(self.path)
+
+  def tearDown(self):
+    self.exporter.Close()
+    shutil.rmtree(self.tempdir)
+
+  def testTraceFollowsDerivedEvents(self):
+    hub = kbevent.EventHub(trace_exporter=self.exporter)
+    relay_events = []
+
+    def HandleMeterUpdate(event):
+      hub.PublishEvent(kbevent.SetRelayOutputEvent(output_name='relay0'))
+    hub.Subscribe(kbevent.MeterUpdate, HandleMeterUpdate)
+    hub.Subscribe(kbevent.SetRelayOutputEvent, relay_events.append)
+
+    event = kbevent.MeterUpdate(meter_name='kegboard.flow0', reading=10)
+    event.SetTrace(tracing.Trace.Start())
+    event.AddTraceHop(tracing.HOP_NET)
+    hub.PublishEvent(event)
+    hub.PublishEvent(kbevent.MeterUpdate(meter_name='kegboard.flow1',
+        reading=10))
+    hub.Flush()
+
+    trace = relay_events[0].GetTrace()
+    self.assertEqual(event.GetTrace().trace_id, trace.trace_id)
+    self.assertEqual(['send', 'net', 'dispatch', 'publish', 'dispatch',
+        'handled'], [name for name, when in trace.hops])
+
+    summary = tracing.Summarize(self.path)
+    self.assertEqual(set([
+      ('MeterUpdate', 'net'),
+      ('MeterUpdate', 'dispatch'),
+      ('MeterUpdate', 'handled'),
+      ('MeterUpdate', 'total'),
+      ('SetRelayOutputEvent', 'publish'),
+      ('SetRelayOutputEvent', 'dispatch'),
+      ('SetRelayOutputEvent', 'handled'),
+      ('SetRelayOutputEvent', 'total'),
+    ]), set(summary))
+    self.assertEqual(1, summary[('MeterUpdate', 'total')]['count'])
+
+    # The file can be appended to by a later exporter.
+    self.exporter.Close()
+    self.exporter = tracing.TraceExporter(self.path)
+    self.exporter.Export('MeterUpdate', event.GetTrace())
+    self.assertEqual(2, tracing.Summarize(self.path)[
+        ('MeterUpdate', 'total')]['count'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,189 @@
+"""Pooled HTTP transport for the Kegbot web API.
+
+PooledClient is a kbapi.Client that sends every request over one keep-alive
+connection pool.  Requests are grouped into call types (auth lookups, drinks,
+sensor readings, status) that each have their own timeout and concurrency
+limit, as configured in common_defs.  A latency histogram is kept for each
+call type.
+
+--api_timeout no longer applies to every request as is: each call type's
+timeout is a multiple of it (see common_defs.API_CALL_TIMEOUT_SCALE), so
+auth lookups give up sooner, and drinks later.
+"""
+
+from builtins import object
+import bisect
+import logging
+import re
+import threading
+import time
+
+import gflags
+import requests
+from requests import adapters
+
+from kegbot.api import kbapi
+from . import common_defs
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('api_pool_size', 8,
+    'Maximum number of keep-alive connections to the Kegbot web API.',
+    lower_bound=1)
+
+
+class CallType(object):
+  AUTH = 'auth'
+  DRINK = 'drink'
+  SENSOR = 'sensor'
+  STATUS = 'status'
+  DEFAULT = 'default'
+
+  ALL = (AUTH, DRINK, SENSOR, STATUS, DEFAULT)
+
+# (pattern, is_post, call type), first match wins.
+_CALL_TYPE_RULES = (
+  (re.compile(r'^auth-tokens/'), None, CallType.AUTH),
+  (re.compile(r'^taps/'), True, CallType.DRINK),
+  (re.compile(r'^cancel-drink$'), True, CallType.DRINK),
+  (re.compile(r'^thermo-sensors/'), True, CallType.SENSOR),
+  (re.compile(r'^(status|taps)$'), False, CallType.STATUS),
+)
+
+
+def GetCallType(endpoint, is_post=False):
+  """Returns the CallType of a request to `endpoint`."""
+  endpoint = endpoint.strip('/')
+  for pattern, post, call_type in _CALL_TYPE_RULES:
+    if post is not None and post != is_post:
+      continue
+    if pattern.match(endpoint):
+      return call_type
+  return CallType.DEFAULT
+
+
+def _GetSetting(settings, call_type):
+  value = settings.get(call_type)
+  if value is None:
+    value = settings['default']
+  return value
+
+
+class LatencyHistogram(object):
+  """Thread-safe histogram of request latencies."""
+  def __init__(self, buckets_ms=common_defs.API_LATENCY_BUCKETS_MS):
+    self._buckets_ms = tuple(buckets_ms)
+    self._counts = [0] * (len(self._buckets_ms) + 1)
+    self._count = 0
+    self._errors = 0
+    self._total_ms = 0.0
+    self._max_ms = 0.0
+    self._lock = threading.Lock()
+
+  def Add(self, latency_ms, error=False):
+    with self._lock:
+      self._counts[bisect.bisect_left(self._buckets_ms, latency_ms)] += 1
+      self._count += 1
+      self._total_ms += latency_ms
+      self._max_ms = max(self._max_ms, latency_ms)
+      if error:
+        self._errors += 1
+
+  def GetPercentile(self, percentile):
+    """Returns the upper bound (ms) of the bucket holding `percentile`.
+
+    Returns None if there are no samples, or the maximum latency seen if the
+    percentile falls beyond the last bucket.
+    """
+    with self._lock:
+      if not self._count:
+        return None
+      rank = self._count * percentile / 100.0
+      seen = 0
+      for i, count in enumerate(self._counts):
+        seen += count
+        if seen >= rank:
+          if i < len(self._buckets_ms):
+            return self._buckets_ms[i]
+          break
+      return self._max_ms
+
+  def GetStats(self):
+    """Returns a dict summarizing the histogram."""
+    with self._lock:
+      buckets = dict(zip(self._buckets_ms, self._counts))
+      buckets['inf'] = self._counts[-1]
+      count = self._count
+      stats = {
+        'count': count,
+        'errors': self._errors,
+        'mean_ms': self._total_ms / count if count else None,
+        'max_ms': self._max_ms,
+        'buckets': buckets,
+      }
+    stats['p50_ms'] = self.GetPercentile(50)
+    stats['p99_ms'] = self.GetPercentile(99)
+    return stats
+
+
+class PooledClient(kbapi.Client):
+  """kbapi.Client using a pooled session and per-call-type limits."""
+  def __init__(self, api_url=None, api_key=None, pool_size=None, timeout=None):
+    super(PooledClient, self).__init__(api_url=api_url, api_key=api_key)
+    self._logger = logging.getLogger('api-transport')
+    if pool_size is None:
+      pool_size = FLAGS.api_pool_size
+    if timeout is None:
+      timeout = FLAGS.api_timeout
+    self._session = requests.Session()
+    adapter = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self._session.mount('http://', adapter)
+    self._session.mount('https://', adapter)
+    self._session.headers['X-Kegbot-Api-Key'] = self._api_key
+
+    self._limiters = {}
+    self._histograms = {}
+    self._timeouts = {}
+    for call_type in CallType.ALL:
+      self._timeouts[call_type] = timeout * _GetSetting(
+          common_defs.API_CALL_TIMEOUT_SCALE, call_type)
+      self._limiters[call_type] = threading.BoundedSemaphore(
+          _GetSetting(common_defs.API_CALL_MAX_CONCURRENCY, call_type))
+      self._histograms[call_type] = LatencyHistogram()
+
+  def close(self):
+    self._session.close()
+
+  def _http_request(self, endpoint, params=None, post_data=None):
+    call_type = GetCallType(endpoint, is_post=bool(post_data))
+    timeout = self._timeouts[call_type]
+    url = self._get_url(endpoint)
+
+    # Wait no longer for a free slot than the call itself may take.
+    limiter = self._limiters[call_type]
+    if not limiter.acquire(timeout=timeout):
+      self._histograms[call_type].Add(timeout * 1000.0, error=True)
+      raise kbapi.RequestError('Too many pending %s requests' % call_type)
+
+    start = time.time()
+    error = True
+    try:
+      if post_data:
+        r = self._session.post(url, params=params, data=post_data,
+            timeout=timeout)
+      else:
+        r = self._session.get(url, params=params, timeout=timeout)
+      error = r.status_code >= 500
+    except requests.exceptions.RequestException as e:
+      raise kbapi.RequestError(e)
+    finally:
+      limiter.release()
+      self._histograms[call_type].Add((time.time() - start) * 1000.0,
+          error=error)
+
+    return kbapi.decode_response(r)
+
+  def GetLatencyStats(self):
+    """Returns a dict of call type to latency histogram stats."""
+    return dict((call_type, histogram.GetStats())
+        for call_type, histogram in self._histograms.items())
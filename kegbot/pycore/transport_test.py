@@ -0,0 +1,114 @@
+"""Unittest for transport module"""
+
+import threading
+import unittest
+
+from . import transport
+
+class FakeResponse(object):
+  status_code = 200
+
+  def json(self):
+    return {'object': {'ok': True}}
+
+
+class FakeSession(object):
+  def __init__(self):
+    self.requests = []
+    self.started = threading.Event()
+    self.release = threading.Event()
+    self.slow_url = None
+
+  def _Request(self, method, url, timeout):
+    self.requests.append((method, url, timeout))
+    if url == self.slow_url:
+      self.started.set()
+      self.release.wait()
+    return FakeResponse()
+
+  def get(self, url, params=None, timeout=None):
+    return self._Request('GET', url, timeout)
+
+  def post(self, url, params=None, data=None, timeout=None):
+    return self._Request('POST', url, timeout)
+
+
+class CallTypeTestCase(unittest.TestCase):
+  def testGetCallType(self):
+    CallType = transport.CallType
+    self.assertEqual(CallType.AUTH,
+        transport.GetCallType('auth-tokens/core.rfid/1234'))
+    self.assertEqual(CallType.DRINK,
+        transport.GetCallType('/taps/kegboard.flow0', is_post=True))
+    self.assertEqual(CallType.DRINK,
+        transport.GetCallType('/cancel-drink', is_post=True))
+    self.assertEqual(CallType.SENSOR,
+        transport.GetCallType('/thermo-sensors/thermo-1', is_post=True))
+    self.assertEqual(CallType.STATUS, transport.GetCallType('status'))
+    self.assertEqual(CallType.STATUS, transport.GetCallType('taps'))
+    self.assertEqual(CallType.DEFAULT, transport.GetCallType('controllers',
+        is_post=True))
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+  def testStats(self):
+    histogram = transport.LatencyHistogram(buckets_ms=(10, 100))
+    self.assertIsNone(histogram.GetPercentile(50))
+    for latency in (5, 5, 50, 500):
+      histogram.Add(latency)
+    histogram.Add(20, error=True)
+
+    stats = histogram.GetStats()
+    self.assertEqual(5, stats['count'])
+    self.assertEqual(1, stats['errors'])
+    self.assertEqual({10: 2, 100: 2, 'inf': 1}, stats['buckets'])
+    self.assertEqual(100, stats['p50_ms'])
+    self.assertEqual(500, stats['p99_ms'])
+
+
+class PooledClientTestCase(unittest.TestCase):
+  def setUp(self):
+    self.client = transport.PooledClient(api_url='http://localhost/api/',
+        api_key='key')
+    self.session = self.client._session = FakeSession()
+
+  def testRequests(self):
+    self.assertEqual({'ok': True}, self.client.status())
+    self.client.log_sensor_reading('thermo-1', 4.0)
+    self.assertEqual([
+        ('GET', 'http://localhost/api/status', 10.0),
+        ('POST', 'http://localhost/api/thermo-sensors/thermo-1', 5.0),
+      ], self.session.requests)
+
+    stats = self.client.GetLatencyStats()
+    self.assertEqual(1, stats['status']['count'])
+    self.assertEqual(1, stats['sensor']['count'])
+    self.assertEqual(0, stats['auth']['count'])
+
+  def testTimeoutsScaleWithApiTimeout(self):
+    client = transport.PooledClient(api_url='http://localhost/api/',
+        api_key='key', timeout=20.0)
+    session = client._session = FakeSession()
+    client.get_token('core.rfid', '1234')
+    client.status()
+    self.assertEqual([6.0, 20.0], [r[2] for r in session.requests])
+
+  def testSlowCallTypeDoesNotBlockOthers(self):
+    # Hold the only sensor slot with a slow upload.
+    self.session.slow_url = 'http://localhost/api/thermo-sensors/thermo-1'
+    thr = threading.Thread(target=self.client.log_sensor_reading,
+        args=('thermo-1', 4.0))
+    thr.start()
+    try:
+      self.session.started.wait()
+      self.assertEqual({'ok': True},
+          self.client.get_token('core.rfid', '1234'))
+    finally:
+      self.session.release.set()
+      thr.join()
+    stats = self.client.GetLatencyStats()
+    self.assertEqual(1, stats['auth']['count'])
+    self.assertEqual(1, stats['sensor']['count'])
+
+if __name__ == '__main__':
+  unittest.main()